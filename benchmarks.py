@@ -0,0 +1,264 @@
+import os
+import io
+import glob
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+import tracemalloc
+import sys
+import numpy as np
+import pandas as pd
+from sklearn.kernel_ridge import KernelRidge
+
+
+from common import ROOT_DIR, RAW_DATA_DIR, START_YEAR, END_YEAR
+from ghcnd import read_dly, columns_to_frame
+from weather import GhcndMunger
+from indemnities import USDAIndemnitiesMunger
+from predict import USAMaizeYieldPredictor
+from synthetic import write_synthetic_data, CORN_YIELD_CSV
+from checks import read_dly_fwf
+import plots
+
+
+def best_time(function, repeat=3):
+    "Smallest wall time of a few calls, and the last result"
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+
+    return min(times), result
+
+
+def measure(function, repeat=3):
+    """best_time, plus the peak memory allocated during one more call as
+    traced by tracemalloc (which slows things down, so it isn't timed)"""
+    seconds, result = best_time(function, repeat)
+    tracemalloc.start()
+    try:
+        function()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return seconds, peak, result
+
+
+def benchmark_suite(directory, n_stations=10, start_year=START_YEAR,
+                    rows_per_year=10000, repeat=3, seed=0):
+    """Time the pipeline's stages, and trace their peak memory, on synthetic
+    data written to directory: parsing .dly files, munge (without and with
+    the parse cache), indemnity munging (likewise), loading the predictor,
+    one prediction, leave-one-out validation (closed form and refit),
+    drawing the report's figures, comparing kernel ridge variants over a
+    process pool and bootstrap prediction intervals. Runs offline, with the
+    outputs written to directory too. Returns a list of dicts of name,
+    seconds, peak_bytes and repeat."""
+    station_ids = write_synthetic_data(directory, n_stations, start_year,
+                                       END_YEAR, rows_per_year, seed)
+    cache_dir = os.path.join(directory, "cache")
+    results = []
+    def record(name, function, repeat=repeat):
+        seconds, peak, result = measure(function, repeat)
+        results.append({"name" : name, "seconds" : seconds,
+                        "peak_bytes" : peak, "repeat" : repeat})
+        return result
+    def munge(cache):
+        return GhcndMunger(cache, directory).munge(station_ids=station_ids)
+    def leave_one_out(fast):
+        predictor.leave_one_out_cross_validation(fast)
+    raw_data_dir = USDAIndemnitiesMunger.raw_data_dir
+    working_dir = os.getcwd()
+    plots_mode = plots.current_mode()
+    # munge and report print a lot and write their outputs to the working
+    # directory
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            os.chdir(directory)
+            # Time the figures on their own, rather than as part of
+            # validation
+            plots.set_mode("none")
+            USDAIndemnitiesMunger.raw_data_dir = directory
+            record("get_measurements", lambda: [
+                GhcndMunger(None, directory).get_measurements(station_id)
+                for station_id in station_ids])
+            record("munge", lambda: munge(None))
+            record("munge_cached", lambda: munge(cache_dir))
+            record("indemnities_munge",
+                   lambda: USDAIndemnitiesMunger.munge(cache_dir=None))
+            record("indemnities_munge_cached",
+                   lambda: USDAIndemnitiesMunger.munge(cache_dir=cache_dir))
+            predictor = record("predictor_init", lambda: USAMaizeYieldPredictor(
+                yield_csv_name=os.path.join(directory, CORN_YIELD_CSV),
+                weather_name=os.path.join(directory, "weather.features")))
+            record("predict", lambda: predictor.predict(END_YEAR))
+            record("leave_one_out_cross_validation",
+                   lambda: leave_one_out(True))
+            record("leave_one_out_cross_validation_refit",
+                   lambda: leave_one_out(False), 1)
+            record("report_figures",
+                   lambda: plots.report_figures(predictor.predictions))
+            record("compare", lambda: predictor.compare(
+                {"kernel_ridge_" + kernel : KernelRidge(kernel=kernel)
+                 for kernel in ["poly", "rbf", "linear"]}, workers=2), 1)
+            record("bootstrap_intervals",
+                   lambda: predictor.bootstrap_intervals(resamples=200), 1)
+        finally:
+            plots.set_mode(plots_mode)
+            USDAIndemnitiesMunger.raw_data_dir = raw_data_dir
+            os.chdir(working_dir)
+
+    return results
+
+
+def benchmark_imports(modules=("weather", "indemnities", "predict"),
+                      repeat=3):
+    """Time importing each module in a fresh interpreter, which is the
+    startup cost of its command line before any work, in the same form as
+    benchmark_suite's results"""
+    results = []
+    for module in modules:
+        script = ("import time; start = time.perf_counter(); import " +
+                  module + "; print(time.perf_counter() - start)")
+        seconds = min(
+            float(subprocess.check_output([sys.executable, "-c", script],
+                                          cwd=ROOT_DIR))
+            for i in range(repeat))
+        results.append({"name" : "import_" + module, "seconds" : seconds,
+                        "peak_bytes" : None, "repeat" : repeat})
+
+    return results
+
+
+def git_commit():
+    "The checked out commit, if this is a git repository"
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT_DIR,
+            stderr=subprocess.DEVNULL).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_report(results, path, **settings):
+    """Save benchmark results as JSON, with the commit, library versions and
+    settings they were measured with, for comparison across commits"""
+    report = {"commit" : git_commit(),
+              "python" : platform.python_version(),
+              "numpy" : np.__version__,
+              "pandas" : pd.__version__,
+              "settings" : settings,
+              "results" : results}
+    with open(path, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+
+    return report
+
+
+def benchmark_dly_parsers(dly_paths=None, repeat=3):
+    """Time the reference parser against ghcnd.read_dly on every .dly file in
+    raw_data, checking that both give the same DataFrame."""
+    if dly_paths is None:
+        dly_paths = sorted(glob.glob(
+            os.path.join(RAW_DATA_DIR, "*.dly")))
+    rows = []
+    for dly_path in dly_paths:
+        reference_time, reference = best_time(
+            lambda: read_dly_fwf(dly_path), repeat)
+        fast_time, fast = best_time(
+            lambda: columns_to_frame(read_dly(dly_path)), repeat)
+        # wide_to_long orders its id columns through a set, so the column
+        # order of the reference changes from run to run
+        pd.testing.assert_frame_equal(reference, fast, check_like=True)
+        rows.append([os.path.basename(dly_path), len(fast),
+                     reference_time, fast_time, reference_time / fast_time])
+    results = pd.DataFrame(
+        rows,
+        columns=["file", "rows", "read_fwf_seconds", "read_dly_seconds",
+                 "speedup"])
+    results = results.set_index("file")
+
+    return results
+
+
+def benchmark_store_memory(station_ids=None):
+    """Compare the memory held by GhcndMunger's dict of long DataFrames with a
+    MeasurementStore of the same stations."""
+    if station_ids is None:
+        station_ids = [os.path.basename(path)[:-len(".dly")] for path in
+                       sorted(glob.glob(
+                           os.path.join(RAW_DATA_DIR, "*.dly")))]
+    munger = GhcndMunger()
+    frame_bytes = sum(
+        munger.get_measurements(station_id).memory_usage(deep=True).sum()
+        for station_id in station_ids)
+    store = GhcndMunger().get_store(station_ids)
+
+    return frame_bytes, store.values.nbytes
+
+
+def benchmark_leave_one_out(scale_on_all_years=True):
+    """Time leave-one-out validation by refitting for every year against the
+    closed form, checking that they agree. Needs weather.features."""
+    predictor = USAMaizeYieldPredictor()
+    years = range(START_YEAR, END_YEAR+1)
+    refit_time, refit = best_time(
+        lambda: np.array([predictor.predict(year, scale_on_all_years)
+                          for year in years]), 1)
+    fast_time, fast = best_time(
+        lambda: predictor.fast_leave_one_out(scale_on_all_years))
+    np.testing.assert_allclose(fast, refit, rtol=1e-8, atol=1e-10)
+
+    return refit_time, fast_time
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time the pipeline on synthetic data, offline")
+    parser.add_argument("--stations", type=int, default=10)
+    parser.add_argument("--start-year", type=int, default=START_YEAR,
+                        help="first year of the synthetic .dly files")
+    parser.add_argument("--rows-per-year", type=int, default=10000,
+                        help="synthetic indemnity records per year")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir",
+                        help="where to write the synthetic data (kept), "
+                             "instead of a temporary directory")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--reference", action="store_true",
+                        help="also compare against the original parser and "
+                             "leave-one-out on the data in raw_data")
+    args = parser.parse_args()
+    directory = args.data_dir or tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        results = benchmark_suite(directory, args.stations, args.start_year,
+                                  args.rows_per_year, args.repeat, args.seed)
+        results += benchmark_imports(repeat=args.repeat)
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(directory)
+    write_report(results, args.output, stations=args.stations,
+                 start_year=args.start_year,
+                 rows_per_year=args.rows_per_year, repeat=args.repeat,
+                 seed=args.seed)
+    print(pd.DataFrame(results).set_index("name"))
+    if args.reference:
+        results = benchmark_dly_parsers()
+        print(results)
+        print("Total speedup: " + str(results["read_fwf_seconds"].sum() /
+                                      results["read_dly_seconds"].sum()))
+        frame_bytes, store_bytes = benchmark_store_memory()
+        print("DataFrame dict: " + str(frame_bytes // 2**20) + " MB, " +
+              "MeasurementStore: " + str(store_bytes // 2**20) + " MB")
+        if os.path.isdir(os.path.join(ROOT_DIR, "weather.features")):
+            refit_time, fast_time = benchmark_leave_one_out()
+            print("Leave one out: " + str(refit_time) + "s refitting, " +
+                  str(fast_time) + "s closed form")
@@ -0,0 +1,165 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+
+from common import ROOT_DIR
+
+
+# Parsed and derived data live next to raw_data
+CACHE_DIR = os.path.join(ROOT_DIR, "cache")
+
+
+def digest(*parts):
+    "Stable hex digest of some JSON-able parameters"
+    return hashlib.sha1(
+        json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def file_digest(path):
+    "sha1 of a file's content, read in blocks"
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(block)
+
+    return sha1.hexdigest()
+
+
+def file_fingerprint(path):
+    stat = os.stat(path)
+    return {"size" : stat.st_size, "mtime_ns" : stat.st_mtime_ns}
+
+
+def is_fresh(source, metadata, path=None, entry=None):
+    """Whether a cache entry built from source is still good. Size and mtime
+    are checked first; if only the mtime moved, the content hash decides.
+    When the content is the same, the new mtime goes into metadata, and if
+    path (the entry's directory) is given the entry's metadata (entry, or
+    metadata itself) is saved there, so source isn't hashed again next
+    time."""
+    fingerprint = file_fingerprint(source)
+    if fingerprint["size"] != metadata.get("size"):
+        return False
+    if fingerprint["mtime_ns"] == metadata.get("mtime_ns"):
+        return True
+    if file_digest(source) != metadata.get("sha1"):
+        return False
+    metadata["mtime_ns"] = fingerprint["mtime_ns"]
+    if path is not None:
+        save_metadata(path, metadata if entry is None else entry)
+    return True
+
+
+def replace_directory(scratch, path):
+    """Move a directory written in full at scratch to path, in place of
+    whatever is there. The old directory is renamed aside first and only
+    then removed, so path is only ever missing for the moment between two
+    renames, and never holds a mix of old and new files. A reader in that
+    moment, or a crash, costs a cache miss."""
+    old = None
+    if os.path.isdir(path):
+        old = scratch + ".old"
+        os.replace(path, old)
+    os.replace(scratch, path)
+    if old is not None:
+        shutil.rmtree(old)
+
+
+def save_columns(path, columns, metadata=None):
+    """Write a dict of numpy arrays as one .npy file per column, plus a
+    metadata.json. The entry is written in full beside path and then renamed
+    into place (see replace_directory), so readers never see half of one."""
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+    scratch = tempfile.mkdtemp(dir=parent)
+    for name, column in columns.items():
+        np.save(os.path.join(scratch, name + ".npy"), np.asarray(column))
+    with open(os.path.join(scratch, "metadata.json"), "w") as metadata_file:
+        json.dump(dict(metadata or {}, columns=list(columns)), metadata_file)
+    replace_directory(scratch, path)
+
+
+def save_metadata(path, metadata):
+    "Rewrite the metadata.json of an existing entry, atomically"
+    scratch = os.path.join(path, "metadata.json.tmp")
+    with open(scratch, "w") as metadata_file:
+        json.dump(metadata, metadata_file)
+    os.replace(scratch, os.path.join(path, "metadata.json"))
+
+
+def load_metadata(path):
+    "metadata.json of a cache entry, or None if there isn't one"
+    try:
+        with open(os.path.join(path, "metadata.json")) as metadata_file:
+            return json.load(metadata_file)
+    except (IOError, ValueError):
+        return None
+
+
+def load_columns(path, mmap_mode="r"):
+    """Read the columns written by save_columns. By default every column is
+    a read-only memory map, so loading costs no parsing and no copies."""
+    metadata = load_metadata(path)
+    if metadata is None:
+        return None
+    return {name : np.load(os.path.join(path, name + ".npy"),
+                           mmap_mode=mmap_mode)
+            for name in metadata["columns"]}
+
+
+def source_metadata(sources):
+    "Fingerprints and sha1s of the files a cache entry is built from"
+    return {path : dict(file_fingerprint(path), sha1=file_digest(path))
+            for path in sources}
+
+
+def is_current(metadata, key, sources=(), path=None):
+    """Whether a cache entry's metadata says it was built with key from
+    sources that are all still fresh. path is the entry's directory, for
+    is_fresh to save new mtimes to."""
+    return (metadata is not None and metadata.get("key") == key and
+            sorted(metadata.get("sources", {})) == sorted(sources) and
+            all(is_fresh(source, metadata["sources"][source], path, metadata)
+                for source in sources))
+
+
+def memoize_columns(path, key, compute, sources=()):
+    """The columns saved at path, if they were computed with key (a digest
+    of the parameters) from source files that haven't changed since, or else
+    compute() saved there for next time. Returns the columns and whether
+    they had to be computed."""
+    if is_current(load_metadata(path), key, sources, path):
+        return load_columns(path), False
+    columns = compute()
+    save_columns(path, columns, {"key" : key,
+                                 "sources" : source_metadata(sources)})
+
+    return columns, True
+
+
+def array_digest(arrays):
+    "sha1 of the contents of some numpy arrays"
+    sha1 = hashlib.sha1()
+    for array in arrays:
+        sha1.update(np.ascontiguousarray(array).tobytes())
+
+    return sha1.hexdigest()
+
+
+def group_digests(groups, columns):
+    """sha1 of the rows of some columns in each group, by group (as a string,
+    for JSON), to tell which slices of a source changed since last time"""
+    order = np.argsort(groups, kind="stable")
+    names, starts = np.unique(np.asarray(groups)[order], return_index=True)
+    stops = np.append(starts[1:], len(order))
+    digests = dict()
+    for name, start, stop in zip(names, starts, stops):
+        rows = order[start:stop]
+        digests[str(name)] = array_digest([column[rows]
+                                           for column in columns])
+
+    return digests
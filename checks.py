@@ -0,0 +1,240 @@
+import os
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+
+
+from common import START_YEAR, END_YEAR
+from ghcnd import read_dly, columns_to_frame, ELEMENTS, MISSING_VALUE
+from discover import dly_members, scan, rank_stations
+from features import FeatureMatrix
+from store import MeasurementStore
+from stress import stress_features
+from predict import USAMaizeYieldPredictor, MultiTargetYieldPredictor
+from synthetic import (write_dly, write_dly_tarball, write_quickstats,
+                       CORN_YIELD_CSV)
+
+
+# Offline checks that the fast code paths agree with straightforward ones,
+# on synthetic data. Each raises AssertionError on a mismatch.
+
+
+def read_dly_fwf(dly_path):
+    """The original pd.read_fwf + pd.wide_to_long parser, kept as a reference
+    for checking and timing ghcnd.read_dly"""
+    # The fixed-width data in the .dly files begin with these four elements
+    names = ["ID", "YEAR", "MONTH", "ELEMENT"]
+    colspecs = [(0,11), (11,15), (15,17), (17,21)]
+    # After that, there are 4 components times 31 days.
+    column_index = 21
+    for i in range(1,32):
+        for name, width in [("VALUE", 5), ("MFLAG", 1),
+                            ("QFLAG", 1), ("SFLAG", 1)]:
+            names.append(name + str(i))
+            colspecs.append((column_index, column_index+width))
+            column_index += width
+    measurements = pd.read_fwf(dly_path, names=names, colspecs=colspecs)
+    measurements = measurements[(measurements["ELEMENT"]=="PRCP") |
+                                (measurements["ELEMENT"]=="TMAX") |
+                                (measurements["ELEMENT"]=="TMIN")]
+    measurements = measurements[(measurements["YEAR"] >= START_YEAR) &
+                                (measurements["YEAR"] <= END_YEAR)]
+    measurements["dly_file_index"] = measurements.index
+    measurements = pd.wide_to_long(measurements,
+                                   ["VALUE", "MFLAG", "QFLAG", "SFLAG"],
+                                   i="dly_file_index",
+                                   j="DAY")
+    measurements = measurements.reset_index(level=["DAY"])
+    measurements["DAY"] = measurements["DAY"].astype(np.int64)
+    measurements = measurements[measurements["VALUE"] != -9999]
+    measurements = measurements[measurements["QFLAG"].isnull()]
+    measurements["SFLAG"] = measurements["SFLAG"].astype(str)
+    measurements = measurements[measurements["SFLAG"] != "S"]
+    measurements = measurements.drop(["MFLAG", "QFLAG", "SFLAG"], axis=1)
+
+    return measurements
+
+
+def check_parse_dly(dly_paths=None):
+    """ghcnd.read_dly against read_dly_fwf on synthetic .dly files, which
+    have missing days, quality and "S" source flags, days past the end of
+    the month and an element to drop, and on dly_paths if given (say
+    raw_data's)"""
+    scratch = tempfile.mkdtemp(prefix="check-")
+    try:
+        paths = [write_dly(scratch, "USZ%08d" % i, 1880, END_YEAR, seed=i)
+                 for i in range(2)]
+        for dly_path in paths + list(dly_paths or []):
+            # wide_to_long orders its id columns through a set, so the
+            # column order of the reference changes from run to run
+            pd.testing.assert_frame_equal(
+                read_dly_fwf(dly_path), columns_to_frame(read_dly(dly_path)),
+                check_like=True)
+    finally:
+        shutil.rmtree(scratch)
+
+
+def write_weather(path, n_stations=3, seed=0):
+    """A features.FeatureMatrix of made up monthly statistics for every
+    study year, like munge's"""
+    rng = np.random.RandomState(seed)
+    columns = ["%s_USZ%08d_month%d" % (statistic, station, month)
+               for station in range(n_stations)
+               for statistic in ["TMAXavg", "TMINavg", "PRCPavg"]
+               for month in range(2, 12)]
+    years = pd.Index(range(START_YEAR, END_YEAR + 1), name="year")
+    weather = pd.DataFrame(rng.normal(size=(len(years), len(columns))),
+                           index=years, columns=columns)
+    FeatureMatrix.from_frame(weather).save(path)
+
+    return path
+
+
+def check_fast_leave_one_out():
+    """USAMaizeYieldPredictor.fast_leave_one_out's closed form against
+    refitting for every year with predict, scaling on every year and on
+    the training years only, on synthetic weather and yields"""
+    scratch = tempfile.mkdtemp(prefix="check-")
+    try:
+        write_quickstats(scratch)
+        predictor = USAMaizeYieldPredictor(
+            yield_csv_name=os.path.join(scratch, CORN_YIELD_CSV),
+            weather_name=write_weather(os.path.join(scratch,
+                                                    "weather.features")))
+        for scale_on_all_years in [True, False]:
+            refit = [predictor.predict(year, scale_on_all_years)
+                     for year in range(START_YEAR, END_YEAR + 1)]
+            np.testing.assert_allclose(
+                predictor.fast_leave_one_out(scale_on_all_years), refit,
+                rtol=1e-8, atol=1e-10)
+    finally:
+        shutil.rmtree(scratch)
+
+
+def check_multi_target_frames():
+    """MultiTargetYieldPredictor detrends a history passed as a DataFrame,
+    with a RangeIndex, the same as the csv it was read from"""
+    scratch = tempfile.mkdtemp(prefix="check-")
+    try:
+        write_quickstats(scratch)
+        yield_csv_name = os.path.join(scratch, CORN_YIELD_CSV)
+        weather_name = write_weather(os.path.join(scratch,
+                                                  "weather.features"))
+        history = pd.read_csv(yield_csv_name)[["Year", "Value"]]
+        departures = []
+        for target in [yield_csv_name, history]:
+            predictor = MultiTargetYieldPredictor(
+                targets={"corn" : target}, weather_name=weather_name)
+            departures.append(predictor.yields["departure_from_trend"])
+        assert departures[0]["corn"].notnull().all()
+        pd.testing.assert_frame_equal(*departures)
+    finally:
+        shutil.rmtree(scratch)
+
+
+def check_stress_missing_seasons():
+    """stress.stress_features gives NaN, not 0, for a station's season
+    without any measurements, or without any of one element, and counts
+    heat days as a loop over the season would"""
+    rng = np.random.RandomState(0)
+    store = MeasurementStore.empty(["USZ00000000", "USZ00000001"])
+    shape = store.values.shape[:2]
+    store.element("TMAX")[:] = rng.normal(250, 80, shape)
+    store.element("TMIN")[:] = rng.normal(100, 80, shape)
+    store.element("PRCP")[:] = (rng.exponential(40, shape) *
+                                (rng.uniform(size=shape) < 0.3))
+    def season(year):
+        return slice(store.day_slice(year, 2).start,
+                     store.day_slice(year, 11).stop)
+    # A season with nothing at all, and one without TMAX
+    store.station("USZ00000001")[season(1950)] = np.nan
+    store.select("USZ00000001", "TMAX")[season(1960)] = np.nan
+    stress = stress_features(store)
+    station = [column for column in stress.columns
+               if "_USZ00000001_" in column]
+    heat = [column for column in station if column.startswith("HEAT")]
+    assert stress.loc[1950, station].isnull().all()
+    assert stress.loc[1960, heat].isnull().all()
+    assert stress.loc[1960, stress.columns.difference(heat)].notnull().all()
+    assert stress.drop([1950, 1960]).notnull().all().all()
+    heat_days = sum(1 for value in store.select("USZ00000000", "TMAX")[
+        season(1970)] if value >= 320)
+    assert stress.loc[1970, "HEATdays_USZ00000000_month2to11"] == heat_days
+
+
+def line_coverage(data, start_year=START_YEAR, end_year=END_YEAR):
+    """discover.station_coverage's day counts by element and its first and
+    last years, worked out a line and a day at a time"""
+    counts = dict.fromkeys(ELEMENTS, 0)
+    years = []
+    for line in data.decode("ascii").splitlines():
+        year = int(line[11:15])
+        element = line[17:21]
+        if element not in counts or not start_year <= year <= end_year:
+            continue
+        for day in range(31):
+            field = line[21 + 8 * day:29 + 8 * day]
+            if (int(field[:5]) != MISSING_VALUE and field[6] == " " and
+                    field[7] != "S"):
+                counts[element] += 1
+                years.append(year)
+
+    return counts, min(years), max(years)
+
+
+def check_scan(workers=2):
+    """Scan a synthetic ghcnd_all.tar.gz, serially and in a process pool,
+    against line_coverage, and check the stations rank by coverage"""
+    # Most coverage first
+    years = {"USZ00000000" : (1880, END_YEAR),
+             "USZ00000001" : (1950, END_YEAR),
+             "USZ00000002" : (1900, 1960)}
+    n_days = (pd.Timestamp(str(END_YEAR) + "-12-31") -
+              pd.Timestamp(str(START_YEAR) + "-01-01")).days + 1
+    scratch = tempfile.mkdtemp(prefix="check-")
+    try:
+        tarball = write_dly_tarball(
+            os.path.join(scratch, "ghcnd_all.tar.gz"), years)
+        members = dict(dly_members(tarball))
+        assert sorted(members) == sorted(years)
+        for pool in [1, workers]:
+            coverage = scan(tarball, pool)
+            assert list(coverage["ID"]) == sorted(years)
+            for station_id, row in coverage.set_index("ID").iterrows():
+                counts, first_year, last_year = line_coverage(
+                    members[station_id])
+                for element in ELEMENTS:
+                    assert np.isclose(row[element],
+                                      counts[element] / float(n_days))
+                assert (row["first_year"], row["last_year"]) == (
+                    first_year, last_year)
+        ranked = rank_stations(coverage)
+        assert list(ranked["ID"]) == list(years)
+        assert list(ranked["rank_in_region"]) == [1, 2, 3]
+    finally:
+        shutil.rmtree(scratch)
+
+
+# Every check, by name
+CHECKS = {"parse_dly" : check_parse_dly,
+          "fast_leave_one_out" : check_fast_leave_one_out,
+          "multi_target_frames" : check_multi_target_frames,
+          "stress_missing_seasons" : check_stress_missing_seasons,
+          "scan" : check_scan}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check the fast code paths against simple ones, offline")
+    parser.add_argument("checks", nargs="*",
+                        help="the checks to run, of " + ", ".join(CHECKS) +
+                             "; all of them by default")
+    args = parser.parse_args()
+    unknown = set(args.checks) - set(CHECKS)
+    if unknown:
+        parser.error("no such check: " + ", ".join(sorted(unknown)))
+    for name in args.checks or CHECKS:
+        CHECKS[name]()
+        print(name + " ok")
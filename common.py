@@ -2,6 +2,10 @@ import os
 import pandas as pd
 
 ROOT_DIR = os.path.dirname(os.path.realpath(__file__))
+# Downloads and USDA exports. Set RAW_DATA_DIR to run on other data, such as
+# the synthetic files written by synthetic.py
+RAW_DATA_DIR = os.environ.get("RAW_DATA_DIR",
+                              os.path.join(ROOT_DIR, "raw_data"))
 pd.set_option('display.width', 280)
 pd.set_option("display.max_rows", 200)
 
@@ -0,0 +1,119 @@
+import os
+import argparse
+import tarfile
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+
+from common import RAW_DATA_DIR, START_YEAR, END_YEAR
+from ghcnd import parse_dly, read_stations, ELEMENTS
+
+
+def dly_members(source):
+    """Yield (station ID, bytes) for every .dly file in a directory or in a
+    tarball such as ghcnd_all.tar.gz. Tarballs are read as a stream, one
+    member at a time, so nothing is extracted to disk."""
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            if name.endswith(".dly"):
+                with open(os.path.join(source, name), "rb") as dly_file:
+                    yield name[:-len(".dly")], dly_file.read()
+        return
+    with tarfile.open(source, mode="r|*") as tarball:
+        for member in tarball:
+            name = os.path.basename(member.name)
+            if member.isfile() and name.endswith(".dly"):
+                yield name[:-len(".dly")], tarball.extractfile(member).read()
+
+
+def station_coverage(station_id, data, start_year=START_YEAR,
+                     end_year=END_YEAR):
+    """Fraction of the days from start_year through end_year on which a
+    station has a usable measurement of each element, plus the first and
+    last year with any"""
+    columns = parse_dly(data, ELEMENTS, start_year, end_year)
+    n_days = (pd.Timestamp(str(end_year) + "-12-31") -
+              pd.Timestamp(str(start_year) + "-01-01")).days + 1
+    counts = np.bincount(columns["ELEMENT"], minlength=len(ELEMENTS))
+    coverage = {"ID" : station_id}
+    for element, count in zip(ELEMENTS, counts):
+        coverage[element] = count / float(n_days)
+    years = columns["YEAR"]
+    coverage["first_year"] = years.min() if len(years) else np.nan
+    coverage["last_year"] = years.max() if len(years) else np.nan
+
+    return coverage
+
+
+def _station_coverage(arguments):
+    "Process pool entry point for station_coverage"
+    return station_coverage(*arguments)
+
+
+def scan(source, workers=1, start_year=START_YEAR, end_year=END_YEAR):
+    """Coverage of every station in source, in a single pass. With workers > 1
+    the parsing happens in a process pool while the stream is read. Only a
+    couple of members per worker are held in memory at once."""
+    coverages = []
+    members = ((station_id, data, start_year, end_year)
+               for station_id, data in dly_members(source))
+    if workers <= 1:
+        coverages = [_station_coverage(member) for member in members]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            for member in members:
+                if len(pending) >= 2 * workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    coverages += [future.result() for future in done]
+                pending.add(executor.submit(_station_coverage, member))
+            coverages += [future.result() for future in pending]
+    coverage = pd.DataFrame(
+        coverages,
+        columns=["ID"] + list(ELEMENTS) + ["first_year", "last_year"])
+
+    return coverage.sort_values("ID").reset_index(drop=True)
+
+
+def rank_stations(coverage, stations=None):
+    """Rank stations by their worst covered element, joined with their
+    metadata from ghcnd-stations.txt if given. The region is the state or
+    province where there is one and the country code otherwise."""
+    candidates = coverage.copy()
+    candidates["coverage"] = candidates[list(ELEMENTS)].min(axis=1)
+    if stations is not None:
+        candidates = candidates.merge(
+            stations[["ID", "LATITUDE", "LONGITUDE", "ELEVATION", "STATE",
+                      "NAME"]],
+            on="ID", how="left")
+        candidates["region"] = candidates["STATE"].where(
+            candidates["STATE"].notnull(), candidates["ID"].str[:2])
+    else:
+        candidates["region"] = candidates["ID"].str[:2]
+    candidates = candidates.sort_values(["coverage", "ID"],
+                                        ascending=[False, True])
+    candidates["rank_in_region"] = candidates.groupby(
+        "region").cumcount() + 1
+
+    return candidates.reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Rank GHCN-Daily stations by PRCP/TMAX/TMIN coverage")
+    parser.add_argument("source",
+                        help="ghcnd_all.tar.gz or a directory of .dly files")
+    parser.add_argument("--stations",
+                        default=os.path.join(RAW_DATA_DIR,
+                                             "ghcnd-stations.txt"),
+                        help="ghcnd-stations.txt to join against")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="number of parsing processes")
+    parser.add_argument("--output", default="candidate_stations.csv")
+    args = parser.parse_args()
+    stations = (read_stations(args.stations)
+                if os.path.isfile(args.stations) else None)
+    candidates = rank_stations(scan(args.source, args.workers), stations)
+    candidates.to_csv(args.output, index=False)
+    print(candidates.head(50))
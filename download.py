@@ -0,0 +1,297 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import threading
+import http.client
+import email.utils
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+
+from common import RAW_DATA_DIR
+from cache import CACHE_DIR
+
+
+# Where station files come from. Point it at another server, e.g.
+# python -m http.server in a copy of raw_data, or at a local directory.
+BASE_URL = os.environ.get(
+    "GHCND_BASE_URL", "https://www1.ncdc.noaa.gov/pub/data/ghcn/daily/all/")
+
+
+class DownloadError(IOError):
+    """A station file couldn't be fetched. transient errors (server errors,
+    throttling, short reads) are worth retrying; the rest (404) aren't."""
+
+    def __init__(self, message, transient=True):
+        IOError.__init__(self, message)
+        self.transient = transient
+
+
+class Downloader:
+    """Fetch GHCN-Daily .dly files into a directory, many at a time.
+
+    Each worker thread keeps its own connection to the server open between
+    files. Files are streamed to a .part file and renamed into place once
+    complete, so a half written .dly is never seen. An interrupted .part is
+    resumed with a Range request (guarded by If-Range, so a file changed on
+    the server starts over), and with refresh, files already present are
+    only fetched again if the server says they changed (If-None-Match or
+    If-Modified-Since). The validators are kept under cache_dir. Errors are
+    retried with exponential backoff, and every station gets a result
+    rather than the first failure ending the run. Redirects are followed,
+    to other servers too, up to max_redirects of them.
+
+    base_url may also be a local directory (or file:// URL) to mirror."""
+
+    # Redirects followed for one file before giving up on it
+    max_redirects = 5
+
+
+    def __init__(self, directory=RAW_DATA_DIR, base_url=BASE_URL, workers=8,
+                 retries=4, backoff=0.5, timeout=60, cache_dir=CACHE_DIR,
+                 block_size=1 << 16):
+        self.directory = directory
+        self.base_url = base_url if base_url.endswith("/") else base_url + "/"
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache_dir = cache_dir
+        self.block_size = block_size
+        url = urllib.parse.urlsplit(self.base_url)
+        self.scheme = url.scheme or "file"
+        self.host = url.netloc
+        self.base_path = url.path
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+
+    def connection(self, scheme=None, host=None):
+        """This thread's connection to a server, the base URL's by default,
+        opened on first use"""
+        scheme = scheme or self.scheme
+        host = host or self.host
+        connections = getattr(self.local, "connections", None)
+        if connections is None:
+            connections = self.local.connections = dict()
+        connection = connections.get((scheme, host))
+        if connection is None:
+            if scheme == "https":
+                connection = http.client.HTTPSConnection(
+                    host, timeout=self.timeout)
+            else:
+                connection = http.client.HTTPConnection(
+                    host, timeout=self.timeout)
+            connections[scheme, host] = connection
+            with self.lock:
+                self.connections.append(connection)
+        return connection
+
+
+    def reset_connection(self):
+        "Drop this thread's connections after an error, to reconnect next time"
+        for connection in getattr(self.local, "connections", {}).values():
+            connection.close()
+        self.local.connections = dict()
+
+
+    def get(self, path, headers):
+        """GET path from the server, following up to max_redirects
+        redirects, which may lead to other servers. Returns the final
+        response."""
+        url = urllib.parse.urlunsplit((self.scheme, self.host, path, "", ""))
+        for hop in range(self.max_redirects + 1):
+            target = urllib.parse.urlsplit(url)
+            connection = self.connection(target.scheme, target.netloc)
+            connection.request(
+                "GET", target.path + ("?" + target.query if target.query
+                                      else ""),
+                headers=headers)
+            response = connection.getresponse()
+            if response.status not in (301, 302, 303, 307, 308):
+                return response
+            response.read()
+            location = response.getheader("Location")
+            if not location:
+                raise DownloadError("HTTP %d without a Location for %s" %
+                                    (response.status, path), transient=False)
+            url = urllib.parse.urljoin(url, location)
+        raise DownloadError("More than %d redirects for %s" %
+                            (self.max_redirects, path), transient=False)
+
+
+    def close(self):
+        "Close every thread's connection"
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+
+
+    def validators_path(self, station_id):
+        return os.path.join(self.cache_dir, "download", station_id + ".json")
+
+
+    def load_validators(self, station_id):
+        "The ETag and Last-Modified the server last sent for a station"
+        if self.cache_dir is None:
+            return {}
+        try:
+            with open(self.validators_path(station_id)) as validators_file:
+                return json.load(validators_file)
+        except (IOError, ValueError):
+            return {}
+
+
+    def save_validators(self, station_id, response):
+        validators = {"etag" : response.getheader("ETag"),
+                      "last_modified" : response.getheader("Last-Modified")}
+        if self.cache_dir is None or not any(validators.values()):
+            return
+        path = self.validators_path(station_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as validators_file:
+            json.dump(validators, validators_file)
+        os.replace(path + ".tmp", path)
+
+
+    def fetch(self, station_id, refresh=False):
+        """Make sure station_id.dly is in directory. Returns a dict of
+        station_id, status ("present", "downloaded", "resumed", "unchanged"
+        or "failed"), bytes transferred, attempts and the last error."""
+        path = os.path.join(self.directory, station_id + ".dly")
+        result = {"station_id" : station_id, "status" : "present",
+                  "bytes" : 0, "attempts" : 0, "error" : None}
+        if os.path.isfile(path) and not refresh:
+            return result
+        for attempt in range(self.retries + 1):
+            result["attempts"] = attempt + 1
+            try:
+                if self.scheme == "file":
+                    result["status"], result["bytes"] = self.copy_once(
+                        station_id, path)
+                else:
+                    result["status"], result["bytes"] = self.fetch_once(
+                        station_id, path)
+                result["error"] = None
+                return result
+            except (IOError, http.client.HTTPException) as error:
+                self.reset_connection()
+                result["error"] = str(error)
+                if not getattr(error, "transient", True):
+                    break
+                if attempt < self.retries:
+                    time.sleep(self.backoff * 2**attempt)
+        result["status"] = "failed"
+
+        return result
+
+
+    def fetch_once(self, station_id, path):
+        "One attempt at fetch over HTTP, returning (status, bytes)"
+        part = path + ".part"
+        validators = self.load_validators(station_id)
+        validator = validators.get("etag") or validators.get("last_modified")
+        # Resuming is only safe if the server can tell us the file changed
+        offset = (os.path.getsize(part)
+                  if os.path.isfile(part) and validator else 0)
+        headers = {}
+        if offset:
+            headers["Range"] = "bytes=%d-" % offset
+            headers["If-Range"] = validator
+        elif os.path.isfile(path):
+            if validators.get("etag"):
+                headers["If-None-Match"] = validators["etag"]
+            headers["If-Modified-Since"] = (
+                validators.get("last_modified") or
+                email.utils.formatdate(os.path.getmtime(path), usegmt=True))
+        response = self.get(self.base_path + station_id + ".dly", headers)
+        if response.status == 304:
+            response.read()
+            return "unchanged", 0
+        if response.status not in (200, 206):
+            response.read()
+            if os.path.isfile(part) and response.status == 416:
+                os.remove(part)
+            raise DownloadError(
+                "HTTP %d fetching %s" % (response.status, station_id),
+                transient=(response.status >= 500 or
+                           response.status in (408, 416, 429)))
+        resumed = response.status == 206
+        if resumed and not (response.getheader("Content-Range", "")
+                            .startswith("bytes %d-" % offset)):
+            response.read()
+            os.remove(part)
+            raise DownloadError("Unexpected Content-Range for " + station_id)
+        self.save_validators(station_id, response)
+        length = response.getheader("Content-Length")
+        written = 0
+        with open(part, "ab" if resumed else "wb") as part_file:
+            for block in iter(lambda: response.read(self.block_size), b""):
+                part_file.write(block)
+                written += len(block)
+        if length is not None and written != int(length):
+            # Keep what arrived for the next attempt to resume from
+            raise DownloadError("Short read of %s: %d of %s bytes" %
+                                (station_id, written, length))
+        os.replace(part, path)
+        last_modified = response.getheader("Last-Modified")
+        if last_modified:
+            mtime = email.utils.parsedate_to_datetime(
+                last_modified).timestamp()
+            os.utime(path, (mtime, mtime))
+
+        return ("resumed" if resumed else "downloaded"), written
+
+
+    def copy_once(self, station_id, path):
+        "One attempt at fetch from a local mirror, returning (status, bytes)"
+        source = os.path.join(urllib.parse.unquote(self.base_path),
+                              station_id + ".dly")
+        if not os.path.isfile(source):
+            raise DownloadError("No " + source, transient=False)
+        stat = os.stat(source)
+        if (os.path.isfile(path) and os.path.getsize(path) == stat.st_size
+                and os.path.getmtime(path) >= stat.st_mtime):
+            return "unchanged", 0
+        part = path + ".part"
+        shutil.copyfile(source, part)
+        os.replace(part, path)
+        os.utime(path, (stat.st_atime, stat.st_mtime))
+
+        return "downloaded", stat.st_size
+
+
+    def fetch_all(self, station_ids, refresh=False):
+        """fetch every station, workers at a time, returning the results in
+        station order"""
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                return list(executor.map(
+                    lambda station_id: self.fetch(station_id, refresh),
+                    station_ids))
+        finally:
+            self.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Download GHCN-Daily station files into raw_data")
+    parser.add_argument("station_ids", nargs="+")
+    parser.add_argument("--directory", default=RAW_DATA_DIR)
+    parser.add_argument("--base-url", default=BASE_URL)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--refresh", action="store_true",
+                        help="check files already present for updates")
+    args = parser.parse_args()
+    downloader = Downloader(args.directory, args.base_url, args.workers)
+    failed = 0
+    for result in downloader.fetch_all(args.station_ids, args.refresh):
+        print("%(station_id)s %(status)s %(bytes)d bytes" % result +
+              ("" if result["error"] is None else " (" + result["error"] + ")"))
+        failed += result["status"] == "failed"
+    raise SystemExit(1 if failed else 0)
@@ -0,0 +1,204 @@
+import os
+import json
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+
+
+from cache import replace_directory
+
+
+# Bump whenever the layout on disk changes
+FEATURES_VERSION = 1
+
+
+def column_months(columns):
+    """Month number of each munge column (TMAXavg_USW00023271_month7 is 7),
+    the last month for whole season columns (HEATdays_USW00023271_month2to11
+    is 11), and 0 for columns that aren't tied to a month, like year"""
+    return np.array([int(column.rsplit("_month", 1)[1].split("to")[-1])
+                     if "_month" in column else 0
+                     for column in columns])
+
+
+def column_schema(column):
+    """(statistic, station, period) of a munge column name, e.g. ("TMAXavg",
+    "USW00023271", "month7") or ("TMAXavg", "USW00023271", "dekad2_month7")
+    for windows.aggregate's. Names without a station, like year, are all
+    statistic."""
+    parts = column.split("_", 2)
+    if len(parts) < 3:
+        return column, None, None
+    return tuple(parts)
+
+
+class FeatureMatrix:
+    """munge's output as a years x features array of float64 or float32,
+    stored column by column (Fortran order) in a .npy file, so that any
+    column, and any run of consecutive columns, is contiguous in the file.
+    Loading maps the file rather than parsing it, and selecting features
+    only reads theirs.
+
+    Each column's schema, its statistic (TMAXavg, HEATdays...), station,
+    period and month (as column_months), is saved alongside, along with
+    which columns held integers, so they can be picked without parsing
+    names and written back out as they were."""
+
+    # The per column schema, as saved
+    schema_fields = ["statistics", "stations", "periods", "months"]
+
+
+    def __init__(self, values, years, columns, integers=None, schema=None):
+        """schema is a dict of schema_fields lists, taken from the column
+        names if None"""
+        self.values = values
+        # Set for matrices living in a memory-mapped file
+        self.path = None
+        self.years = np.asarray(years, dtype=np.int64)
+        self.columns = list(columns)
+        if schema is None:
+            parsed = [column_schema(column) for column in self.columns]
+            schema = {"statistics" : [fields[0] for fields in parsed],
+                      "stations" : [fields[1] for fields in parsed],
+                      "periods" : [fields[2] for fields in parsed],
+                      "months" : column_months(self.columns)}
+        self.statistics = np.array(schema["statistics"], dtype=object)
+        self.stations = np.array(schema["stations"], dtype=object)
+        self.periods = np.array(schema["periods"], dtype=object)
+        self.months = np.array(schema["months"], dtype=np.int64)
+        if integers is None:
+            integers = np.zeros(len(self.columns), dtype=bool)
+        self.integers = np.asarray(integers, dtype=bool)
+        assert values.shape == (len(self.years), len(self.columns))
+
+
+    @classmethod
+    def from_frame(cls, frame, dtype=np.float64):
+        """From a DataFrame indexed by year, like munge returns. Columns of
+        integers are remembered as such."""
+        integers = [dtype.kind in "iu" for dtype in frame.dtypes]
+        values = np.asfortranarray(frame.values, dtype=dtype)
+
+        return cls(values, frame.index.values, frame.columns, integers)
+
+
+    @classmethod
+    def read(cls, path, mmap_mode="r"):
+        "load a saved matrix, or a weather.csv style file if path ends in .csv"
+        if path.endswith(".csv"):
+            return cls.from_frame(pd.read_csv(path, index_col="year"))
+        return cls.load(path, mmap_mode)
+
+
+    def to_frame(self, integers=False):
+        """A DataFrame indexed by year. Its one block of floats shares the
+        matrix's memory. With integers, the integer columns are converted
+        back, which copies them."""
+        frame = pd.DataFrame(self.values, columns=self.columns,
+                             index=pd.Index(self.years, name="year"),
+                             copy=False)
+        if integers and self.integers.any():
+            frame = frame.astype({column : np.int64 for column, integer
+                                  in zip(self.columns, self.integers)
+                                  if integer})
+
+        return frame
+
+
+    def to_csv(self, path):
+        "Export for inspection, in munge's original weather.csv format"
+        self.to_frame(integers=True).to_csv(path)
+
+
+    def column_indexes(self, stations=None, months=None, statistics=None):
+        """Positions of the columns of the given stations, months and
+        statistics (every one if None), in order"""
+        keep = np.ones(len(self.columns), dtype=bool)
+        for names, values in [(stations, self.stations),
+                              (months, self.months),
+                              (statistics, self.statistics)]:
+            if names is not None:
+                keep &= np.isin(values, list(names))
+
+        return np.flatnonzero(keep)
+
+
+    def select(self, stations=None, months=None, statistics=None):
+        """The matrix of just the given stations, months and statistics. A
+        contiguous run of columns, such as one station's monthly statistics,
+        is a view; otherwise only the selected columns are read and
+        copied."""
+        indexes = self.column_indexes(stations, months, statistics)
+        contiguous = len(indexes) > 0 and np.all(np.diff(indexes) == 1)
+        if contiguous:
+            values = self.values[:, indexes[0]:indexes[-1] + 1]
+        else:
+            values = np.asarray(self.values[:, indexes])
+        matrix = type(self)(
+            values, self.years, [self.columns[i] for i in indexes],
+            self.integers[indexes],
+            {field : getattr(self, field)[indexes]
+             for field in self.schema_fields})
+        if contiguous:
+            matrix.path = self.path
+
+        return matrix
+
+
+    def write_metadata(self, path):
+        with open(os.path.join(path, "features.json"), "w") as metadata_file:
+            metadata = {field : getattr(self, field).tolist()
+                        for field in self.schema_fields}
+            json.dump(dict(metadata, version=FEATURES_VERSION,
+                           dtype=self.values.dtype.name,
+                           columns=self.columns,
+                           integers=self.integers.tolist()),
+                      metadata_file)
+
+
+    def save(self, path):
+        """Write to a directory that load can memory-map. It is written in
+        full beside path and renamed into place (see
+        cache.replace_directory), so readers never see half a matrix."""
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        scratch = tempfile.mkdtemp(dir=parent)
+        np.save(os.path.join(scratch, "values.npy"),
+                np.asfortranarray(self.values))
+        np.save(os.path.join(scratch, "years.npy"), self.years)
+        self.write_metadata(scratch)
+        replace_directory(scratch, path)
+
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """Open a saved matrix. The default read-only memory map costs no
+        parsing, and lets any number of processes share one copy of the
+        pages."""
+        with open(os.path.join(path, "features.json")) as metadata_file:
+            metadata = json.load(metadata_file)
+        if metadata.get("version") != FEATURES_VERSION:
+            raise ValueError(path + " is from another version of munge; "
+                             "munge again")
+        values = np.load(os.path.join(path, "values.npy"), mmap_mode=mmap_mode)
+        matrix = cls(values, np.load(os.path.join(path, "years.npy")),
+                     metadata["columns"], metadata["integers"],
+                     {field : metadata[field] for field in cls.schema_fields})
+        if mmap_mode is not None:
+            matrix.path = path
+
+        return matrix
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export a feature matrix written by munge to csv")
+    parser.add_argument("features", nargs="?", default="weather.features")
+    parser.add_argument("csv", nargs="?", default="weather.csv")
+    parser.add_argument("--stations", nargs="+")
+    parser.add_argument("--months", nargs="+", type=int)
+    parser.add_argument("--statistics", nargs="+")
+    args = parser.parse_args()
+    FeatureMatrix.load(args.features).select(
+        args.stations, args.months, args.statistics).to_csv(args.csv)
@@ -0,0 +1,132 @@
+import numpy as np
+import pandas as pd
+
+
+from common import START_YEAR, END_YEAR
+
+
+# Each line of a .dly file is a fixed width record of 269 bytes: ID, YEAR,
+# MONTH and ELEMENT, then 31 days of (VALUE, MFLAG, QFLAG, SFLAG).
+RECORD_LENGTH = 269
+DAY_OFFSET = 21
+DAY_WIDTH = 8
+ELEMENTS = ("TMAX", "TMIN", "PRCP")
+MISSING_VALUE = -9999
+# Bump whenever parse_dly changes what it keeps, to invalidate cached parses
+DLY_FILTER_VERSION = 1
+
+
+def _records(data):
+    """View the bytes of a .dly file as an (n_lines, 269) uint8 array."""
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    line_length = RECORD_LENGTH + 1
+    if (len(buffer) % line_length == 0 and
+            np.all(buffer[RECORD_LENGTH::line_length] == ord("\n"))):
+        # The usual case: no copy needed
+        return buffer.reshape(-1, line_length)[:, :RECORD_LENGTH]
+    # Odd line endings or a missing final newline. Pad every line out.
+    lines = [line.ljust(RECORD_LENGTH)[:RECORD_LENGTH]
+             for line in data.splitlines() if line]
+    return np.frombuffer(b"".join(lines), dtype=np.uint8).reshape(
+        -1, RECORD_LENGTH)
+
+
+def _parse_integers(fields):
+    """Decode right justified, possibly negative ASCII integers along the last
+    axis of a uint8 array without building any strings."""
+    digits = fields.astype(np.int64) - ord("0")
+    is_digit = (digits >= 0) & (digits <= 9)
+    values = np.zeros(fields.shape[:-1], dtype=np.int64)
+    for k in range(fields.shape[-1]):
+        values = np.where(is_digit[..., k],
+                          values * 10 + digits[..., k],
+                          values)
+    negative = np.any(fields == ord("-"), axis=-1)
+    values[negative] *= -1
+    return values
+
+
+def parse_dly(data, elements=ELEMENTS, start_year=START_YEAR,
+              end_year=END_YEAR):
+    """Parse the raw bytes of a .dly file into columns of daily measurements.
+
+    Rows are filtered on element and year while still bytes, and days with a
+    missing value, a quality flag or an "S" source flag are dropped. Returns
+    a dict of numpy arrays: "index" (line number in the file), "DAY",
+    "YEAR", "MONTH", "VALUE", "ELEMENT" (codes into elements) and "ID"
+    (codes into "ID_NAMES")."""
+    records = _records(data)
+    element_fields = records[:, 17:21]
+    element_codes = np.full(len(records), -1, dtype=np.int8)
+    for code, element in enumerate(elements):
+        pattern = np.frombuffer(element.encode("ascii"), dtype=np.uint8)
+        element_codes[np.all(element_fields == pattern, axis=1)] = code
+    years = _parse_integers(records[:, 11:15])
+    keep = ((element_codes >= 0) &
+            (years >= start_year) & (years <= end_year))
+    rows = np.flatnonzero(keep)
+    kept = records[rows]
+    days = kept[:, DAY_OFFSET:DAY_OFFSET + 31 * DAY_WIDTH].reshape(
+        -1, 31, DAY_WIDTH)
+    # Day major order, the same order wide_to_long produces
+    days = days.transpose(1, 0, 2)
+    values = _parse_integers(days[:, :, 0:5])
+    good = ((values != MISSING_VALUE) &
+            (days[:, :, 6] == ord(" ")) &
+            (days[:, :, 7] != ord("S")))
+    day_numbers = np.broadcast_to(
+        np.arange(1, 32, dtype=np.int64)[:, np.newaxis], good.shape)
+    line_numbers = np.broadcast_to(rows[np.newaxis, :], good.shape)
+    # Only the handful of distinct station IDs ever become strings
+    id_names, id_codes = np.unique(
+        np.ascontiguousarray(kept[:, 0:11]).view("S11").ravel(),
+        return_inverse=True)
+    def per_row(column):
+        return np.broadcast_to(column[np.newaxis, :], good.shape)[good]
+
+    return {
+        "index": line_numbers[good].astype(np.int64),
+        "DAY": day_numbers[good],
+        "YEAR": per_row(years[rows]),
+        "MONTH": per_row(_parse_integers(kept[:, 15:17])),
+        "VALUE": values[good],
+        "ELEMENT": per_row(element_codes[rows]),
+        "ID": per_row(id_codes.astype(np.int32)),
+        "ID_NAMES": id_names.astype(str)}
+
+
+def read_dly(dly_path, elements=ELEMENTS, start_year=START_YEAR,
+             end_year=END_YEAR):
+    """Read a .dly file with parse_dly."""
+    with open(dly_path, "rb") as dly_file:
+        data = dly_file.read()
+    return parse_dly(data, elements, start_year, end_year)
+
+
+def columns_to_frame(columns, elements=ELEMENTS):
+    """Build the long daily DataFrame (one row per station, day and element)
+    from the columns returned by parse_dly."""
+    element_names = np.array(elements, dtype=object)
+    id_names = np.array(list(columns["ID_NAMES"]), dtype=object)
+    measurements = pd.DataFrame(
+        {"DAY": columns["DAY"],
+         "ID": id_names[columns["ID"]],
+         "ELEMENT": element_names[columns["ELEMENT"]],
+         "YEAR": columns["YEAR"],
+         "MONTH": columns["MONTH"],
+         "VALUE": columns["VALUE"]},
+        index=pd.Index(columns["index"], name="dly_file_index"),
+        columns=["DAY", "ID", "ELEMENT", "YEAR", "MONTH", "VALUE"])
+
+    return measurements
+
+
+def read_stations(stations_path):
+    "Station metadata from ghcnd-stations.txt"
+    stations = pd.read_fwf(
+        stations_path,
+        header=None,
+        names=[     "ID", "LATITUDE", "LONGITUDE", "ELEVATION", "STATE", "NAME", "GSN FLAG", "HCN/CRN FLAG", "WMO ID"],
+        colspecs=[(0,11),    (12,20),     (21,30),     (31,37), (38,40), (41,71),   (72,75),        (76,79), (80,85)])
+
+    return stations
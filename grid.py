@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+
+from store import MeasurementStore
+
+
+def unit_vectors(latitudes, longitudes):
+    """Points on the unit sphere, so that straight-line distances order like
+    great circle distances"""
+    latitudes = np.radians(np.asarray(latitudes, dtype=np.float64))
+    longitudes = np.radians(np.asarray(longitudes, dtype=np.float64))
+
+    return np.column_stack([np.cos(latitudes) * np.cos(longitudes),
+                            np.cos(latitudes) * np.sin(longitudes),
+                            np.sin(latitudes)])
+
+
+def cell_name(latitude, longitude):
+    "Grid cells are named after their centres, like GRID+41.0-093.0"
+    return "GRID%+05.1f%+06.1f" % (latitude, longitude)
+
+
+def assign_cells(latitudes, longitudes, cell_degrees=2.0):
+    """Put every station in the grid cell with the nearest centre, found with
+    a KD-tree over the centres of every cell in the stations' bounding box.
+    Returns each station's cell number and a DataFrame of the occupied
+    cells' names and centres."""
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    def centres(coordinates):
+        low = np.floor(coordinates.min() / cell_degrees) * cell_degrees
+        high = np.floor(coordinates.max() / cell_degrees) * cell_degrees
+        return (np.arange(low, high + cell_degrees / 2, cell_degrees) +
+                cell_degrees / 2)
+    centre_latitudes, centre_longitudes = np.meshgrid(
+        centres(latitudes), centres(longitudes), indexing="ij")
+    centre_latitudes = centre_latitudes.ravel()
+    centre_longitudes = centre_longitudes.ravel()
+    tree = cKDTree(unit_vectors(centre_latitudes, centre_longitudes))
+    distances, nearest = tree.query(unit_vectors(latitudes, longitudes))
+    occupied, cells = np.unique(nearest, return_inverse=True)
+    cell_table = pd.DataFrame(
+        {"ID" : [cell_name(latitude, longitude) for latitude, longitude
+                 in zip(centre_latitudes[occupied],
+                        centre_longitudes[occupied])],
+         "LATITUDE" : centre_latitudes[occupied],
+         "LONGITUDE" : centre_longitudes[occupied],
+         "stations" : np.bincount(cells)},
+        columns=["ID", "LATITUDE", "LONGITUDE", "stations"])
+
+    return cells, cell_table
+
+
+def grid_store(store, stations, cell_degrees=2.0, weights=None, path=None,
+               chunk_days=4096):
+    """Average the stations of a MeasurementStore over grid cells, returning a
+    MeasurementStore with one "station" per occupied cell.
+
+    stations is station metadata with ID, LATITUDE and LONGITUDE columns
+    (see ghcnd.read_stations), and weights an optional weight per station
+    of the store, equal by default. Each cell-day is the weighted mean of
+    the stations measuring that day, or NaN if none did. The work is a
+    sparse cells x stations matrix product over blocks of chunk_days days,
+    so memory stays bounded however many stations there are."""
+    coordinates = stations.set_index("ID").loc[
+        store.station_ids, ["LATITUDE", "LONGITUDE"]]
+    cells, cell_table = assign_cells(coordinates["LATITUDE"].values,
+                                     coordinates["LONGITUDE"].values,
+                                     cell_degrees)
+    if weights is None:
+        weights = np.ones(len(store.station_ids))
+    W = sparse.csr_matrix(
+        (np.asarray(weights, dtype=np.float64),
+         (cells, np.arange(len(store.station_ids)))),
+        shape=(len(cell_table), len(store.station_ids)))
+    gridded = MeasurementStore.empty(cell_table["ID"].tolist(),
+                                     store.start_year, store.end_year,
+                                     store.elements, path)
+    n_days = store.values.shape[1]
+    for start in range(0, n_days, chunk_days):
+        block = np.asarray(store.values[:, start:start+chunk_days, :],
+                           dtype=np.float64)
+        shape = block.shape
+        block = block.reshape(shape[0], -1)
+        present = ~np.isnan(block)
+        totals = W.dot(np.where(present, block, 0.0))
+        counts = W.dot(present.astype(np.float64))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = np.where(counts > 0, totals / counts, np.nan)
+        gridded.values[:, start:start+chunk_days, :] = means.reshape(
+            (len(cell_table),) + shape[1:])
+    if path is not None:
+        gridded.values.flush()
+    gridded.cells = cell_table
+
+    return gridded
@@ -1,9 +1,14 @@
 import os
+import argparse
 import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 
 
-from common import ROOT_DIR, START_YEAR
+from common import RAW_DATA_DIR, START_YEAR
+from cache import (CACHE_DIR, digest, file_digest, file_fingerprint, is_fresh,
+                   load_metadata, load_columns, save_columns, memoize_columns)
+from instrument import stage, start_run, RUN_REPORT, PROFILE
 
 
 class USDAIndemnitiesMunger:
@@ -13,6 +18,9 @@ class USDAIndemnitiesMunger:
 
     Accuracy seems poor, but this class makes the data available at least"""
 
+    # Where the report files and the price and acreage exports are
+    raw_data_dir = RAW_DATA_DIR
+
     # Pruned version of the complete list of given causes
     default_causes = [
         #'Excess Moisture/Precip/Rain',
@@ -102,73 +110,196 @@ class USDAIndemnitiesMunger:
             }[year]
 
 
+    # The columns munge uses and the types to read them as. Everything else
+    # in the reports (codes, "Determined Acres") is skipped while parsing.
+    report_dtypes = {
+        "Commodity Year" : np.int16,
+        "Location State Abbreviation" : np.object_,
+        "Location County Name" : np.object_,
+        "Commodity Name" : np.object_,
+        "Insurance Plan Abbreviation" : np.object_,
+        "Damage Cause Description" : np.object_,
+        "Indemnity Amount" : np.float64}
+    # Stripped and stored as categories once read
+    report_strings = ["Location State Abbreviation",
+                      "Location County Name",
+                      "Insurance Plan Abbreviation",
+                      "Damage Cause Description"]
+    # Bump whenever get_report changes what it keeps, to invalidate the cache
+    report_version = 1
+    # Bump whenever get_cached_totals changes what it sums
+    totals_version = 1
+    # The report files by year_to_fname: 1948-88 are all in one
+    report_years = [1988] + list(range(1989, 2017+1))
+
+
+    @staticmethod
+    def report_names(year):
+        """Column names of a report, which gained "Determined Acres" in
+        2001"""
+        return (["Commodity Year",
+                 "Location State Code",
+                 "Location State Abbreviation",
+                 "Location County Code",
+                 "Location County Name",
+                 "Commodity Code",
+                 "Commodity Name",
+                 "Insurance Plan Code",
+                 "Insurance Plan Abbreviation",
+                 "Stage Code",
+                 "Damage Cause Code",
+                 "Damage Cause Description"] +
+                ([] if year < 2001 else ["Determined Acres"]) +
+                ["Indemnity Amount",
+                 "(empty)"])
+
+
     @classmethod
-    def get_report(cls, year):
+    def get_report(cls, year, commodity="CORN", chunksize=100000):
+        """The records of one commodity in one of USDA's report files, with
+        the columns of report_dtypes and names stripped. The file is read in
+        chunks, each filtered on commodity before the next is read, so only
+        that commodity's rows are ever held in memory."""
         fname = cls.year_to_fname(year)
-        report = pd.read_csv(
-            os.path.join(ROOT_DIR, "raw_data", fname),
+        chunks = pd.read_csv(
+            os.path.join(cls.raw_data_dir, fname),
             sep="|",
-            names = (["Commodity Year",
-                     "Location State Code",
-                     "Location State Abbreviation",
-                     "Location County Code",
-                     "Location County Name",
-                     "Commodity Code",
-                     "Commodity Name",
-                     "Insurance Plan Code",
-                     "Insurance Plan Abbreviation",
-                     "Stage Code",
-                     "Damage Cause Code",
-                     "Damage Cause Description"] +
-                     ([] if year < 2001 else ["Determined Acres"]) +
-                     ["Indemnity Amount",
-                      "(empty)"]),
-                header=None,
-                dtype={"Indemnity Amount" : np.float64,
-                       "Insurance Plan Abbreviation" : np.object_})
-        report = report.drop(
-            ["Location County Code",
-             "Location State Code",
-             "Commodity Code",
-             "Insurance Plan Code",
-             "Stage Code",
-             "Damage Cause Code",
-             "(empty)"],
-            axis=1)
-        
+            names=cls.report_names(year),
+            usecols=list(cls.report_dtypes),
+            dtype=cls.report_dtypes,
+            header=None,
+            chunksize=chunksize)
+        report = pd.concat(
+            [chunk[chunk["Commodity Name"].str.strip() == commodity]
+             for chunk in chunks],
+            ignore_index=True)
+        report = report.drop("Commodity Name", axis=1)
+        for column in cls.report_strings:
+            report[column] = report[column].str.strip()
+
         return report
 
 
     @classmethod
-    def munge(cls, correction_term_damage_causes=default_causes):
-        """Read indemnities from USDA data to estimate a non-weather related 
-        loss correction tern to Nielsen model before calculating departure from 
-        trend. The data starts in 1948."""
-        reports = pd.DataFrame()
-        for year in range(1988, 2017+1): # 1948-88 all in one file
-            report = cls.get_report(year)
-            reports = reports.append(report)
-        reports = reports.drop("Determined Acres", axis=1)
-        reports["Commodity Year"] = reports["Commodity Year"].astype(
-            np.int64)
-        reports["Commodity Name"] = reports[
-            "Commodity Name"].str.strip()
-        reports = reports[
-            reports["Commodity Name"] == "CORN"]
-        reports["Damage Cause Description"] = reports[
-            "Damage Cause Description"].str.strip()
-        reports["Insurance Plan Abbreviation"] = reports[
-            "Insurance Plan Abbreviation"].str.strip()
-        reports["Location County Name"] = reports[
-            "Location County Name"].str.strip()
-        reports["Location State Abbreviation"] = reports[
-            "Location State Abbreviation"].str.strip()
-        reports = reports[
-            reports["Damage Cause Description"].isin(
-            correction_term_damage_causes)]
-        # Compute avg lost bushels per acre
+    def get_cached_report(cls, year, commodity="CORN", cache_dir=CACHE_DIR):
+        """get_report, cached under cache_dir as one column per file (names as
+        category codes), checked against the report file itself"""
+        if cache_dir is None:
+            return cls.get_report(year, commodity)
+        fname = cls.year_to_fname(year)
+        path = os.path.join(cls.raw_data_dir, fname)
+        settings = digest("indemnities", cls.report_version, commodity,
+                          cls.report_names(year))
+        cache_path = os.path.join(cache_dir, "indemnities",
+                                  fname + "-" + settings[:16])
+        metadata = load_metadata(cache_path)
+        if metadata is not None and is_fresh(path, metadata, cache_path):
+            columns = load_columns(cache_path)
+            report = pd.DataFrame(
+                {"Commodity Year" : columns["year"],
+                 "Indemnity Amount" : columns["amount"]})
+            for i, column in enumerate(cls.report_strings):
+                report[column] = pd.Categorical.from_codes(
+                    columns["codes" + str(i)],
+                    columns["names" + str(i)].astype(object))
+            return report[[column for column in cls.report_dtypes
+                           if column in report.columns]]
+        report = cls.get_report(year, commodity)
+        columns = {"year" : report["Commodity Year"].values,
+                   "amount" : report["Indemnity Amount"].values}
+        for i, column in enumerate(cls.report_strings):
+            categories = report[column].astype("category").cat
+            columns["codes" + str(i)] = categories.codes.values
+            columns["names" + str(i)] = categories.categories.values.astype(
+                str)
+        metadata = file_fingerprint(path)
+        metadata["sha1"] = file_digest(path)
+        save_columns(cache_path, columns, metadata)
+
+        return report
+
+
+    @classmethod
+    def get_reports(cls, commodity="CORN", workers=1, cache_dir=CACHE_DIR):
+        """The records of one commodity from every report file, 1948 on, in a
+        single DataFrame with categorical names. With workers > 1 the files
+        are read in a process pool."""
+        arguments = [(cls, year, commodity, cache_dir)
+                     for year in cls.report_years]
+        with stage("parse") as counts:
+            if workers > 1:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    reports = list(executor.map(_get_cached_report,
+                                                arguments))
+            else:
+                reports = [_get_cached_report(argument)
+                           for argument in arguments]
+            counts["rows"] = sum(len(report) for report in reports)
+        with stage("reshape") as counts:
+            reports = pd.concat(reports, ignore_index=True)
+            for column in cls.report_strings:
+                reports[column] = reports[column].astype("category")
+            counts["rows"] = len(reports)
+
+        return reports
+
+
+    @classmethod
+    def get_cached_totals(cls, year, causes=None, commodity="CORN",
+                          cache_dir=CACHE_DIR):
+        """Total indemnities by year over the given damage causes (all if None)
+        of one report file, as a Series. Cached under cache_dir and checked
+        against the report file, so a new or revised file is the only one
+        read again."""
+        def compute():
+            report = cls.get_cached_report(year, commodity, cache_dir)
+            if len(report) == 0:
+                return {"year" : np.zeros(0, dtype=np.int64),
+                        "total" : np.zeros(0)}
+            totals = IndemnityStore(report).totals_by_year(causes)
+            return {"year" : totals.index.values, "total" : totals.values}
+        if cache_dir is None:
+            columns = compute()
+        else:
+            fname = cls.year_to_fname(year)
+            settings = digest("totals", cls.totals_version, cls.report_version,
+                              commodity, cls.report_names(year),
+                              None if causes is None else sorted(causes))
+            columns = memoize_columns(
+                os.path.join(cache_dir, "totals", fname + "-" + settings[:16]),
+                settings, compute, [os.path.join(cls.raw_data_dir, fname)])[0]
+
+        return pd.Series(columns["total"],
+                         index=pd.Index(columns["year"], name="Year"),
+                         name="total_indemnities")
+
+
+    @classmethod
+    def get_totals(cls, causes=None, commodity="CORN", workers=1,
+                   cache_dir=CACHE_DIR):
+        """Total indemnities by year over the given damage causes, from every
+        report file's get_cached_totals. With workers > 1 the files are
+        totalled in a process pool."""
+        arguments = [(cls, year, causes, commodity, cache_dir)
+                     for year in cls.report_years]
+        with stage("aggregate") as counts:
+            if workers > 1:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    totals = list(executor.map(_get_cached_totals, arguments))
+            else:
+                totals = [_get_cached_totals(argument)
+                          for argument in arguments]
+            totals = pd.concat(totals).groupby(level=0).sum()
+            counts["rows"] = len(totals)
+
+        return totals
+
+
+    @classmethod
+    def get_prices_and_acres(cls):
+        """Marketing year price per bushel and acres planted, by year"""
         per_bushel_prices = pd.read_csv(
-            os.path.join(ROOT_DIR, "raw_data",
+            os.path.join(cls.raw_data_dir,
                          "FDE80B2D-1155-391B-B0D9-2ECC1E988562.csv"),
             dtype={"Year" : np.int64, "Value" : np.float64})
         per_bushel_prices = per_bushel_prices[
@@ -180,7 +311,7 @@ class USDAIndemnitiesMunger:
             per_bushel_prices["Year"])
         per_bushel_prices.sort_index()
         acres_planted = pd.read_csv(
-            os.path.join(ROOT_DIR, "raw_data",
+            os.path.join(cls.raw_data_dir,
                          "0BA4DA4C-05B8-3321-B35B-C145F4AA2925.csv"),
             dtype={"Year" : np.int64})
         acres_planted["Value"] = acres_planted["Value"].apply(
@@ -192,13 +323,25 @@ class USDAIndemnitiesMunger:
         acres_planted = acres_planted.set_index(
             acres_planted["Year"])
         acres_planted.sort_index()
-        indemnities = per_bushel_prices.merge(acres_planted, on="Year")
-        def total_indemnities(year):
-            return reports[reports["Commodity Year"] == year][
-                "Indemnity Amount"].sum()
-        indemnities["total_indemnities"] = indemnities["Year"]
-        indemnities["total_indemnities"] = indemnities[
-            "total_indemnities"].apply(total_indemnities)
+        # Merge on the Year columns, not the indexes of the same name
+        prices_and_acres = per_bushel_prices.reset_index(drop=True).merge(
+            acres_planted.reset_index(drop=True), on="Year")
+
+        return prices_and_acres
+
+
+    @classmethod
+    def correction_terms(cls, totals, prices_and_acres=None):
+        """The table munge writes to indemnities.csv, from a Series of total
+        indemnities by year: the bushels per acre those indemnities would
+        have bought, padded with zeroes before 1926 and the mean of the
+        latest years for 2017"""
+        # Compute avg lost bushels per acre
+        if prices_and_acres is None:
+            prices_and_acres = cls.get_prices_and_acres()
+        indemnities = prices_and_acres.copy()
+        indemnities["total_indemnities"] = indemnities["Year"].map(
+            totals).fillna(0.0)
         indemnities = indemnities.set_index("Year")
         indemnities = indemnities[indemnities.index >= START_YEAR]
         indemnities["bushels_lost"] = (
@@ -231,10 +374,200 @@ class USDAIndemnitiesMunger:
         unknown_indemnities = pd.DataFrame(unknown_indemnities,
                                            columns=columns)
         unknown_indemnities = unknown_indemnities.set_index("Year")
-        indemnities = indemnities.append(unknown_indemnities)
+        indemnities = pd.concat([indemnities, unknown_indemnities])
         indemnities = indemnities.sort_index()
-        indemnities.to_csv("indemnities.csv")
-        
+
+        return indemnities
+
+
+    @classmethod
+    def munge(cls, correction_term_damage_causes=default_causes, workers=1,
+              cache_dir=CACHE_DIR):
+        """Read indemnities from USDA data to estimate a non-weather related 
+        loss correction tern to Nielsen model before calculating departure from 
+        trend. The data starts in 1948.
+
+        Only report files that changed since the last run are read again
+        (see get_cached_totals), and indemnities.csv is only rewritten if
+        its content changes."""
+        totals = cls.get_totals(correction_term_damage_causes, "CORN",
+                                workers, cache_dir)
+        with stage("report") as counts:
+            indemnities = cls.correction_terms(totals)
+            counts["rows"] = len(indemnities)
+            content = indemnities.to_csv()
+            if os.path.isfile("indemnities.csv"):
+                with open("indemnities.csv") as indemnities_file:
+                    if indemnities_file.read() == content:
+                        return
+            with open("indemnities.csv", "w") as indemnities_file:
+                indemnities_file.write(content)
+
+
+class IndemnityStore:
+    """The cleaned indemnity records of one commodity, held as integer codes
+    into the year, state, county, cause and plan categories, with the totals
+    of every year, state and cause summed once up front.
+
+    Totals for any set of causes and states are then a masked sum over that
+    small year x state x cause array rather than a pass over the records, so
+    many subsets can be tried quickly. Counties and plans are answered from
+    the records by select."""
+
+    def __init__(self, reports, prices_and_acres=None):
+        """reports is a DataFrame like USDAIndemnitiesMunger.get_reports
+        returns"""
+        years = reports["Commodity Year"].values.astype(np.int64)
+        self.years = np.arange(years.min(), years.max() + 1)
+        self.year_codes = years - self.years[0]
+        def categorical(column):
+            values = reports[column].astype("category").cat
+            return (np.asarray(values.categories, dtype=object),
+                    values.codes.values)
+        self.states, self.state_codes = categorical(
+            "Location State Abbreviation")
+        self.counties, self.county_codes = categorical("Location County Name")
+        self.causes, self.cause_codes = categorical("Damage Cause Description")
+        self.plans, self.plan_codes = categorical(
+            "Insurance Plan Abbreviation")
+        self.amounts = reports["Indemnity Amount"].values.astype(np.float64)
+        # Missing names (code -1) get a total of their own, past the last
+        shape = (len(self.years), len(self.states) + 1, len(self.causes) + 1)
+        cells = np.ravel_multi_index(
+            (self.year_codes, self.state_codes % shape[1],
+             self.cause_codes % shape[2]), shape)
+        self.totals = np.bincount(cells, weights=self.amounts,
+                                  minlength=np.prod(shape)).reshape(shape)
+        self.year_cause_totals = self.totals.sum(axis=1)
+        self.prices_and_acres = prices_and_acres
+
+
+    @classmethod
+    def load(cls, commodity="CORN", workers=1, cache_dir=CACHE_DIR):
+        "Build from the (cached) USDA report files"
+        reports = USDAIndemnitiesMunger.get_reports(commodity, workers,
+                                                    cache_dir)
+        with stage("aggregate") as counts:
+            store = cls(reports, USDAIndemnitiesMunger.get_prices_and_acres())
+            counts["rows"] = store.totals.size
+
+        return store
+
+
+    def _mask(self, categories, names):
+        "Which codes (and the missing code, last) to sum, for names or all"
+        if names is None:
+            return np.ones(len(categories) + 1, dtype=bool)
+        return np.append(np.isin(categories, list(names)), False)
+
+
+    def totals_by_year(self, causes=None, states=None):
+        """Total indemnity amount per year over the given damage causes and
+        states (all of them if None), as a Series indexed by year"""
+        cause_mask = self._mask(self.causes, causes)
+        if states is None:
+            totals = self.year_cause_totals[:, cause_mask].sum(axis=1)
+        else:
+            totals = self.totals[:, self._mask(self.states, states)][
+                :, :, cause_mask].sum(axis=(1, 2))
+
+        return pd.Series(totals, index=pd.Index(self.years, name="Year"),
+                         name="total_indemnities")
+
+
+    def totals_by_year_and_cause(self, causes=None, states=None):
+        """Total indemnity amount per year (rows) and damage cause (columns)
+        over the given causes and states"""
+        cause_mask = self._mask(self.causes, causes)[:-1]
+        if states is None:
+            totals = self.year_cause_totals
+        else:
+            totals = self.totals[:, self._mask(self.states, states)].sum(
+                axis=1)
+
+        return pd.DataFrame(totals[:, :-1][:, cause_mask],
+                            index=pd.Index(self.years, name="Year"),
+                            columns=self.causes[cause_mask])
+
+
+    def totals_by_state(self, causes=None, years=None):
+        """Total indemnity amount per state over the given causes and years
+        (all of them if None), as a Series indexed by state"""
+        year_mask = (np.ones(len(self.years), dtype=bool) if years is None
+                     else np.isin(self.years, list(years)))
+        totals = self.totals[year_mask][
+            :, :, self._mask(self.causes, causes)].sum(axis=(0, 2))
+
+        return pd.Series(totals[:-1],
+                         index=pd.Index(self.states, name="state"),
+                         name="total_indemnities")
+
+
+    def select(self, years=None, states=None, counties=None, causes=None,
+               plans=None):
+        """The records matching every given filter, as a DataFrame of year,
+        state, county, cause, plan and amount"""
+        selected = np.ones(len(self.amounts), dtype=bool)
+        for categories, codes, names in [
+                (self.states, self.state_codes, states),
+                (self.counties, self.county_codes, counties),
+                (self.causes, self.cause_codes, causes),
+                (self.plans, self.plan_codes, plans)]:
+            if names is not None:
+                selected &= self._mask(categories, names)[codes]
+        if years is not None:
+            selected &= np.isin(self.years, list(years))[self.year_codes]
+        def names(categories, codes):
+            return pd.Categorical.from_codes(codes[selected], categories)
+
+        return pd.DataFrame(
+            {"year" : self.years[self.year_codes[selected]],
+             "state" : names(self.states, self.state_codes),
+             "county" : names(self.counties, self.county_codes),
+             "cause" : names(self.causes, self.cause_codes),
+             "plan" : names(self.plans, self.plan_codes),
+             "amount" : self.amounts[selected]},
+            columns=["year", "state", "county", "cause", "plan", "amount"])
+
+
+    def bushels_lost_per_acre(self, causes=None, states=None):
+        """The yield correction term of USDAIndemnitiesMunger.correction_terms
+        for the given causes and states, by year. Prices and acres are
+        national, so state subsets give that region's losses spread over the
+        whole country's acres."""
+        if self.prices_and_acres is None:
+            self.prices_and_acres = (
+                USDAIndemnitiesMunger.get_prices_and_acres())
+
+        return USDAIndemnitiesMunger.correction_terms(
+            self.totals_by_year(causes, states),
+            self.prices_and_acres)["bushels_lost_per_acre"]
+
+
+def _get_cached_report(arguments):
+    "Process pool entry point for get_cached_report"
+    cls, year, commodity, cache_dir = arguments
+    return cls.get_cached_report(year, commodity, cache_dir)
+
+
+def _get_cached_totals(arguments):
+    "Process pool entry point for get_cached_totals"
+    cls, year, causes, commodity, cache_dir = arguments
+    return cls.get_cached_totals(year, causes, commodity, cache_dir)
+
 
 if __name__ == "__main__":
-    USDAIndemnitiesMunger.munge()
+    parser = argparse.ArgumentParser(
+        description="Munge USDA corn indemnities into indemnities.csv")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes reading report files")
+    parser.add_argument("--report", default=RUN_REPORT,
+                        help="write a JSON report of the run's stages here")
+    parser.add_argument("--profile", default=PROFILE,
+                        help="profiling hooks, comma separated: cprofile, "
+                             "tracemalloc")
+    args = parser.parse_args()
+    run = start_run("indemnities", args.profile, args.report)
+    USDAIndemnitiesMunger.munge(workers=args.workers)
+    if args.report:
+        run.write(args.report)
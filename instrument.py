@@ -0,0 +1,214 @@
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import datetime
+import contextlib
+import tracemalloc
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+
+# Comma separated hooks to switch on for every run: cprofile, tracemalloc
+PROFILE = os.environ.get("PROFILE", "")
+# Where to write run reports when no path is given on the command line
+RUN_REPORT = os.environ.get("RUN_REPORT")
+
+
+def peak_rss():
+    "High water mark of this process's resident memory in bytes"
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class RunReport:
+    """Wall time, CPU time and row counts of the named stages of one run
+    (parse, filter, reshape, aggregate, scale, fit, predict, report...),
+    totalled over every time a stage runs, with the process's peak RSS as
+    the stage last finished, plus whatever results the run adds, written
+    out as JSON.
+
+    profile lists hooks to switch on: "cprofile" profiles the whole run and
+    saves the stats next to the report, with the top functions in it;
+    "tracemalloc" adds each stage's peak traced allocation. Stages in
+    process pool workers aren't seen; the stage around the pool is.
+
+    path is where the report will be written, if it is known up front.
+    Progress messages (see log) then go into the report instead of being
+    printed. Warnings (see warn) go to stderr regardless."""
+
+    def __init__(self, name, profile=PROFILE, path=None):
+        self.name = name
+        self.path = path
+        self.messages = []
+        if isinstance(profile, str):
+            profile = [hook for hook in profile.split(",") if hook]
+        self.profile = list(profile or [])
+        self.stages = dict()
+        self.results = dict()
+        self.started = datetime.datetime.now().isoformat()
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        # Peak traced memory so far of each stage still open, since nested
+        # stages reset tracemalloc's peak
+        self.traced_peaks = []
+        self.profiler = None
+        if "tracemalloc" in self.profile:
+            tracemalloc.start()
+        if "cprofile" in self.profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Measure a block as stage name. Yields a dict in which the block
+        can set "rows" to the number of rows it produced."""
+        counts = {}
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            if self.traced_peaks:
+                self.traced_peaks[-1] = max(
+                    self.traced_peaks[-1], tracemalloc.get_traced_memory()[1])
+            self.traced_peaks.append(0)
+            tracemalloc.reset_peak()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield counts
+        finally:
+            totals = self.stages.setdefault(
+                name, {"calls" : 0, "wall_seconds" : 0.0,
+                       "cpu_seconds" : 0.0, "rows" : 0})
+            totals["calls"] += 1
+            totals["wall_seconds"] += time.perf_counter() - wall
+            totals["cpu_seconds"] += time.process_time() - cpu
+            totals["rows"] += int(counts.get("rows", 0))
+            totals["peak_rss_bytes"] = peak_rss()
+            if tracing:
+                peak = max(self.traced_peaks.pop(),
+                           tracemalloc.get_traced_memory()[1])
+                totals["peak_traced_bytes"] = max(
+                    totals.get("peak_traced_bytes", 0), peak)
+                # The enclosing stage's peak is at least this one's
+                if self.traced_peaks:
+                    self.traced_peaks[-1] = max(self.traced_peaks[-1], peak)
+                tracemalloc.reset_peak()
+
+
+    def add(self, key, value):
+        "Record a result of the run, such as the bad month counts"
+        self.results[key] = value
+
+
+    def log(self, message):
+        "Progress for a person: kept in the report if there will be one"
+        if self.path is None:
+            print(message)
+        else:
+            self.messages.append(message)
+
+
+    def warn(self, message):
+        """Something that went wrong without ending the run: always written
+        to stderr, and kept in the report too"""
+        print(message, file=sys.stderr)
+        self.messages.append("warning: " + message)
+
+
+    def to_dict(self):
+        report = {"run" : self.name,
+                  "argv" : sys.argv,
+                  "started" : self.started,
+                  "wall_seconds" : time.perf_counter() - self.wall,
+                  "cpu_seconds" : time.process_time() - self.cpu,
+                  "peak_rss_bytes" : peak_rss(),
+                  "stages" : self.stages,
+                  "results" : self.results,
+                  "log" : self.messages}
+        if self.profiler is not None:
+            stats = pstats.Stats(self.profiler)
+            top = sorted(stats.stats.items(), key=lambda item: -item[1][3])
+            report["profile"] = [
+                {"function" : "%s:%d(%s)" % function,
+                 "calls" : calls,
+                 "total_seconds" : total,
+                 "cumulative_seconds" : cumulative}
+                for function, (primitive, calls, total, cumulative, callers)
+                in top[:25]]
+
+        return report
+
+
+    def write(self, path=None):
+        """Stop the hooks and save the report as JSON at path (the one it was
+        made with by default), and the cProfile stats, if any, next to it
+        with a .prof extension"""
+        path = path or self.path
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(os.path.splitext(path)[0] + ".prof")
+        report = self.to_dict()
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        with open(path, "w") as report_file:
+            json.dump(report, report_file, indent=2, default=str)
+
+        return report
+
+
+# The report stages are recorded into, if a run has started
+_current = None
+
+
+def start_run(name, profile=PROFILE, path=None):
+    "Start recording stages into a new RunReport, and return it"
+    global _current
+    _current = RunReport(name, profile, path)
+    return _current
+
+
+def current_run():
+    return _current
+
+
+@contextlib.contextmanager
+def stage(name):
+    """RunReport.stage on the current run, or just the dict for rows if no
+    run has started, so instrumented code costs nothing outside of one"""
+    if _current is None:
+        yield {}
+    else:
+        with _current.stage(name) as counts:
+            yield counts
+
+
+def add_result(key, value):
+    "RunReport.add on the current run, if any"
+    if _current is not None:
+        _current.add(key, value)
+
+
+def log(message):
+    """RunReport.log on the current run, or just print the message if no run
+    has started"""
+    if _current is None:
+        print(message)
+    else:
+        _current.log(message)
+
+
+def warn(message):
+    """RunReport.warn on the current run, or just write the message to stderr
+    if no run has started"""
+    if _current is None:
+        print(message, file=sys.stderr)
+    else:
+        _current.warn(message)
@@ -0,0 +1,180 @@
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+
+from instrument import add_result, warn
+
+
+# The plotting libraries are slow to import and need a display to show
+# anything, so they are only imported by the functions that draw.
+
+def has_display():
+    "Whether figures could be shown on a screen"
+    if sys.platform.startswith("linux"):
+        return bool(os.environ.get("DISPLAY") or
+                    os.environ.get("WAYLAND_DISPLAY"))
+    return True
+
+
+# How figures are made: "show" saves them and shows them on screen, which
+# blocks until their windows are closed; "background" saves them from a
+# worker process on the non-interactive Agg backend while the run carries
+# on; "none" skips them. Without a display the default is background.
+MODES = ("show", "background", "none")
+PLOTS = os.environ.get("PLOTS") or ("show" if has_display() else "background")
+
+
+def pyplot(show=False):
+    """matplotlib.pyplot, imported on first use. Unless figures are to be
+    shown, on the Agg backend, which needs no display."""
+    import matplotlib
+    if not show and "matplotlib.pyplot" not in sys.modules:
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    return plt
+
+
+def station_map(stations, path="stations.pdf", show=False):
+    """Draw a map of stations (rows of ghcnd-stations.txt) to path"""
+    plt = pyplot(show)
+    from mpl_toolkits.basemap import Basemap
+    fig=plt.figure()
+    ax=fig.add_axes([0.1,0.1,0.8,0.8])
+    m = Basemap(projection="mill",\
+                lon_0=0)
+    m.drawcoastlines()
+    m.drawcountries()
+    lons = stations["LONGITUDE"].tolist()
+    lats = stations["LATITUDE"].tolist()
+    x, y = m(lons, lats)
+    m.scatter(x,y,marker=".", color="red")
+    ax.set_title("Weather stations")
+    plt.savefig(path)
+    if show:
+        plt.show()
+    plt.close(fig)
+
+
+def report_figures(predictions, show=False):
+    """Plot leave-one-out predictions against the observed departures from
+    trend and yields, to departure_from_trend.pdf and yield.pdf"""
+    plt = pyplot(show)
+    regression_plot = predictions.plot(
+        y=["departure_from_trend",
+           "predicted_departure"],
+        title="Predicted vs observed departure from technological model"
+    ).axhline(y=0)
+    for x in range(1890,2020,10):
+        plt.axvline(x=x)
+    regression_plot.get_figure().savefig("departure_from_trend.pdf")
+    if show:
+        plt.show()
+    value_plot = predictions.plot(
+        y=["Value", "technological_trend", "predicted"],
+        title="predicted yield (bushels/acre)"
+    )
+    for x in range(1890,2020,10):
+        plt.axvline(x=x)
+    value_plot.get_figure().savefig("yield.pdf")
+    if show:
+        plt.show()
+    error_plot = predictions.plot(
+        y=["prediction_error"],
+        title="prediction error (bushels/acre)"
+    )
+    if not show:
+        plt.close("all")
+
+
+class Plotter:
+    """Makes figures as mode says (see PLOTS). In the background the
+    figure functions run one after another in a single worker process,
+    started on first use, so their arguments need to pickle.
+
+    Figures are a by-product of a run, so one that can't be made (say
+    Basemap isn't installed) is reported, and recorded as a plot_failures
+    result of the run, rather than ending it."""
+
+    def __init__(self, mode=PLOTS):
+        if mode not in MODES:
+            raise ValueError("Unknown plots mode " + str(mode))
+        self.mode = mode
+        self.executor = None
+        # (figure function, Future) of every figure still rendering
+        self.futures = []
+        self.failures = dict()
+
+
+    def plot(self, function, *args):
+        """Call function(*args, show=...) now, in the background, or not at
+        all. In the background returns a Future of its result."""
+        if self.mode == "none":
+            return None
+        if self.mode == "show":
+            try:
+                return function(*args, show=True)
+            except Exception as error:
+                self.failed(function, error)
+                return None
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=1)
+        future = self.executor.submit(function, *args, show=False)
+        self.futures.append((function, future))
+
+        return future
+
+
+    def failed(self, function, error):
+        "Report a figure that couldn't be made"
+        message = type(error).__name__ + ": " + str(error)
+        warn("Couldn't make " + function.__name__ + " (" + message + ")")
+        self.failures[function.__name__] = message
+        add_result("plot_failures", self.failures)
+
+
+    def wait(self):
+        """Wait for the figures still rendering, reporting any that failed,
+        and stop the worker. Returns the failures so far, by figure
+        function."""
+        try:
+            for function, future in self.futures:
+                try:
+                    future.result()
+                except Exception as error:
+                    self.failed(function, error)
+        finally:
+            self.futures = []
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+        return self.failures
+
+
+# The plotter figures go through
+_plotter = Plotter()
+
+
+def current_mode():
+    "How figures are being made, one of MODES"
+    return _plotter.mode
+
+
+def set_mode(mode):
+    """Switch how figures are made, after waiting for any rendering in the
+    background"""
+    global _plotter
+    _plotter.wait()
+    _plotter = Plotter(mode)
+
+
+def plot(function, *args):
+    "Plotter.plot on the current plotter"
+    return _plotter.plot(function, *args)
+
+
+def wait():
+    "Plotter.wait on the current plotter"
+    return _plotter.wait()
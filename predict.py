@@ -1,14 +1,315 @@
 import os
 import sys
+import copy
+import time
+import argparse
 import numpy as np
 import pandas as pd
 import scipy
+import scipy.linalg
 from sklearn import preprocessing
 from sklearn import decomposition
+from sklearn.metrics import pairwise
+from sklearn.base import clone
 from sklearn.kernel_ridge import KernelRidge
-import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
 
-from common import ROOT_DIR, START_YEAR, END_YEAR
+from common import ROOT_DIR, RAW_DATA_DIR, START_YEAR, END_YEAR
+from cache import CACHE_DIR
+from features import FeatureMatrix, column_months
+from indemnities import IndemnityStore
+from trend import technological_trend, choose_breakpoints
+from instrument import stage, add_result, start_run, RUN_REPORT, PROFILE
+from plots import plot, report_figures, set_mode, wait, MODES, PLOTS
+from shared import SharedArrays, attach, attached
+
+
+def fitter_kernel(fitter, X, Y=None):
+    "The Gram matrix of a KernelRidge fitter's kernel, as it computes it"
+    if callable(fitter.kernel):
+        params = fitter.kernel_params or {}
+    else:
+        params = {"gamma" : fitter.gamma,
+                  "degree" : fitter.degree,
+                  "coef0" : fitter.coef0}
+    return pairwise.pairwise_kernels(X, Y, metric=fitter.kernel,
+                                     filter_params=True, **params)
+
+
+def kernel_ridge_loo(eigenvalues, eigenvectors, y, alpha):
+    """Leave-one-out predictions of kernel ridge regression for every row of
+    y (a vector, or a matrix with one column per target), given the
+    eigendecomposition of the full kernel matrix."""
+    shrinkage = eigenvalues / (eigenvalues + alpha)
+    hat_diagonal = (eigenvectors ** 2).dot(shrinkage)
+    if y.ndim == 2:
+        shrinkage = shrinkage[:, np.newaxis]
+        hat_diagonal = hat_diagonal[:, np.newaxis]
+    fitted = eigenvectors.dot(shrinkage * eigenvectors.T.dot(y))
+
+    return (fitted - hat_diagonal * y) / (1.0 - hat_diagonal)
+
+
+def kernel_from_gram(gram, n_features, kernel="poly", degree=3, gamma=None,
+                     coef0=1):
+    """Evaluate one of sklearn's dot product based kernels from the linear Gram
+    matrix X X^T, with KernelRidge's defaults, so many kernels can share one
+    pass over the features"""
+    if gamma is None:
+        gamma = 1.0 / n_features
+    if kernel == "linear":
+        return gram
+    if kernel == "poly":
+        return (gamma * gram + coef0) ** degree
+    if kernel == "sigmoid":
+        return np.tanh(gamma * gram + coef0)
+    if kernel == "rbf":
+        squared_norms = np.diag(gram)
+        distances = np.maximum(squared_norms[:, np.newaxis] +
+                               squared_norms[np.newaxis, :] - 2.0 * gram, 0.0)
+        return np.exp(-gamma * distances)
+    raise ValueError("No Gram matrix shortcut for kernel " + str(kernel))
+
+
+def score_departures(predicted_departures, values, trends):
+    """Win counts and mean absolute error in bushels/acre of predicted
+    departures from trend, one per column, scored like evaluate does"""
+    predicted = trends * (1.0 + predicted_departures)
+    improvement = np.abs(values - trends) - np.abs(values - predicted)
+
+    return ((improvement > 0).sum(axis=0),
+            np.abs(values - predicted).mean(axis=0))
+
+
+def _search_kernel(arguments):
+    """Leave-one-out scores of one kernel for every alpha and target column,
+    from a single eigendecomposition"""
+    gram, n_features, kernel, alphas, targets, values, trends = arguments
+    eigenvalues, eigenvectors = np.linalg.eigh(
+        kernel_from_gram(gram, n_features, **kernel))
+    scores = []
+    for alpha in alphas:
+        wins, errors = score_departures(
+            kernel_ridge_loo(eigenvalues, eigenvectors, targets, alpha),
+            values, trends)
+        scores.append((alpha, wins, errors))
+
+    return scores
+
+
+def leave_one_out(fitter, X, y):
+    """Leave-one-out predictions of any fitter on already scaled features,
+    in closed form for KernelRidge. Other fitters are refit on a copy, so
+    the fitter passed in is left as it was."""
+    if isinstance(fitter, KernelRidge):
+        eigenvalues, eigenvectors = np.linalg.eigh(fitter_kernel(fitter, X))
+        return kernel_ridge_loo(eigenvalues, eigenvectors, y, fitter.alpha)
+    predictions = np.empty(len(y))
+    fitter = clone(fitter)
+    for i in range(len(y)):
+        training = np.arange(len(y)) != i
+        predictions[i] = fitter.fit(X[training], y[training]).predict(
+            X[i].reshape(1, -1))[0]
+
+    return predictions
+
+
+def _leave_one_out(arguments):
+    "Process pool entry point for leave_one_out"
+    return leave_one_out(*arguments)
+
+
+def walk_forward(fitter, X, y, min_training_years=30):
+    """Walk-forward predictions of any fitter on already scaled features:
+    every row after the first min_training_years predicted from a fit on
+    the rows before it. For KernelRidge the kernel matrix is fixed, so the
+    Cholesky factor of K + alpha I is grown by one row at a time instead of
+    refitting."""
+    n = len(y)
+    m = min_training_years
+    predictions = np.empty(n - m)
+    if not isinstance(fitter, KernelRidge):
+        for t in range(m, n):
+            predictions[t - m] = fitter.fit(X[:t], y[:t]).predict(
+                X[t].reshape(1, -1))[0]
+        return predictions
+    K = fitter_kernel(fitter, X)
+    K[np.diag_indices_from(K)] += fitter.alpha
+    L = np.zeros((n, n))
+    L[:m, :m] = scipy.linalg.cholesky(K[:m, :m], lower=True)
+    for t in range(m, n):
+        dual_coef = scipy.linalg.cho_solve((L[:t, :t], True), y[:t])
+        # The kernel row of year t doesn't include the ridge
+        predictions[t - m] = K[t, :t].dot(dual_coef)
+        # Append year t to the factorization
+        row = scipy.linalg.solve_triangular(L[:t, :t], K[:t, t],
+                                            lower=True)
+        L[t, :t] = row
+        L[t, t] = np.sqrt(K[t, t] - row.dot(row))
+
+    return predictions
+
+
+# How compare backtests estimators
+VALIDATIONS = ("loo", "walk-forward")
+
+
+def validation_predictions(estimator, X, y, validation="loo",
+                           min_training_years=30):
+    """leave_one_out ("loo") or walk_forward ("walk-forward") predictions of
+    a fresh copy of estimator"""
+    if validation == "loo":
+        return leave_one_out(clone(estimator), X, y)
+    if validation == "walk-forward":
+        return walk_forward(clone(estimator), X, y, min_training_years)
+    raise ValueError("Unknown validation " + str(validation))
+
+
+def _validate(arguments):
+    """validation_predictions of one estimator and the seconds they took, on
+    the given features and targets or, if they are None, on those a
+    process pool worker has in shared memory"""
+    estimator, validation, min_training_years, data = arguments
+    X, y = attached("X", "y") if data is None else data
+    start = time.perf_counter()
+    predictions = validation_predictions(estimator, X, y, validation,
+                                         min_training_years)
+
+    return predictions, time.perf_counter() - start
+
+
+def bootstrap_predictions(estimator, X, y, seeds):
+    """Out-of-bag predictions of a copy of estimator fit on a bootstrap
+    resample of the rows for each of seeds (numpy SeedSequences): one row
+    per resample, NaN for the rows drawn into it"""
+    predictions = np.full((len(seeds), len(y)), np.nan)
+    for i, seed in enumerate(seeds):
+        sample = np.random.default_rng(seed).integers(len(y), size=len(y))
+        out_of_bag = np.ones(len(y), dtype=bool)
+        out_of_bag[sample] = False
+        if out_of_bag.any():
+            fit = clone(estimator).fit(X[sample], y[sample])
+            predictions[i, out_of_bag] = fit.predict(X[out_of_bag])
+
+    return predictions
+
+
+def _bootstrap(arguments):
+    "Process pool entry point for bootstrap_predictions, as _validate"
+    estimator, seeds, data = arguments
+    X, y = attached("X", "y") if data is None else data
+
+    return bootstrap_predictions(estimator, X, y, seeds)
+
+
+def prediction_intervals(draws, y, coverage=0.9):
+    """Bagged predictions of y and prediction intervals around them from
+    bootstrap_predictions' draws. Each row's prediction is the mean of the
+    fits that left it out, and its interval adds the quantiles of the other
+    rows' errors, out-of-bag too (the jackknife+ after bootstrap, roughly),
+    so it covers the model's own error rather than just its variance.
+    Returns the predictions, lower and upper bounds, the standard deviation
+    of the draws and how many there were, one of each per row."""
+    counts = np.sum(~np.isnan(draws), axis=0)
+    if counts.min() == 0:
+        raise ValueError("Some rows are never out of bag; use more "
+                         "resamples")
+    predictions = np.nanmean(draws, axis=0)
+    errors = y - predictions
+    tail = (1.0 - coverage) / 2.0
+    lower = np.empty(len(y))
+    upper = np.empty(len(y))
+    for i in range(len(y)):
+        others = np.delete(errors, i)
+        lower[i], upper[i] = predictions[i] + np.quantile(
+            others, [tail, 1.0 - tail])
+
+    return predictions, lower, upper, np.nanstd(draws, axis=0), counts
+
+
+def default_estimators():
+    """Estimators for USAMaizeYieldPredictor.compare: the kernel ridge
+    variants, a Gaussian process and gradient boosting. Imported here so the
+    rest of sklearn isn't loaded until something is compared."""
+    from sklearn.linear_model import Ridge
+    from sklearn.ensemble import GradientBoostingRegressor
+    from sklearn.gaussian_process import GaussianProcessRegressor
+    from sklearn.gaussian_process.kernels import RBF, WhiteKernel
+
+    return {
+        "kernel_ridge_poly3" : KernelRidge(kernel="poly", degree=3,
+                                           alpha=0.5),
+        "kernel_ridge_poly2" : KernelRidge(kernel="poly", degree=2,
+                                           alpha=0.5),
+        "kernel_ridge_rbf" : KernelRidge(kernel="rbf", alpha=0.5),
+        "kernel_ridge_linear" : KernelRidge(kernel="linear", alpha=1.0),
+        "ridge" : Ridge(alpha=1.0),
+        # Unbounded, the length scale shrinks until the GP is all noise
+        "gaussian_process" : GaussianProcessRegressor(
+            kernel=RBF(length_scale=10.0, length_scale_bounds=(1.0, 1e3)) +
+            WhiteKernel(),
+            normalize_y=True),
+        "gradient_boosting" : GradientBoostingRegressor(
+            max_depth=2, learning_rate=0.05, subsample=0.8,
+            max_features="sqrt", random_state=0)}
+
+
+def defines_range(X):
+    """Which rows hold the only minimum or the only maximum of some column,
+    i.e. the rows whose removal would change a MinMaxScaler fit"""
+    defining = np.zeros(len(X), dtype=bool)
+    for extreme in [np.nanmin(X, axis=0), np.nanmax(X, axis=0)]:
+        attained = X == extreme
+        defining |= np.any(attained & (attained.sum(axis=0) == 1), axis=1)
+
+    return defining
+
+
+def read_yield_history(yield_csv_name):
+    """Yearly national yields (Year and Value) from one of the USDA QuickStats
+    csv files in raw_data"""
+    history = pd.read_csv(os.path.join(RAW_DATA_DIR, yield_csv_name))
+    # Prune forecast rows
+    history = history[history["Period"] == "YEAR"] 
+    history = history.loc[:,['Year', 'Value']]
+    history = history.set_index(history['Year'])
+    history = history.sort_index()
+
+    return history
+
+
+def read_weather(weather_name, stations=None, months=None, statistics=None):
+    """The features munge wrote (as features.FeatureMatrix.read), selected by
+    station, month and statistic, as a DataFrame with the year as the first
+    column and the rest sharing the file's pages"""
+    features = FeatureMatrix.read(os.path.join(ROOT_DIR, weather_name))
+    if stations is not None or months is not None or statistics is not None:
+        features = features.select(stations, months, statistics)
+
+    weather = features.to_frame()
+    # As a column rather than the index, as it is a feature too
+    weather.insert(0, "year", features.years)
+    weather.index = pd.RangeIndex(len(weather))
+
+    return weather
+
+
+def detrend_history(history, advent_1, advent_2):
+    """Yields of the study years with the technological trend for the given
+    breakpoints and the departure from it, indexed by year (whatever the
+    history's index)"""
+    # Perform piecewise linear fit and compute departure from trend %
+    yields = history.set_index(history["Year"])
+    yields["technological_trend"] = technological_trend(
+        yields["Year"].values, yields["Value"].values, advent_1, advent_2)
+    yields = yields[(yields["Year"] >= START_YEAR) &
+                    (yields["Year"] <= END_YEAR) ]
+    yields = yields.drop("Year", axis=1)
+    yields["departure_from_trend"] = (
+        (yields["Value"] - yields["technological_trend"]) /
+        yields["technological_trend"])
+
+    return yields
 
 
 class USAMaizeYieldPredictor:
@@ -19,63 +320,120 @@ class USAMaizeYieldPredictor:
             yield_csv_name="FF72F614-2177-381F-A4EB-D059F706EC14.csv",
             advent_1=1937, # Technological model slope changes in these years
             advent_2=1962,
-            use_indemnities=False):
+            use_indemnities=False,
+            indemnity_store=None,
+            weather_name="weather.features",
+            stations=None, months=None, statistics=None):
         """Use RL Nielsen's technological model of maize yields to compute
         seasonal deviations from expectations. Load NOAA climatic data and be
-        ready to predict."""
+        ready to predict.
+
+        use_indemnities adds the bushels/acre lost to insured damage back to
+        the yields: True reads them from indemnities.csv, and a list of
+        damage causes totals those causes from indemnity_store (an
+        indemnities.IndemnityStore, loaded from the USDA files if None).
+
+        weather_name is munge's output, relative to the repository: the
+        memory-mapped weather.features, or a csv export of it. stations,
+        months and statistics (such as "TMAXavg") pick the features to use,
+        all of them if None."""
         self.fitter = fitter
-        self.weather = pd.read_csv(os.path.join(ROOT_DIR, "weather.csv"))
-        self.yields = pd.read_csv(
-            os.path.join(ROOT_DIR, "raw_data", yield_csv_name))
-        # Prune forecast rows
-        self.yields = self.yields[self.yields["Period"] == "YEAR"] 
-        self.yields = self.yields.loc[:,['Year', 'Value']]
-        self.yields = self.yields.set_index(self.yields['Year'])
-        self.yields = self.yields.sort_index()
-        if use_indemnities:
+        self.advent_1 = advent_1
+        self.advent_2 = advent_2
+        with stage("parse") as counts:
+            self.weather = read_weather(weather_name, stations, months,
+                                        statistics)
+            self.history = read_yield_history(yield_csv_name)
+            counts["rows"] = len(self.weather) + len(self.history)
+        self.reported_history = self.history
+        self.indemnity_store = indemnity_store
+        if use_indemnities is True:
             indemnities = pd.read_csv(os.path.join(ROOT_DIR, "indemnities.csv"))
             indemnities = indemnities.set_index("Year")
-            self.yields = self.yields.join(indemnities)
-            self.yields["Value"] = (
-                self.yields["Value"] + self.yields["bushels_lost_per_acre"])
-            self.yields = self.yields.loc[:,['Year', 'Value']]
-            self.yields = self.yields[self.yields["Year"] >= START_YEAR]
-        # Perform piecewise linear fit and compute departure from trend %
-        era = self.yields[self.yields["Year"] < advent_1]
-        (early_slope, early_intercept,
-        r_value, p_value, std_err) = scipy.stats.linregress(
-            era.as_matrix())
-        era = self.yields[(self.yields["Year"] >= advent_1) &
-                     (self.yields["Year"] < advent_2)]
-        (middle_slope, middle_intercept,
-         r_value, p_value, std_err) = scipy.stats.linregress(
-             era.as_matrix())
-        era = self.yields[self.yields["Year"] >= advent_2]
-        (modern_slope, modern_intercept,
-         r_value, p_value, std_err) = scipy.stats.linregress(
-             era.as_matrix())
-        def fit(year):
-            if year < advent_1:
-                return early_slope * year + early_intercept
-            elif year < advent_2:
-                return middle_slope * year + middle_intercept
-            else:
-                return modern_slope * year + modern_intercept
-        self.yields["technological_trend"] = self.yields["Year"].apply(fit)
-        self.yields = self.yields[(self.yields["Year"] >= START_YEAR) &
-                      (self.yields["Year"] <= END_YEAR) ]
-        self.yields = self.yields.drop("Year", axis=1)
-        self.yields["departure_from_trend"] = (
-            (self.yields["Value"] - self.yields["technological_trend"]) /
-            self.yields["technological_trend"])
+            self.history = self.corrected_history(
+                indemnities["bushels_lost_per_acre"])
+        elif use_indemnities:
+            if self.indemnity_store is None:
+                self.indemnity_store = IndemnityStore.load()
+            self.history = self.corrected_history(
+                self.indemnity_store.bushels_lost_per_acre(use_indemnities))
+        self.yields = self.detrend(advent_1, advent_2)
+        # Set by fit, and by the validations
+        self.model = None
+        self.scaler = None
+        self.predictions = None
 
-        
-    def predict(self, year):
-        """Predict the maize yield in bushels/acre for year, return as float"""
-        X = self.weather.as_matrix()
-        y = self.yields["departure_from_trend"].as_matrix()
+
+    def corrected_history(self, bushels_lost_per_acre):
+        "Reported yields plus a Series of bushels/acre lost, by year"
+        history = self.reported_history.join(
+            bushels_lost_per_acre.rename("bushels_lost_per_acre"))
+        history["Value"] = (
+            history["Value"] + history["bushels_lost_per_acre"])
+        history = history.loc[:,['Year', 'Value']]
+        history = history[history["Year"] >= START_YEAR]
+
+        return history
+
+
+    def with_indemnities(self, causes, states=None):
+        """A copy of this predictor whose yields are corrected for the
+        indemnities of the given damage causes (and states), totalled from
+        indemnity_store. Nothing is read from disk, so many subsets of causes
+        can be compared cheaply, e.g. with fast_leave_one_out. The copy
+        isn't fit, since a model of this predictor's yields would be stale."""
+        if self.indemnity_store is None:
+            self.indemnity_store = IndemnityStore.load()
+        predictor = copy.copy(self)
+        predictor.model = None
+        predictor.scaler = None
+        predictor.predictions = None
+        predictor.history = self.corrected_history(
+            self.indemnity_store.bushels_lost_per_acre(causes, states))
+        predictor.yields = predictor.detrend(self.advent_1, self.advent_2)
+
+        return predictor
+
+
+    def detrend(self, advent_1, advent_2):
+        """Yields of the study years with the technological trend for the given
+        breakpoints and the departure from it"""
+        return detrend_history(self.history, advent_1, advent_2)
+
+
+    def choose_advents(self, criterion="sse", candidates=None,
+                       min_era_years=10, cache_dir=CACHE_DIR):
+        """Replace advent_1 and advent_2 with the breakpoints that fit the
+        yield history best by criterion (see trend.breakpoint_scores), and
+        detrend again. Returns the new pair. The search is cached under
+        cache_dir, unless it is None, until the yields change."""
+        self.advent_1, self.advent_2 = choose_breakpoints(
+            self.history["Year"].values, self.history["Value"].values,
+            candidates, min_era_years, criterion, cache_dir)
+        self.yields = self.detrend(self.advent_1, self.advent_2)
+
+        return self.advent_1, self.advent_2
+
+
+    def predict(self, year, scale_on_all_years=True, training_years=None):
+        """Predict the maize yield in bushels/acre for year, return as float.
+        The model is trained on every other year, or on training_years if
+        given. The weather is min-max scaled using every year, including the
+        one being predicted, unless scale_on_all_years is False, in which case
+        only the training years are used."""
+        X = self.weather.values
+        y = self.yields["departure_from_trend"].values
         scaler = preprocessing.MinMaxScaler(feature_range=(0, 1))
-        X = scaler.fit_transform(X)
+        if training_years is None:
+            training = np.arange(len(X)) != year - START_YEAR
+        else:
+            training = np.zeros(len(X), dtype=bool)
+            training[np.asarray(training_years) - START_YEAR] = True
+        with stage("scale"):
+            if scale_on_all_years:
+                X = scaler.fit_transform(X)
+            else:
+                X = scaler.fit(X[training]).transform(X)
         # principal component analysis doesn't seem to help. Maybe later
         # pca = decomposition.PCA(
         #     svd_solver="full",
@@ -83,43 +441,442 @@ class USAMaizeYieldPredictor:
         # pca.fit(X)
         # X = pca.transform(X)
         prediction_season_vector = X[year - START_YEAR]
-        training_X = np.delete(X, year - START_YEAR, axis=0)
-        training_y = np.delete(y, year - START_YEAR, axis=0)
-        fit = self.fitter.fit(training_X, training_y)
-        prediction = float(fit.predict(prediction_season_vector.reshape(1, -1)))
+        training_X = X[training]
+        training_y = y[training]
+        with stage("fit") as counts:
+            fit = self.fitter.fit(training_X, training_y)
+            counts["rows"] = len(training_y)
+        with stage("predict") as counts:
+            prediction = float(fit.predict(
+                prediction_season_vector.reshape(1, -1)))
+            counts["rows"] = 1
 
         return prediction    
 
-    
-    def leave_one_out_cross_validation(self):
-        "Predict each year by training on all other years"
-        predictions = []
-        for year in range(START_YEAR, END_YEAR+1):
-            predictions.append([year, self.predict(year)])
-        self.predictions = pd.DataFrame(
-            predictions,
-            columns=["Year", "predicted_departure"])
-        self.predictions = self.predictions.set_index("Year")
-        self.predictions = self.predictions.join(predictor.yields)
+
+    def nowcast(self, cutoff_months=None, workers=1):
+        """Leave-one-out backtest of mid-season predictions. For each cutoff
+        month a model is trained on only the weather up to and including that
+        month, so each year gets one prediction of departure from trend per
+        cutoff. Returns a table of those with years as rows and cutoff months
+        as columns, next to the observed departure.
+
+        Min-max scaling is per column, so the full feature matrix is scaled
+        once and sliced for each cutoff. With workers > 1 the cutoffs are
+        spread over a process pool."""
+        months = column_months(self.weather.columns)
+        if cutoff_months is None:
+            cutoff_months = sorted(set(months[months > 0]))
+        scaler = preprocessing.MinMaxScaler(feature_range=(0, 1))
+        X = scaler.fit_transform(self.weather.values)
+        y = self.yields["departure_from_trend"].values
+        arguments = [(self.fitter, X[:, months <= cutoff], y)
+                     for cutoff in cutoff_months]
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(_leave_one_out, arguments))
+        else:
+            results = [_leave_one_out(cutoff) for cutoff in arguments]
+        nowcasts = pd.DataFrame(
+            np.column_stack(results),
+            index=self.yields.index,
+            columns=pd.Index(cutoff_months, name="cutoff_month"))
+        nowcasts["departure_from_trend"] = (
+            self.yields["departure_from_trend"])
+
+        return nowcasts
+
+
+    def nowcast_season(self, season, year=END_YEAR+1):
+        """Predict the departure from trend of a season in progress, given as a
+        munge schema row with NaN for the months not yet measured, from a
+        model trained on all years up to the last complete month"""
+        season = pd.Series(self.season_matrix(season, year)[0],
+                           index=self.weather.columns)
+        months = column_months(self.weather.columns)
+        missing = months[season.isnull().values]
+        cutoff = (missing.min() - 1) if len(missing) else months.max()
+        columns = months <= cutoff
+        scaler = preprocessing.MinMaxScaler(feature_range=(0, 1))
+        X = scaler.fit_transform(self.weather.values[:, columns])
+        fit = clone(self.fitter).fit(
+            X, self.yields["departure_from_trend"].values)
+        prediction = float(fit.predict(scaler.transform(
+            season.values[columns].reshape(1, -1))))
+
+        return prediction
+
+
+    def fit(self):
+        """Fit the scaler and a copy of the fitter on every year once, for
+        predict_scenarios. The fitter itself may be shared with other
+        predictors and is refit by predict."""
+        self.scaler = preprocessing.MinMaxScaler(feature_range=(0, 1))
+        X = self.scaler.fit_transform(self.weather.values)
+        self.model = clone(self.fitter).fit(
+            X, self.yields["departure_from_trend"].values)
+
+        return self
+
+
+    def season_matrix(self, seasons, year):
+        """Rows of features in weather.csv's column order from a DataFrame in
+        the munge schema or an array of season vectors, adding the year column
+        if it is missing"""
+        if isinstance(seasons, pd.DataFrame):
+            seasons = seasons.reset_index()
+            if "year" not in seasons.columns:
+                seasons["year"] = year
+            return seasons[self.weather.columns].values
+        seasons = np.atleast_2d(np.asarray(seasons, dtype=np.float64))
+        if seasons.shape[1] == self.weather.shape[1] - 1:
+            seasons = np.column_stack([np.full(len(seasons), year), seasons])
+
+        return seasons
+
+
+    def scenario_departures(self, seasons, year=END_YEAR+1, batch_size=10000):
+        """Predicted departure from trend of every season in a batch, with the
+        model from fit. Works through the batch in blocks of batch_size rows
+        to bound memory."""
+        if self.model is None:
+            self.fit()
+        seasons = self.season_matrix(seasons, year)
+        departures = np.empty(len(seasons))
+        for start in range(0, len(seasons), batch_size):
+            block = self.scaler.transform(seasons[start:start+batch_size])
+            departures[start:start+batch_size] = self.model.predict(block)
+
+        return departures
+
+
+    def predict_scenarios(self, seasons, year=END_YEAR+1,
+                          quantiles=(0.05, 0.25, 0.5, 0.75, 0.95)):
+        """Quantiles of departure from trend and of bushels/acre over an
+        ensemble of possible seasons for year, e.g. perturbations of the
+        current season or weather forecasts"""
+        departures = self.scenario_departures(seasons, year)
+        trend = technological_trend(
+            self.history["Year"].values, self.history["Value"].values,
+            self.advent_1, self.advent_2, at_years=[year])[0]
+        distribution = pd.DataFrame(
+            {"departure_from_trend" : np.quantile(departures, quantiles),
+             "predicted" : trend * (1.0 + np.quantile(departures, quantiles))},
+            index=pd.Index(quantiles, name="quantile"))
+
+        return distribution
+
+
+    def perturbed_seasons(self, year, n, scale=0.1, seed=None):
+        """n copies of year's season with Gaussian noise added to every
+        feature, scale times that feature's standard deviation over the
+        years"""
+        X = self.weather.drop("year", axis=1)
+        noise = np.random.RandomState(seed).standard_normal((n, X.shape[1]))
+        season = X.values[year - START_YEAR]
+
+        return season + scale * noise * X.std().values
+
+
+    def kernel(self, X, Y=None):
+        "The Gram matrix of the fitter's kernel, as KernelRidge computes it"
+        return fitter_kernel(self.fitter, X, Y)
+
+
+    def fast_leave_one_out(self, scale_on_all_years=True):
+        """Every year's leave-one-out prediction of departure from trend for a
+        KernelRidge fitter, from a single fit. Matches calling predict for
+        each year.
+
+        Kernel ridge is a linear smoother, y_hat = H y with
+        H = K (K + alpha I)^-1, and the held-out residual of row i is
+        (y_i - y_hat_i) / (1 - H_ii), so one eigendecomposition of K gives
+        all of them. When scaling leaves the held-out year out, only years
+        holding some feature's unique minimum or maximum change the scaling,
+        and those are refit the slow way. With hundreds of features that is
+        most years, so that mode saves little."""
+        X = self.weather.values
+        y = self.yields["departure_from_trend"].values
+        scaler = preprocessing.MinMaxScaler(feature_range=(0, 1))
+        with stage("scale"):
+            scaled = scaler.fit_transform(X)
+        with stage("fit") as counts:
+            eigenvalues, eigenvectors = np.linalg.eigh(self.kernel(scaled))
+            counts["rows"] = len(y)
+        with stage("predict") as counts:
+            predictions = kernel_ridge_loo(eigenvalues, eigenvectors, y,
+                                           self.fitter.alpha)
+            counts["rows"] = len(predictions)
+        if not scale_on_all_years:
+            for i in np.flatnonzero(defines_range(X)):
+                predictions[i] = self.predict(START_YEAR + i,
+                                              scale_on_all_years=False)
+
+        return predictions
+
+
+    def search(self, alphas=(0.5,), kernels=None, advents=None, workers=1):
+        """Leave-one-out validate every combination of alpha, kernel and
+        technological trend breakpoints with the closed form, returning a
+        table ranked by win count and then mean absolute error.
+
+        kernels is a list of dicts of KernelRidge kernel parameters (kernel,
+        degree, gamma, coef0) and advents a list of (advent_1, advent_2)
+        pairs, defaulting to the current ones. The scaled weather and its Gram
+        matrix are computed once, every kernel is eigendecomposed once for all
+        alphas, and every alpha scores all the trend variants in one go. With
+        workers > 1 the kernels are spread over a process pool."""
+        if kernels is None:
+            kernels = [{"kernel" : self.fitter.kernel,
+                        "degree" : self.fitter.degree,
+                        "gamma" : self.fitter.gamma,
+                        "coef0" : self.fitter.coef0}]
+        kernels = [dict({"kernel" : "poly", "degree" : 3, "gamma" : None,
+                         "coef0" : 1}, **kernel) for kernel in kernels]
+        if advents is None:
+            advents = [(self.advent_1, self.advent_2)]
+        scaler = preprocessing.MinMaxScaler(feature_range=(0, 1))
+        X = scaler.fit_transform(self.weather.values)
+        gram = X.dot(X.T)
+        detrended = [self.detrend(advent_1, advent_2)
+                     for advent_1, advent_2 in advents]
+        targets, values, trends = [
+            np.column_stack([yields[column].values for yields in detrended])
+            for column in ["departure_from_trend", "Value",
+                           "technological_trend"]]
+        arguments = [(gram, X.shape[1], kernel, alphas, targets, values, trends)
+                     for kernel in kernels]
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(_search_kernel, arguments))
+        else:
+            results = [_search_kernel(kernel) for kernel in arguments]
+        rows = []
+        for kernel, scores in zip(kernels, results):
+            for alpha, wins, errors in scores:
+                for (advent_1, advent_2), win, error in zip(advents, wins,
+                                                            errors):
+                    rows.append(dict(kernel, alpha=alpha, advent_1=advent_1,
+                                     advent_2=advent_2, wins=win,
+                                     mean_absolute_error=error))
+        ranking = pd.DataFrame(
+            rows,
+            columns=["kernel", "degree", "gamma", "coef0", "alpha",
+                     "advent_1", "advent_2", "wins", "mean_absolute_error"])
+        ranking = ranking.sort_values(["wins", "mean_absolute_error"],
+                                      ascending=[False, True])
+
+        return ranking.reset_index(drop=True)
+
+
+    def scaled_weather(self):
+        "The weather min-max scaled over every year"
+        scaler = preprocessing.MinMaxScaler(feature_range=(0, 1))
+        with stage("scale"):
+            return scaler.fit_transform(self.weather.values)
+
+
+    def compare(self, estimators=None, validation="loo",
+                min_training_years=30, workers=1):
+        """Backtest every one of estimators, a dict of names to sklearn
+        estimators (default_estimators() if None), by leave-one-out ("loo")
+        or walk-forward validation, and rank them like search: by wins over
+        the technological model, then mean absolute error in bushels/acre.
+        The leaderboard also has each one's root mean squared error and the
+        seconds its validation took. The predicted departures are kept in
+        comparison, a column per estimator.
+
+        With workers > 1 the estimators are spread over a process pool. The
+        scaled weather and the departures go into shared memory once rather
+        than being pickled into every task."""
+        if estimators is None:
+            estimators = default_estimators()
+        if validation not in VALIDATIONS:
+            raise ValueError("Unknown validation " + str(validation))
+        X = self.scaled_weather()
+        y = self.yields["departure_from_trend"].values
+        with stage("fit") as counts:
+            if workers > 1:
+                with SharedArrays(X=X, y=y) as shared, ProcessPoolExecutor(
+                        max_workers=workers, initializer=attach,
+                        initargs=(shared.descriptors,)) as executor:
+                    results = list(executor.map(
+                        _validate,
+                        [(estimator, validation, min_training_years, None)
+                         for estimator in estimators.values()]))
+            else:
+                results = [_validate((estimator, validation,
+                                      min_training_years, (X, y)))
+                           for estimator in estimators.values()]
+            counts["rows"] = len(estimators) * len(y)
+        # Walk-forward predicts none of the first min_training_years
+        yields = self.yields.iloc[
+            0 if validation == "loo" else min_training_years:]
+        predicted_departures = np.column_stack(
+            [predictions for predictions, seconds in results])
+        values = yields["Value"].values[:, np.newaxis]
+        trends = yields["technological_trend"].values[:, np.newaxis]
+        wins, errors = score_departures(predicted_departures, values, trends)
+        squared_errors = (values - trends * (1.0 + predicted_departures)) ** 2
+        self.comparison = pd.DataFrame(predicted_departures,
+                                       index=yields.index,
+                                       columns=list(estimators))
+        leaderboard = pd.DataFrame(
+            {"estimator" : list(estimators),
+             "validation" : validation,
+             "years" : len(yields),
+             "wins" : wins,
+             "mean_absolute_error" : errors,
+             "root_mean_squared_error" : np.sqrt(squared_errors.mean(axis=0)),
+             "seconds" : [seconds for predictions, seconds in results]})
+        leaderboard = leaderboard.sort_values(
+            ["wins", "mean_absolute_error"],
+            ascending=[False, True]).reset_index(drop=True)
+        add_result("leaderboard", leaderboard.to_dict("records"))
+
+        return leaderboard
+
+
+    def bootstrap_intervals(self, estimator=None, resamples=500,
+                            coverage=0.9, seed=0, workers=1):
+        """Prediction intervals for every year from resamples fits of
+        estimator (the fitter if None), each on a bootstrap resample of the
+        years and predicting the years it left out (see
+        prediction_intervals). Returns a table by year of the bagged
+        predicted_departure and predicted yield, as in predictions, with
+        their _lower and _upper bounds, the standard deviation of the fits'
+        departures and how many fits left the year out, next to the yields
+        and whether the reported yield fell inside its interval.
+
+        With workers > 1 the resamples are split over a process pool, with
+        the scaled weather and departures in shared memory as for compare.
+        Every resample is seeded from seed, so the intervals don't depend on
+        the number of workers."""
+        if estimator is None:
+            estimator = self.fitter
+        X = self.scaled_weather()
+        y = self.yields["departure_from_trend"].values
+        seeds = np.random.SeedSequence(seed).spawn(resamples)
+        with stage("fit") as counts:
+            if workers > 1:
+                # A few batches per worker to even out the load
+                batches = [[seeds[i] for i in batch] for batch in
+                           np.array_split(np.arange(resamples), workers * 4)
+                           if len(batch)]
+                with SharedArrays(X=X, y=y) as shared, ProcessPoolExecutor(
+                        max_workers=workers, initializer=attach,
+                        initargs=(shared.descriptors,)) as executor:
+                    draws = np.vstack(list(executor.map(
+                        _bootstrap,
+                        [(estimator, batch, None) for batch in batches])))
+            else:
+                draws = _bootstrap((estimator, seeds, (X, y)))
+            counts["rows"] = resamples
+        with stage("report"):
+            predicted, lower, upper, spread, fits = prediction_intervals(
+                draws, y, coverage)
+            intervals = pd.DataFrame(
+                {"predicted_departure" : predicted,
+                 "predicted_departure_lower" : lower,
+                 "predicted_departure_upper" : upper,
+                 "bootstrap_std" : spread,
+                 "fits" : fits},
+                index=self.yields.index)
+            intervals = intervals.join(self.yields)
+            for bound in ["", "_lower", "_upper"]:
+                intervals["predicted" + bound] = (
+                    intervals["technological_trend"] *
+                    (1.0 + intervals["predicted_departure" + bound]))
+            intervals["covered"] = (
+                (intervals["Value"] >= intervals["predicted_lower"]) &
+                (intervals["Value"] <= intervals["predicted_upper"]))
+            add_result("interval_coverage", float(intervals["covered"].mean()))
+
+        return intervals
+
+
+    def leave_one_out_cross_validation(self, fast=True,
+                                       scale_on_all_years=True):
+        """Predict each year by training on all other years. KernelRidge
+        fitters use the closed form in fast_leave_one_out unless fast is
+        False."""
+        years = range(START_YEAR, END_YEAR+1)
+        if fast and isinstance(self.fitter, KernelRidge):
+            predictions = self.fast_leave_one_out(scale_on_all_years)
+        else:
+            predictions = [self.predict(year, scale_on_all_years)
+                           for year in years]
+        with stage("report"):
+            self.predictions = self.evaluate(
+                pd.Series(predictions, index=pd.Index(years, name="Year")))
+            add_result("wins", int(self.predictions["win"].sum()))
+            add_result("years", len(self.predictions))
+            self.report()
+
+
+    def walk_forward_validation(self, min_training_years=30, fast=True,
+                                scale_on_all_years=True):
+        """Backtest the way the model would be used: predict each year after
+        the first min_training_years by training only on the years before
+        it. (The technological trend is still fit on all years.)
+
+        For a KernelRidge fitter with the weather scaled on all years, the
+        kernel matrix is fixed, so instead of refitting every year the
+        Cholesky factor of K + alpha I is grown by one row per year and each
+        prediction costs two triangular solves."""
+        years = range(START_YEAR + min_training_years, END_YEAR+1)
+        if fast and scale_on_all_years and isinstance(self.fitter,
+                                                      KernelRidge):
+            predictions = self.fast_walk_forward(min_training_years)
+        else:
+            predictions = [
+                self.predict(year, scale_on_all_years,
+                             training_years=range(START_YEAR, year))
+                for year in years]
+        self.predictions = self.evaluate(
+            pd.Series(predictions, index=pd.Index(years, name="Year")))
+        self.report()
+
+
+    def fast_walk_forward(self, min_training_years=30):
+        """Walk-forward predictions of departure from trend for every year
+        after the first min_training_years, for a KernelRidge fitter, by
+        rank-one growth of a Cholesky factor"""
+        X = self.weather.values
+        y = self.yields["departure_from_trend"].values
+        scaler = preprocessing.MinMaxScaler(feature_range=(0, 1))
+
+        return walk_forward(self.fitter, scaler.fit_transform(X), y,
+                            min_training_years)
+
+
+    def evaluate(self, predicted_departures):
+        """Join a Series of predicted departures from trend, indexed by year,
+        with the yields and add the columns that score it against the
+        technological model"""
+        predictions = pd.DataFrame(
+            {"predicted_departure" : predicted_departures})
+        predictions = predictions.join(self.yields)
         # Columns to evaluate the fit
-        self.predictions["predicted"] = (
-            self.predictions["technological_trend"] *
-            (1.0 + self.predictions["predicted_departure"]))
-        self.predictions["technological_trend_error"] = (
-            self.predictions["Value"] - self.predictions["technological_trend"])
-        self.predictions["prediction_error"] = (self.predictions["Value"] -
-                                           self.predictions["predicted"])
-        self.predictions["improvement"] =  (
-            abs(self.predictions["technological_trend_error"]) -
-            abs(self.predictions["prediction_error"]))
-        self.predictions["win"] = self.predictions["improvement"] > 0
+        predictions["predicted"] = (
+            predictions["technological_trend"] *
+            (1.0 + predictions["predicted_departure"]))
+        predictions["technological_trend_error"] = (
+            predictions["Value"] - predictions["technological_trend"])
+        predictions["prediction_error"] = (predictions["Value"] -
+                                           predictions["predicted"])
+        predictions["improvement"] =  (
+            abs(predictions["technological_trend_error"]) -
+            abs(predictions["prediction_error"]))
+        predictions["win"] = predictions["improvement"] > 0
         # The technological model is probably flawed for any year where the
         # weather suggests a bad crop but the yield beats the technological
         # trendline. Flag years like this.
         # Playing around with advent_1 and advent_2 redistributes these years.
-        self.predictions["unexpected_bumper_crop"] = (~self.predictions["win"] &
-            (self.predictions["departure_from_trend"] > 0))
-        self.report()
+        predictions["unexpected_bumper_crop"] = (~predictions["win"] &
+            (predictions["departure_from_trend"] > 0))
+
+        return predictions
 
     def report(self):
         "IO to tell a person about the leave-one-out predicctions"
@@ -127,29 +884,193 @@ class USAMaizeYieldPredictor:
         print("Times outperformed technological model baseline: ")
         print(str(self.predictions["win"].sum()) +
               " / " + str(len(self.predictions)))
-        regression_plot = self.predictions.plot(
-            y=["departure_from_trend",
-               "predicted_departure"],
-            title="Predicted vs observed departure from technological model"
-        ).axhline(y=0)
-        for x in range(1890,2020,10):
-            plt.axvline(x=x)
-        plt.show()
-        regression_plot.get_figure().savefig("departure_from_trend.pdf")
-        value_plot = self.predictions.plot(
-            y=["Value", "technological_trend", "predicted"],
-            title="predicted yield (bushels/acre)"
-        )
-        for x in range(1890,2020,10):
-            plt.axvline(x=x)
-        plt.show()
-        value_plot.get_figure().savefig("yield.pdf")
-        error_plot = self.predictions.plot(
-            y=["prediction_error"],
-            title="prediction error (bushels/acre)"
-        )
+        # Shown, rendered in the background or skipped, as the plots mode
+        # says
+        plot(report_figures, self.predictions)
 
         
+class MultiTargetYieldPredictor:
+    """Predict the departures from trend of several yield series (crops, or
+    regions) from the same weather at once.
+
+    Targets covering the same years share one kernel matrix, one
+    eigendecomposition and one multi-output solve, so another crop with
+    corn's years costs a few more matrix-vector products rather than a
+    whole pipeline run. Targets with fewer years (soybeans start in 1924)
+    form their own group."""
+
+    # National yields in raw_data, bushels/acre
+    default_targets = {
+        "corn" : "FF72F614-2177-381F-A4EB-D059F706EC14.csv",
+        "soybeans" : "D4AC8178-39FB-32AE-B1E6-C2F6D6FEE1BD.csv",
+        "wheat" : "532FB590-F41E-3905-B625-354826BCDA4D.csv"}
+
+
+    def __init__(
+            self,
+            fitter=KernelRidge(kernel="poly", degree=3, alpha=0.5),
+            targets=None,
+            advents=None,
+            weather_name="weather.features",
+            stations=None, months=None, statistics=None):
+        """targets maps names to yield csv names in raw_data or to histories
+        with Year and Value columns, default_targets by default. advents maps
+        names to their (advent_1, advent_2) trend breakpoints, 1937 and 1962
+        where not given. weather_name and the feature selection are as for
+        USAMaizeYieldPredictor."""
+        self.fitter = fitter
+        if targets is None:
+            targets = self.default_targets
+        if advents is None:
+            advents = dict()
+        self.weather = read_weather(weather_name, stations, months,
+                                    statistics)
+        years = pd.Index(range(START_YEAR, END_YEAR+1), name="Year")
+        self.histories = dict()
+        detrended = dict()
+        for name, target in targets.items():
+            self.histories[name] = (read_yield_history(target)
+                                    if isinstance(target, str) else target)
+            detrended[name] = detrend_history(
+                self.histories[name], *advents.get(name, (1937, 1962)))
+        # Years x targets, NaN where a target has no yield
+        self.yields = {
+            column : pd.DataFrame({name : yields[column] for name, yields
+                                   in detrended.items()},
+                                  index=years, columns=list(targets))
+            for column in ["Value", "technological_trend",
+                           "departure_from_trend"]}
+
+
+    def target_groups(self):
+        """The targets grouped by the years they have yields for, as a list of
+        (boolean year mask, target names)"""
+        present = self.yields["departure_from_trend"].notnull()
+        groups = dict()
+        for name in present.columns:
+            groups.setdefault(tuple(present[name].values), []).append(name)
+
+        return [(np.array(mask), names) for mask, names in groups.items()]
+
+
+    def scaled_weather(self):
+        "The weather min-max scaled over every year"
+        scaler = preprocessing.MinMaxScaler(feature_range=(0, 1))
+
+        return scaler.fit_transform(self.weather.values)
+
+
+    def fit(self):
+        """Fit the scaler, and a copy of the fitter per target group with one
+        multi-output solve, on every year each group has"""
+        self.scaler = preprocessing.MinMaxScaler(feature_range=(0, 1))
+        X = self.scaler.fit_transform(self.weather.values)
+        departures = self.yields["departure_from_trend"]
+        self.models = []
+        for rows, names in self.target_groups():
+            model = clone(self.fitter).fit(X[rows],
+                                           departures[names].values[rows])
+            self.models.append((names, model))
+
+        return self
+
+
+    def predict(self, seasons, year=END_YEAR+1):
+        """Predicted departure from trend of every target for a batch of
+        seasons (rows of features in weather.csv's order), one row each"""
+        if not hasattr(self, "models"):
+            self.fit()
+        X = self.scaler.transform(np.atleast_2d(seasons))
+        predictions = pd.DataFrame(index=range(len(X)),
+                                   columns=self.yields["Value"].columns,
+                                   dtype=np.float64)
+        for names, model in self.models:
+            predictions[names] = model.predict(X).reshape(len(X), -1)
+
+        return predictions
+
+
+    def fast_leave_one_out(self):
+        """Every year's leave-one-out prediction of every target, as a years x
+        targets DataFrame (NaN where a target has no yield). KernelRidge
+        fitters get the closed form from one eigendecomposition per target
+        group; anything else is refit year by year."""
+        X = self.scaled_weather()
+        departures = self.yields["departure_from_trend"]
+        predictions = pd.DataFrame(np.nan, index=departures.index,
+                                   columns=departures.columns)
+        for rows, names in self.target_groups():
+            Y = departures[names].values[rows]
+            if isinstance(self.fitter, KernelRidge):
+                eigenvalues, eigenvectors = np.linalg.eigh(
+                    fitter_kernel(self.fitter, X[rows]))
+                predicted = kernel_ridge_loo(eigenvalues, eigenvectors, Y,
+                                             self.fitter.alpha)
+            else:
+                predicted = np.column_stack(
+                    [leave_one_out(self.fitter, X[rows], y) for y in Y.T])
+            predictions.loc[rows, names] = predicted
+
+        return predictions
+
+
+    def leave_one_out_cross_validation(self):
+        """Leave-one-out predictions of every target, scored like
+        USAMaizeYieldPredictor.evaluate: a table of years, wins over the
+        technological model and mean absolute error in bushels/acre, per
+        target"""
+        self.predictions = self.fast_leave_one_out()
+        scores = []
+        for name in self.predictions.columns:
+            rows = self.predictions[name].notnull().values
+            wins, errors = score_departures(
+                self.predictions[name].values[rows],
+                self.yields["Value"][name].values[rows],
+                self.yields["technological_trend"][name].values[rows])
+            scores.append([name, rows.sum(), wins, errors])
+
+        return pd.DataFrame(
+            scores, columns=["target", "years", "wins",
+                             "mean_absolute_error"]).set_index("target")
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Validate the maize yield predictor, or compare "
+                    "estimators")
+    parser.add_argument("--plots", choices=MODES, default=PLOTS,
+                        help="show the report's figures, render them in the "
+                             "background, or skip them and only validate")
+    parser.add_argument("--validation", choices=VALIDATIONS, default="loo")
+    parser.add_argument("--compare", action="store_true",
+                        help="rank the default estimators by validating "
+                             "each of them, instead of just the fitter")
+    parser.add_argument("--bootstrap", type=int, default=0, metavar="N",
+                        help="also print prediction intervals from N "
+                             "bootstrap fits")
+    parser.add_argument("--coverage", type=float, default=0.9)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--report", default=RUN_REPORT,
+                        help="write a JSON report of the run's stages here")
+    parser.add_argument("--profile", default=PROFILE,
+                        help="profiling hooks, comma separated: cprofile, "
+                             "tracemalloc")
+    args = parser.parse_args()
+    run = start_run("predict", args.profile, args.report)
+    set_mode(args.plots)
     predictor = USAMaizeYieldPredictor()
-    predictor.leave_one_out_cross_validation()
+    if args.compare:
+        print(predictor.compare(validation=args.validation,
+                                workers=args.workers))
+    elif args.validation == "walk-forward":
+        predictor.walk_forward_validation()
+    else:
+        predictor.leave_one_out_cross_validation()
+    if args.bootstrap:
+        print(predictor.bootstrap_intervals(resamples=args.bootstrap,
+                                            coverage=args.coverage,
+                                            workers=args.workers))
+    with stage("plot"):
+        wait()
+    if args.report:
+        run.write(args.report)
@@ -0,0 +1,69 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+
+class SharedArrays:
+    """numpy arrays copied once into shared memory, so that process pool
+    workers map the same pages rather than each task carrying a pickled
+    copy of them.
+
+    Start the pool with attach as its initializer and descriptors as its
+    arguments, and its tasks can then get the arrays by name with
+    attached. Use as a context manager around the pool, so the memory is
+    released once the workers are done with it."""
+
+    def __init__(self, **arrays):
+        self.segments = []
+        # (name, segment name, shape, dtype) of every array, for attach
+        self.descriptors = []
+        try:
+            for name, array in arrays.items():
+                array = np.ascontiguousarray(array)
+                segment = shared_memory.SharedMemory(
+                    create=True, size=max(array.nbytes, 1))
+                self.segments.append(segment)
+                np.ndarray(array.shape, array.dtype,
+                           buffer=segment.buf)[...] = array
+                self.descriptors.append(
+                    (name, segment.name, array.shape, array.dtype.str))
+        except:
+            self.close()
+            raise
+
+
+    def close(self):
+        "Free the shared memory. Workers mustn't use the arrays after this."
+        for segment in self.segments:
+            segment.close()
+            segment.unlink()
+        self.segments = []
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exception):
+        self.close()
+
+
+# The arrays attached in this process by name, and their segments, which
+# have to stay open for as long as the arrays are used
+_arrays = dict()
+_segments = []
+
+
+def attach(descriptors):
+    """Process pool initializer mapping the arrays of a SharedArrays into the
+    worker, read only"""
+    for name, segment_name, shape, dtype in descriptors:
+        segment = shared_memory.SharedMemory(name=segment_name)
+        _segments.append(segment)
+        array = np.ndarray(shape, dtype, buffer=segment.buf)
+        array.flags.writeable = False
+        _arrays[name] = array
+
+
+def attached(*names):
+    "The arrays attach mapped into this process, in the order named"
+    return [_arrays[name] for name in names]
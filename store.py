@@ -0,0 +1,203 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+
+from common import START_YEAR, END_YEAR
+from ghcnd import ELEMENTS
+
+
+class MeasurementStore:
+    """Daily GHCN measurements for many stations in one dense float32 array
+    shaped stations x calendar days x elements, NaN wherever a day is missing
+    or was filtered out. Values keep the .dly units (tenths of degrees C and
+    tenths of mm), which float32 represents exactly.
+
+    Every (year, month) is a contiguous run of days, so statistics can be
+    taken from slices instead of boolean masks over a long table."""
+
+    def __init__(self, values, station_ids, start_year=START_YEAR,
+                 end_year=END_YEAR, elements=ELEMENTS):
+        self.values = values
+        # Set for stores living in a memory-mapped file
+        self.path = None
+        self.station_ids = list(station_ids)
+        self.start_year = start_year
+        self.end_year = end_year
+        self.elements = tuple(elements)
+        self.dates = pd.date_range(str(start_year) + "-01-01",
+                                   str(end_year) + "-12-31")
+        # Day offset of the first of every month, plus one past the end
+        month_starts = pd.date_range(str(start_year) + "-01-01",
+                                     str(end_year + 1) + "-01-01",
+                                     freq="MS")
+        self.month_offsets = np.asarray(
+            (month_starts - self.dates[0]).days, dtype=np.int64)
+        self.station_index = {station_id : i for i, station_id
+                              in enumerate(self.station_ids)}
+        assert values.shape == (len(self.station_ids), len(self.dates),
+                                len(self.elements))
+
+
+    @classmethod
+    def empty(cls, station_ids, start_year=START_YEAR, end_year=END_YEAR,
+              elements=ELEMENTS, path=None):
+        """An all-NaN store, in memory or as a new memory-mapped file under
+        path"""
+        n_days = (pd.Timestamp(str(end_year) + "-12-31") -
+                  pd.Timestamp(str(start_year) + "-01-01")).days + 1
+        shape = (len(station_ids), n_days, len(elements))
+        if path is None:
+            values = np.full(shape, np.nan, dtype=np.float32)
+        else:
+            os.makedirs(path, exist_ok=True)
+            values = np.lib.format.open_memmap(
+                os.path.join(path, "values.npy"), mode="w+",
+                dtype=np.float32, shape=shape)
+            values[:] = np.nan
+        store = cls(values, station_ids, start_year, end_year, elements)
+        if path is not None:
+            store.path = path
+            store.write_metadata(path)
+
+        return store
+
+
+    @classmethod
+    def from_munger(cls, munger, station_ids, path=None,
+                    start_year=START_YEAR, end_year=END_YEAR,
+                    elements=ELEMENTS):
+        """Fill a store from the parsed .dly columns of each station, without
+        keeping any of the long DataFrames around"""
+        store = cls.empty(station_ids, start_year, end_year, elements, path)
+        for station_id in station_ids:
+            store.fill(station_id, munger.get_columns(station_id))
+        if path is not None:
+            store.values.flush()
+
+        return store
+
+
+    def fill(self, station_id, columns, elements=ELEMENTS):
+        """Copy the columns returned by ghcnd.parse_dly, whose ELEMENT codes
+        index elements, into one station's slab, leaving out the years and
+        elements the store doesn't have"""
+        years = columns["YEAR"]
+        positions = np.array([self.elements.index(element)
+                              if element in self.elements else -1
+                              for element in elements])
+        element_positions = positions[columns["ELEMENT"]]
+        # Month numbers are only defined within the store's years
+        keep = np.flatnonzero((years >= self.start_year) &
+                              (years <= self.end_year) &
+                              (element_positions >= 0))
+        days = columns["DAY"][keep]
+        month_numbers = ((years[keep] - self.start_year) * 12 +
+                         columns["MONTH"][keep] - 1)
+        # .dly files have 31 days for every month
+        real = days <= (self.month_offsets[month_numbers + 1] -
+                        self.month_offsets[month_numbers])
+        keep = keep[real]
+        day_numbers = (self.month_offsets[month_numbers[real]] +
+                       days[real] - 1)
+        self.values[self.station_index[station_id],
+                    day_numbers,
+                    element_positions[keep]] = columns["VALUE"][keep]
+
+
+    def write_metadata(self, path):
+        with open(os.path.join(path, "store.json"), "w") as metadata_file:
+            json.dump({"station_ids" : self.station_ids,
+                       "start_year" : self.start_year,
+                       "end_year" : self.end_year,
+                       "elements" : list(self.elements)},
+                      metadata_file)
+
+
+    def save(self, path):
+        "Write to a directory that load can memory-map"
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "values.npy"), self.values)
+        self.write_metadata(path)
+
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """Open a saved store. The default read-only memory map lets any number
+        of processes share one copy of the pages."""
+        with open(os.path.join(path, "store.json")) as metadata_file:
+            metadata = json.load(metadata_file)
+        values = np.load(os.path.join(path, "values.npy"), mmap_mode=mmap_mode)
+        store = cls(values, metadata["station_ids"], metadata["start_year"],
+                    metadata["end_year"], metadata["elements"])
+        if mmap_mode is not None:
+            store.path = path
+
+        return store
+
+
+    def __getstate__(self):
+        """Memory-mapped stores travel to other processes as their path and
+        are reopened there, rather than copied"""
+        state = dict(self.__dict__)
+        if self.path is not None:
+            self.values.flush()
+            state["values"] = None
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.values is None:
+            self.values = np.load(os.path.join(self.path, "values.npy"),
+                                  mmap_mode="r")
+
+
+    def day_slice(self, year, month=None):
+        "The days of a year, or of one month of it, as a slice"
+        month_number = (year - self.start_year) * 12
+        if month is None:
+            return slice(self.month_offsets[month_number],
+                         self.month_offsets[month_number + 12])
+        month_number += month - 1
+        return slice(self.month_offsets[month_number],
+                     self.month_offsets[month_number + 1])
+
+
+    def station(self, station_id):
+        "days x elements view of one station"
+        return self.values[self.station_index[station_id]]
+
+
+    def element(self, element):
+        "stations x days view of one element"
+        return self.values[:, :, self.elements.index(element)]
+
+
+    def select(self, station_id, element, year=None, month=None):
+        """Daily values of one station and element, optionally narrowed to a
+        year or month. A view, NaN on missing days."""
+        values = self.values[self.station_index[station_id], :,
+                             self.elements.index(element)]
+        if year is None:
+            return values
+        return values[self.day_slice(year, month)]
+
+
+    def to_frame(self, station_id):
+        """Long DataFrame of one station's present days, with the columns of
+        GhcndMunger.get_measurements"""
+        slab = self.station(station_id)
+        day_numbers, element_codes = np.nonzero(~np.isnan(slab))
+        dates = self.dates[day_numbers]
+        measurements = pd.DataFrame(
+            {"ID": station_id,
+             "ELEMENT": np.array(self.elements, dtype=object)[element_codes],
+             "YEAR": np.asarray(dates.year, dtype=np.int64),
+             "MONTH": np.asarray(dates.month, dtype=np.int64),
+             "DAY": np.asarray(dates.day, dtype=np.int64),
+             "VALUE": slab[day_numbers, element_codes].astype(np.float64)},
+            columns=["DAY", "ID", "ELEMENT", "YEAR", "MONTH", "VALUE"])
+
+        return measurements
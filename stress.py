@@ -0,0 +1,125 @@
+import numpy as np
+import pandas as pd
+
+
+# Thresholds are in .dly units: tenths of degrees C and tenths of mm
+DEFAULT_THRESHOLDS = {
+    "heat" : 320,           # TMAX at or above 32C is a heat stress day
+    "heat_wave_days" : 3,   # this many heat days in a row make a heat wave
+    "hot_night" : 220,      # TMIN at or above 22C
+    "frost" : 0,            # TMIN at or below freezing
+    "flood" : 500,          # PRCP totalling 50mm or more over flood_window
+    "flood_window" : 2,     # days, since flood damage takes 24-48 hours
+    "dry" : 1,              # PRCP below 0.1mm is a dry day
+    "dry_spell_days" : 10,  # this many dry days in a row make a dry spell
+}
+
+
+def runs(condition, starts):
+    """Run-length encode every row of a boolean (stations x days) array.
+    Returns the station, the number of the period (delimited by the day
+    offsets in starts) in which each run begins, and its length."""
+    n_stations, n_days = condition.shape
+    padded = np.zeros((n_stations, n_days + 1), dtype=np.int8)
+    padded[:, 1:] = condition
+    # A trailing zero column separates the stations once flattened
+    edges = np.diff(np.column_stack(
+        [padded, np.zeros(n_stations, dtype=np.int8)]).ravel())
+    run_starts = np.flatnonzero(edges == 1)
+    run_ends = np.flatnonzero(edges == -1)
+    stations, days = np.divmod(run_starts, n_days + 2)
+
+    return (stations, np.searchsorted(starts, days, side="right") - 1,
+            run_ends - run_starts)
+
+
+def per_period(stations, periods, values, shape, reduce=np.add):
+    "Scatter per-run values into a (stations x periods) table"
+    table = np.zeros(shape)
+    reduce.at(table, (stations, periods), values)
+    return table
+
+
+def stress_features(store, start_month=2, end_month=11, station_ids=None,
+                    **thresholds):
+    """Counts and longest runs of physiologically stressful weather events in
+    each growing season, from a MeasurementStore's daily series:
+
+    HEATdays, HEATWAVEcount and HEATWAVEmaxrun (TMAX >= heat),
+    HOTNIGHTdays (TMIN >= hot_night), FROSTdays (TMIN <= frost),
+    FLOODdays (days ending a flood_window day PRCP total >= flood) and
+    PRCPmaxwindow (the largest such total), DRYSPELLcount and DRYSPELLmaxrun
+    (PRCP < dry).
+
+    Thresholds override DEFAULT_THRESHOLDS. Missing days never count as
+    events and break runs. Every feature is NaN for a season without any
+    measurements of its element, rather than a 0 that would read as a
+    season without stress.
+    Returns a DataFrame indexed by year, with columns like
+    HEATdays_USW00023271_month2to11, to sit alongside munge's."""
+    thresholds = dict(DEFAULT_THRESHOLDS, **thresholds)
+    if station_ids is None:
+        station_ids = store.station_ids
+    rows = [store.station_index[station_id] for station_id in station_ids]
+    years = range(store.start_year, store.end_year + 1)
+    year_starts = store.month_offsets[0:-1:12]
+    shape = (len(rows), len(years))
+    in_season = np.zeros(store.values.shape[1], dtype=bool)
+    for year in years:
+        in_season[store.day_slice(year, start_month).start:
+                  store.day_slice(year, end_month).stop] = True
+    def element(name):
+        values = np.asarray(store.values[rows, :, store.elements.index(name)],
+                            dtype=np.float64)
+        values[:, ~in_season] = np.nan
+        return values
+    def days(condition):
+        return np.add.reduceat(condition.astype(np.int64), year_starts, axis=1)
+    def unless_unmeasured(values, names):
+        measured = days(~np.isnan(values)) > 0
+        for name in names:
+            features[name] = np.where(measured, features[name], np.nan)
+    def run_statistics(condition, min_length):
+        stations, periods, lengths = runs(condition, year_starts)
+        long_enough = lengths >= min_length
+        return (per_period(stations[long_enough], periods[long_enough],
+                           1, shape),
+                per_period(stations, periods, lengths, shape, np.maximum))
+    features = dict()
+    with np.errstate(invalid="ignore"):
+        tmax = element("TMAX")
+        heat = tmax >= thresholds["heat"]
+        features["HEATdays"] = days(heat)
+        (features["HEATWAVEcount"],
+         features["HEATWAVEmaxrun"]) = run_statistics(
+             heat, thresholds["heat_wave_days"])
+        unless_unmeasured(tmax, ["HEATdays", "HEATWAVEcount",
+                                 "HEATWAVEmaxrun"])
+        tmin = element("TMIN")
+        features["HOTNIGHTdays"] = days(tmin >= thresholds["hot_night"])
+        features["FROSTdays"] = days(tmin <= thresholds["frost"])
+        unless_unmeasured(tmin, ["HOTNIGHTdays", "FROSTdays"])
+        prcp = element("PRCP")
+        # Rolling totals from a running sum, each ending on its last day
+        window = thresholds["flood_window"]
+        cumulative = np.cumsum(np.nan_to_num(prcp), axis=1)
+        totals = cumulative.copy()
+        totals[:, window:] -= cumulative[:, :-window]
+        totals[np.isnan(prcp)] = np.nan
+        features["FLOODdays"] = days(totals >= thresholds["flood"])
+        # fmax skips missing days, so only a season without any is NaN
+        features["PRCPmaxwindow"] = np.fmax.reduceat(
+            totals, year_starts, axis=1)
+        (features["DRYSPELLcount"],
+         features["DRYSPELLmaxrun"]) = run_statistics(
+             prcp < thresholds["dry"], thresholds["dry_spell_days"])
+        unless_unmeasured(prcp, ["FLOODdays", "DRYSPELLcount",
+                                 "DRYSPELLmaxrun"])
+    suffix = "_month" + str(start_month) + "to" + str(end_month)
+    columns = dict()
+    for i, station_id in enumerate(station_ids):
+        for name, table in features.items():
+            columns[name + "_" + str(station_id) + suffix] = table[i]
+    stress = pd.DataFrame(columns, index=pd.Index(years, name="year"))
+
+    return stress
@@ -0,0 +1,224 @@
+import os
+import io
+import tarfile
+import argparse
+import numpy as np
+import pandas as pd
+
+
+from common import START_YEAR, END_YEAR
+from ghcnd import MISSING_VALUE
+from indemnities import USDAIndemnitiesMunger
+
+
+# Made up but well formed inputs for every stage of the pipeline, so it can
+# be run and timed offline at any scale.
+
+CORN_YIELD_CSV = "FF72F614-2177-381F-A4EB-D059F706EC14.csv"
+CORN_PRICE_CSV = "FDE80B2D-1155-391B-B0D9-2ECC1E988562.csv"
+CORN_ACRES_CSV = "0BA4DA4C-05B8-3321-B35B-C145F4AA2925.csv"
+
+
+def synthetic_station_ids(n_stations):
+    "IDs shaped like GHCN-Daily's, which won't clash with real ones"
+    return ["USZ%08d" % i for i in range(n_stations)]
+
+
+def dly_bytes(station_id, start_year=START_YEAR, end_year=END_YEAR,
+              elements=("TMAX", "TMIN", "PRCP", "SNOW"), missing=0.05,
+              flagged=0.01, synoptic=0.02, seed=0):
+    """The contents of a .dly file: one 269 byte record per year, month and
+    element, with seasonal temperatures and showery precipitation. About
+    missing of the days are -9999, flagged have a quality flag and synoptic
+    an "S" source flag. Days past the end of a month are -9999 as in the
+    real files. SNOW is there to be filtered out."""
+    rng = np.random.RandomState(seed)
+    years, months, codes = [grid.ravel() for grid in np.meshgrid(
+        np.arange(start_year, end_year + 1), np.arange(1, 13),
+        np.arange(len(elements)), indexing="ij")]
+    n = len(years)
+    days = np.arange(1, 32)[np.newaxis, :]
+    day_of_year = 30.4 * (months[:, np.newaxis] - 1) + days
+    season = -np.cos(2 * np.pi * (day_of_year - 15) / 365.0)
+    tmax = 150 + 150 * season + rng.normal(0, 40, (n, 31))
+    tmin = tmax - 100 + rng.normal(0, 20, (n, 31))
+    prcp = np.where(rng.uniform(size=(n, 31)) < 0.3,
+                    rng.exponential(80, (n, 31)), 0)
+    snow = np.where((season > 0.5) & (rng.uniform(size=(n, 31)) < 0.2),
+                    rng.exponential(50, (n, 31)), 0)
+    by_element = {"TMAX" : tmax, "TMIN" : tmin, "PRCP" : prcp,
+                  "SNOW" : snow}
+    values = np.empty((n, 31), dtype=np.int64)
+    for code, element in enumerate(elements):
+        values[codes == code] = np.round(by_element[element][codes == code])
+    month_lengths = pd.to_datetime(
+        pd.DataFrame({"year" : years, "month" : months, "day" : 1})
+    ).dt.days_in_month.values
+    absent = ((days > month_lengths[:, np.newaxis]) |
+              (rng.uniform(size=(n, 31)) < missing))
+    values[absent] = MISSING_VALUE
+    qflags = np.where(rng.uniform(size=(n, 31)) < flagged, "I", " ")
+    sflags = np.where(rng.uniform(size=(n, 31)) < synoptic, "S", "7")
+    qflags[absent] = " "
+    sflags[absent] = " "
+    fields = np.char.add(np.char.add(np.char.rjust(values.astype(str), 5),
+                                     " "),
+                         np.char.add(qflags, sflags)).astype("S8")
+    day_fields = np.ascontiguousarray(fields).view("S248").ravel()
+    heads = np.array(["%s%04d%02d%s" % (station_id, year, month,
+                                         elements[code])
+                      for year, month, code in zip(years, months, codes)],
+                     dtype="S21")
+    lines = np.char.add(np.char.add(heads, day_fields), b"\n")
+
+    return lines.astype("S270").tobytes()
+
+
+def write_dly(directory, station_id, start_year=START_YEAR,
+              end_year=END_YEAR, seed=0):
+    "Write dly_bytes to station_id.dly in directory, returning its path"
+    path = os.path.join(directory, station_id + ".dly")
+    with open(path, "wb") as dly_file:
+        dly_file.write(dly_bytes(station_id, start_year, end_year, seed=seed))
+
+    return path
+
+
+def write_dly_tarball(path, years, seed=0):
+    """A gzipped tarball laid out like ghcnd_all.tar.gz, with a dly_bytes
+    member for every station in years, a dict of station IDs to their
+    (start_year, end_year), plus a directory and a readme to be skipped"""
+    with tarfile.open(path, "w:gz") as tarball:
+        directory = tarfile.TarInfo("ghcnd_all")
+        directory.type = tarfile.DIRTYPE
+        tarball.addfile(directory)
+        members = [("readme.txt", b"Not a station\n")]
+        members += [(station_id + ".dly",
+                     dly_bytes(station_id, start_year, end_year,
+                               seed=seed + i))
+                    for i, (station_id, (start_year, end_year))
+                    in enumerate(sorted(years.items()))]
+        for name, data in members:
+            member = tarfile.TarInfo("ghcnd_all/" + name)
+            member.size = len(data)
+            tarball.addfile(member, io.BytesIO(data))
+
+    return path
+
+
+def write_stations(directory, station_ids, seed=0):
+    "A ghcnd-stations.txt placing the stations around the corn belt"
+    rng = np.random.RandomState(seed)
+    lines = ["%-11s %8.4f %9.4f %6.1f %-2s %-30s" %
+             (station_id, rng.uniform(36, 48), rng.uniform(-104, -82),
+              rng.uniform(100, 500), "IA", "SYNTHETIC " + station_id)
+             for station_id in station_ids]
+    with open(os.path.join(directory, "ghcnd-stations.txt"), "w") as out:
+        out.write("\n".join(lines) + "\n")
+
+
+def indemnity_report(year, rows, seed=0):
+    """rows records of USDA's pipe delimited cause of loss layout for year
+    (or spread over 1948-88 for the historical file), padded like the
+    real ones, a third of them corn"""
+    rng = np.random.RandomState(seed)
+    causes = USDAIndemnitiesMunger.default_causes + [
+        "Drought", "Hail", "Flood", "Excess Moisture/Precip/Rain"]
+    states = ["IA", "IL", "NE", "MN", "IN", "OH", "SD", "WI"]
+    years = (rng.randint(1948, 1989, rows) if year < 1989
+             else np.full(rows, year))
+    report = pd.DataFrame(
+        {"Commodity Year" : years,
+         "Location State Code" : "19",
+         "Location State Abbreviation" : rng.choice(states, rows),
+         "Location County Code" : "001",
+         "Location County Name" : np.char.ljust(
+             np.char.add("County ", rng.randint(0, 99, rows).astype(str)),
+             15),
+         "Commodity Code" : "0041",
+         "Commodity Name" : np.char.ljust(
+             rng.choice(["CORN", "SOYBEANS", "WHEAT"], rows), 20),
+         "Insurance Plan Code" : "90",
+         "Insurance Plan Abbreviation" : rng.choice(["APH", "CRC", "RP "],
+                                                    rows),
+         "Stage Code" : "  ",
+         "Damage Cause Code" : "11",
+         "Damage Cause Description" : np.char.ljust(
+             rng.choice(causes, rows), 40)},
+        columns=USDAIndemnitiesMunger.report_names(year)[:12])
+    if year >= 2001:
+        report["Determined Acres"] = np.round(rng.uniform(0, 100, rows), 1)
+    report["Indemnity Amount"] = np.round(rng.exponential(20000, rows), 2)
+    report["(empty)"] = ""
+
+    return report
+
+
+def write_indemnity_reports(directory, rows_per_year=10000, seed=0):
+    """The report files USDAIndemnitiesMunger.munge reads: the historical
+    file with rows_per_year for each of 1948-88, and one per year after"""
+    fnames = {USDAIndemnitiesMunger.year_to_fname(year) : year
+              for year in range(1988, END_YEAR + 1)}
+    for fname, year in fnames.items():
+        rows = rows_per_year * (1988 - 1948 + 1 if year < 1989 else 1)
+        indemnity_report(year, rows, seed + year).to_csv(
+            os.path.join(directory, fname), sep="|", header=False,
+            index=False)
+
+
+def write_quickstats(directory, seed=0):
+    """Corn yields, marketing year prices and acres planted in the columns
+    of USDA's QuickStats exports that the pipeline reads"""
+    rng = np.random.RandomState(seed)
+    years = np.arange(1866, END_YEAR + 1)
+    trend = np.where(years < 1937, 26.0,
+                     np.where(years < 1962, 26.0 + 0.9 * (years - 1937),
+                              48.5 + 1.9 * (years - 1962)))
+    yields = pd.DataFrame(
+        {"Year" : years, "Period" : "YEAR",
+         "Value" : np.round(trend * (1 + rng.normal(0, 0.08, len(years))),
+                            1)})
+    yields.to_csv(os.path.join(directory, CORN_YIELD_CSV), index=False)
+    price_years = np.arange(1908, END_YEAR)
+    prices = pd.DataFrame(
+        {"Year" : price_years, "Period" : "MARKETING YEAR",
+         "Value" : np.round(rng.uniform(1, 6, len(price_years)), 2)})
+    prices.to_csv(os.path.join(directory, CORN_PRICE_CSV), index=False)
+    acre_years = np.arange(1926, END_YEAR + 1)
+    acres = pd.DataFrame(
+        {"Year" : acre_years, "Period" : "YEAR",
+         "Value" : ["{:,}".format(acres) for acres
+                    in rng.randint(60, 100, len(acre_years)) * 1000000]})
+    acres.to_csv(os.path.join(directory, CORN_ACRES_CSV), index=False)
+
+
+def write_synthetic_data(directory, n_stations=10, start_year=START_YEAR,
+                         end_year=END_YEAR, rows_per_year=10000, seed=0):
+    """Fill directory with everything the pipeline reads from raw_data, and
+    return the synthetic station IDs. Point RAW_DATA_DIR at it to run the
+    pipeline on it."""
+    os.makedirs(directory, exist_ok=True)
+    station_ids = synthetic_station_ids(n_stations)
+    for i, station_id in enumerate(station_ids):
+        write_dly(directory, station_id, start_year, end_year, seed + i)
+    write_stations(directory, station_ids, seed)
+    write_indemnity_reports(directory, rows_per_year, seed)
+    write_quickstats(directory, seed)
+
+    return station_ids
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Write synthetic GHCN-Daily and USDA inputs")
+    parser.add_argument("directory")
+    parser.add_argument("--stations", type=int, default=10)
+    parser.add_argument("--start-year", type=int, default=START_YEAR)
+    parser.add_argument("--end-year", type=int, default=END_YEAR)
+    parser.add_argument("--rows-per-year", type=int, default=10000,
+                        help="indemnity records per year")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(write_synthetic_data(args.directory, args.stations,
+                               args.start_year, args.end_year,
+                               args.rows_per_year, args.seed))
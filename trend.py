@@ -0,0 +1,174 @@
+import os
+import numpy as np
+import pandas as pd
+
+
+from cache import digest, array_digest, memoize_columns
+
+
+# Bump whenever breakpoint_scores changes its scores, to invalidate the cache
+BREAKPOINTS_VERSION = 1
+
+
+def era_fits(years, values, breakpoints):
+    """Least squares slope and intercept of every era between breakpoints
+    (era k holds the years from breakpoints[k-1] up to but excluding
+    breakpoints[k]), all eras at once from per-era sums"""
+    years = np.asarray(years, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    eras = np.searchsorted(breakpoints, years, side="right")
+    n_eras = len(breakpoints) + 1
+    def total(weights):
+        return np.bincount(eras, weights=weights, minlength=n_eras)
+    counts = total(None)
+    # Centre on each era's means before the sums of products
+    mean_years = total(years) / counts
+    mean_values = total(values) / counts
+    dx = years - mean_years[eras]
+    dy = values - mean_values[eras]
+    slopes = total(dx * dy) / total(dx * dx)
+
+    return slopes, mean_values - slopes * mean_years
+
+
+def technological_trend(years, values, advent_1, advent_2, at_years=None):
+    """RL Nielsen's piecewise linear model of yields, with the slope changing
+    in advent_1 and advent_2, evaluated at every year or at at_years"""
+    if at_years is None:
+        at_years = years
+    at_years = np.asarray(at_years, dtype=np.float64)
+    breakpoints = [advent_1, advent_2]
+    slopes, intercepts = era_fits(years, values, breakpoints)
+    eras = np.searchsorted(breakpoints, at_years, side="right")
+
+    return slopes[eras] * at_years + intercepts[eras]
+
+
+def trend_and_departure(years, values, advent_1, advent_2):
+    """The technological trend of every year and the departure from it, as a
+    fraction of the trend"""
+    trend = technological_trend(years, values, advent_1, advent_2)
+
+    return trend, (np.asarray(values) - trend) / trend
+
+
+def segment_table(years, values, criterion="sse"):
+    """The error of a straight line fit to every run of consecutive points
+    [lo, hi) of series sorted by year, as an (n+1) x (n+1) array indexed by
+    lo and hi (inf where hi - lo < 3).
+
+    criterion "sse" is the sum of squared residuals, which comes from prefix
+    sums of x, y, x^2, xy and y^2 in O(1) per run. "loo" is the
+    leave-one-out squared error (PRESS), the residuals inflated by
+    1 / (1 - h) with h the leverage of each point, O(n) per run."""
+    x = np.asarray(years, dtype=np.float64)
+    y = np.asarray(values, dtype=np.float64)
+    n = len(x)
+    # Centring keeps the sums of squares from cancelling badly
+    x = x - x.mean()
+    y = y - y.mean()
+    def prefix(column):
+        return np.concatenate([[0.0], np.cumsum(column)])
+    sums = {"n" : prefix(np.ones(n)), "x" : prefix(x), "y" : prefix(y),
+            "xx" : prefix(x * x), "xy" : prefix(x * y), "yy" : prefix(y * y)}
+    lo = np.arange(n + 1)[:, np.newaxis]
+    hi = np.arange(n + 1)[np.newaxis, :]
+    run = {name : column[hi] - column[lo] for name, column in sums.items()}
+    with np.errstate(invalid="ignore", divide="ignore"):
+        m = run["n"]
+        sxx = run["xx"] - run["x"]**2 / m
+        sxy = run["xy"] - run["x"] * run["y"] / m
+        syy = run["yy"] - run["y"]**2 / m
+        slopes = sxy / sxx
+        if criterion == "sse":
+            table = np.maximum(syy - slopes * sxy, 0.0)
+        elif criterion == "loo":
+            mean_x = run["x"] / m
+            intercepts = run["y"] / m - slopes * mean_x
+            table = np.full((n + 1, n + 1), np.inf)
+            in_run = np.arange(n)[np.newaxis, :]
+            for start in range(n - 2):
+                stops = np.arange(start + 3, n + 1)[:, np.newaxis]
+                residuals = (y - intercepts[start, stops] -
+                             slopes[start, stops] * x)
+                leverage = (1.0 / m[start, stops] +
+                            (x - mean_x[start, stops])**2 /
+                            sxx[start, stops])
+                terms = np.where((in_run >= start) & (in_run < stops),
+                                 (residuals / (1.0 - leverage))**2, 0.0)
+                table[start, start+3:] = terms.sum(axis=1)
+        else:
+            raise ValueError("Unknown criterion " + str(criterion))
+    table[~(hi - lo >= 3)] = np.inf
+
+    return table
+
+
+def breakpoint_scores(years, values, candidates=None, min_era_years=10,
+                      criterion="sse"):
+    """Score every pair of breakpoints (advent_1 < advent_2) for the three
+    era piecewise linear trend, by the total segment_table error of the
+    eras. Eras need at least min_era_years points. Returns a DataFrame of
+    advent_1, advent_2 and score, best first.
+
+    candidates defaults to every year of the series. The whole search costs
+    one segment_table and three lookups per pair."""
+    order = np.argsort(years, kind="mergesort")
+    years = np.asarray(years)[order]
+    values = np.asarray(values, dtype=np.float64)[order]
+    n = len(years)
+    if candidates is None:
+        candidates = np.unique(years)
+    candidates = np.unique(np.asarray(candidates))
+    table = segment_table(years, values, criterion)
+    # A breakpoint starts its era at the first year on or after it
+    starts = np.searchsorted(years, candidates, side="left")
+    first = starts[:, np.newaxis]
+    second = starts[np.newaxis, :]
+    scores = table[0, first] + table[first, second] + table[second, n]
+    valid = ((first >= min_era_years) &
+             (second - first >= min_era_years) &
+             (n - second >= min_era_years) &
+             (candidates[:, np.newaxis] < candidates[np.newaxis, :]))
+    i, j = np.nonzero(valid & np.isfinite(scores))
+    scored = pd.DataFrame({"advent_1" : candidates[i],
+                           "advent_2" : candidates[j],
+                           "score" : scores[i, j]},
+                          columns=["advent_1", "advent_2", "score"])
+    scored = scored.sort_values(["score", "advent_1", "advent_2"])
+
+    return scored.reset_index(drop=True)
+
+
+def cached_breakpoint_scores(years, values, candidates=None,
+                             min_era_years=10, criterion="sse",
+                             cache_dir=None):
+    """breakpoint_scores, cached under cache_dir by a digest of the series and
+    the arguments, so the search only runs again when they change"""
+    def compute():
+        scores = breakpoint_scores(years, values, candidates, min_era_years,
+                                   criterion)
+        return {name : scores[name].values for name in scores.columns}
+    if cache_dir is None:
+        return pd.DataFrame(compute())
+    series = array_digest([np.asarray(years, dtype=np.float64),
+                           np.asarray(values, dtype=np.float64)])
+    key = digest("breakpoints", BREAKPOINTS_VERSION, series,
+                 None if candidates is None else
+                 [int(candidate) for candidate in candidates],
+                 min_era_years, criterion)
+    columns = memoize_columns(os.path.join(cache_dir, "trend", key[:16]),
+                              key, compute)[0]
+
+    return pd.DataFrame({name : np.asarray(columns[name])
+                         for name in ["advent_1", "advent_2", "score"]})
+
+
+def choose_breakpoints(years, values, candidates=None, min_era_years=10,
+                       criterion="sse", cache_dir=None):
+    """The best (advent_1, advent_2) of breakpoint_scores, cached under
+    cache_dir if given"""
+    best = cached_breakpoint_scores(years, values, candidates, min_era_years,
+                                    criterion, cache_dir).iloc[0]
+
+    return int(best["advent_1"]), int(best["advent_2"])
@@ -1,14 +1,27 @@
 import os
-import sys
-from pprint import pprint
+import shutil
+import argparse
+import tempfile
 import numpy as np
 import pandas as pd
-import urllib.request
-import matplotlib.pyplot as plt
-from mpl_toolkits.basemap import Basemap
+from concurrent.futures import ProcessPoolExecutor
 
 
-from common import ROOT_DIR, START_YEAR, END_YEAR
+from common import RAW_DATA_DIR, START_YEAR, END_YEAR
+from ghcnd import (read_dly, read_stations, columns_to_frame, ELEMENTS,
+                   DLY_FILTER_VERSION)
+from cache import (CACHE_DIR, digest, file_digest, file_fingerprint, is_fresh,
+                   is_current, group_digests, source_metadata, load_metadata,
+                   load_columns, save_columns)
+from store import MeasurementStore
+from grid import grid_store
+from stress import stress_features
+from features import FeatureMatrix
+from windows import STATISTICS
+from download import Downloader, DownloadError, BASE_URL
+from instrument import (stage, add_result, log, warn, start_run,
+                        RUN_REPORT, PROFILE)
+from plots import plot, station_map, set_mode, wait, MODES, PLOTS
 
 
 class GhcndMunger:
@@ -37,184 +50,511 @@ class GhcndMunger:
         "USW00014898"]      #     WI                       GREEN BAY
 
 
-    def __init__(self):
-        """Prepare a wide schema for reading fixed width .dly files"""
-        # The fixed-width data in the .dly files begin with these four elements
-        self.dly_schema_names = ["ID", "YEAR", "MONTH", "ELEMENT"]
-        self.dly_schema_indices = [(0,11), (11,15), (15,17), (17,21)]
-        # After that, there are 4 components times 31 days. Append these numbered
-        # column names to the schema above
-        column_index = 21
-        for i in range(1,32):
-            self.dly_schema_names.append("VALUE" + str(i))
-            self.dly_schema_indices.append((column_index, column_index+5))
-            column_index += 5
-
-            self.dly_schema_names.append("MFLAG" + str(i))
-            self.dly_schema_indices.append((column_index, column_index+1))
-            column_index += 1
-
-            self.dly_schema_names.append("QFLAG" + str(i))
-            self.dly_schema_indices.append((column_index, column_index+1))
-            column_index += 1
-
-            self.dly_schema_names.append("SFLAG" + str(i))
-            self.dly_schema_indices.append((column_index, column_index+1))
-            column_index += 1
+    def __init__(self, cache_dir=CACHE_DIR, raw_data_dir=RAW_DATA_DIR,
+                 base_url=BASE_URL, download_workers=8):
+        """Parsed stations are memoized by ID, and cached on disk under
+        cache_dir unless it is None. .dly files are read from raw_data_dir,
+        and missing ones downloaded there from base_url, download_workers
+        at a time."""
+        self.cache_dir = cache_dir
+        self.raw_data_dir = raw_data_dir
+        self.downloader = Downloader(raw_data_dir, base_url, download_workers,
+                                     cache_dir=cache_dir)
         self.measurements = dict()
 
 
+    def get_columns(self, station_id):
+        """Parse one of the NOAA daily measurement files into the numpy columns
+        of ghcnd.parse_dly, downloading it first if need be. Raises
+        download.DownloadError if it can't be had."""
+        dly_path = os.path.join(self.raw_data_dir, station_id + ".dly")
+        if not os.path.isfile(dly_path):
+            result = self.downloader.fetch(station_id)
+            if result["status"] == "failed":
+                raise DownloadError("Error downloading " + station_id + ": " +
+                                    str(result["error"]), transient=False)
+        # Keep only temperature and precipitation totals in the study years,
+        # one row per day. Missing values and days with a bad quality flag are
+        # dropped, and so are days with source flag "S". According to docs:
+        # "NOTE: "S" values are derived from hourly synoptic reports exchanged
+        # on the Global Telecommunications System (GTS). Daily values derived
+        # in this fashion may differ significantly from "true" daily data,
+        # particularly for precipitation (i.e., use with caution)."
+        with stage("parse") as counts:
+            if self.cache_dir is None:
+                columns = read_dly(dly_path)
+            else:
+                columns = self.get_cached_columns(station_id, dly_path)
+            counts["rows"] = len(columns["VALUE"])
+
+        return columns
+
+
+    def get_cached_columns(self, station_id, dly_path):
+        """read_dly, cached per station, keyed on the filter settings and
+        checked against the .dly file itself"""
+        settings = digest("dly", DLY_FILTER_VERSION, START_YEAR, END_YEAR,
+                          ELEMENTS)
+        cache_path = os.path.join(self.cache_dir, "dly",
+                                  station_id + "-" + settings[:16])
+        metadata = load_metadata(cache_path)
+        if metadata is not None and is_fresh(dly_path, metadata, cache_path):
+            return load_columns(cache_path)
+        columns = read_dly(dly_path)
+        metadata = file_fingerprint(dly_path)
+        metadata["sha1"] = file_digest(dly_path)
+        save_columns(cache_path, columns, metadata)
+
+        return columns
+
+
+    def download(self, station_ids, refresh=False):
+        """Fetch the .dly files of stations that are missing (or, with
+        refresh, changed) concurrently, returning download.Downloader's
+        result for each"""
+        return self.downloader.fetch_all(station_ids, refresh)
+
+
     def get_measurements(self, station_id):
         """Obtain the relevant DataFrame representation of one of the NOAA daily
         measurement files."""
         if station_id in self.measurements:
             return self.measurements[station_id]
-        dly_path = os.path.join(ROOT_DIR, "raw_data", station_id + ".dly")
-        if not os.path.isfile(dly_path):
-            try:
-                url = ("https://www1.ncdc.noaa.gov/pub/data/ghcn/daily/all/" +
-                       station_id + ".dly")
-                with urllib.request.urlopen(url) as response, \
-                     open(dly_path, "wb") as out_file:
-                    data = response.read() # a `bytes` object
-                    out_file.write(data)
-            except:
-                print("Error downloading " + url)
-                sys.exit(0)
-        measurements = pd.read_fwf(
-            dly_path,
-            names=self.dly_schema_names,
-            colspecs=self.dly_schema_indices)
-        # Discard everything except for temperature and precipitation total
-        measurements = measurements[(measurements["ELEMENT"]=="PRCP") |
-                                    (measurements["ELEMENT"]=="TMAX") |
-                                    (measurements["ELEMENT"]=="TMIN")]
-        measurements = measurements[(measurements["YEAR"] >= START_YEAR) &
-                  (measurements["YEAR"] <= END_YEAR)]
-        # Change from rows being months to rows being days
-        measurements["dly_file_index"] = measurements.index
-        measurements = pd.wide_to_long(measurements,
-                                       ["VALUE", "MFLAG", "QFLAG", "SFLAG"],
-                                       i="dly_file_index",
-                                       j="DAY")
-        measurements = measurements.reset_index(level=["DAY"])
-        measurements["DAY"] = measurements["DAY"].astype(np.int64)
-        measurements = measurements[measurements["VALUE"] != -9999]
-        # Remove days with bad quality flag
-        measurements = measurements[measurements["QFLAG"].isnull()]
-        # Filter on source flag. According to docs: "NOTE: "S" values are derived
-        # from hourly synoptic reports exchanged on the Global Telecommunications
-        # System (GTS). Daily values derived in this fashion may differ
-        # significantly from "true" daily data, particularly for precipitation
-        # (i.e., use with caution)."
-        measurements["SFLAG"] = measurements["SFLAG"].astype(str)
-        measurements = measurements[measurements["SFLAG"] != "S"]
-        # Drop unused columns
-        measurements = measurements.drop("MFLAG", axis=1)
-        measurements = measurements.drop("QFLAG", axis=1)
-        measurements = measurements.drop("SFLAG", axis=1)
+        measurements = columns_to_frame(self.get_columns(station_id))
         # Memoize
         self.measurements[station_id] = measurements
 
         return measurements
 
 
+    def get_store(self, station_ids=default_station_ids, path=None,
+                  start_year=START_YEAR, end_year=END_YEAR, elements=ELEMENTS):
+        """Dense stations x days x elements alternative to get_measurements. If
+        path is given, reuse the memory-mapped store saved there if it holds
+        the same stations, years and elements, or build one there."""
+        if path is not None and os.path.isfile(os.path.join(path, "store.json")):
+            store = MeasurementStore.load(path)
+            if (store.station_ids == list(station_ids) and
+                    store.start_year == start_year and
+                    store.end_year == end_year and
+                    store.elements == tuple(elements)):
+                return store
+        return MeasurementStore.from_munger(self, station_ids, path,
+                                            start_year, end_year, elements)
+
+
+    def get_grid(self, station_ids=default_station_ids, cell_degrees=2.0,
+                 path=None, store_path=None):
+        """Average the stations over a grid of cell_degrees x cell_degrees
+        cells, returning a MeasurementStore with one series per occupied cell
+        for munge(store=...), memory-mapped under path if given. The cells
+        and their station counts are in the store's cells attribute.
+
+        The stations' own store is memory-mapped too, so that thousands of
+        them needn't fit in memory: under store_path (see get_store) if
+        given, and otherwise in a temporary directory removed once they are
+        gridded."""
+        stations = read_stations(
+            os.path.join(self.raw_data_dir, "ghcnd-stations.txt"))
+        scratch = None
+        if store_path is None:
+            scratch = store_path = tempfile.mkdtemp(prefix="store-")
+        try:
+            return grid_store(self.get_store(station_ids, store_path),
+                              stations, cell_degrees, path=path)
+        finally:
+            if scratch is not None:
+                shutil.rmtree(scratch)
+
+
     def plot_stations(self, station_ids=default_station_ids):
-        "Draw a map of stations."
-        stations = pd.read_fwf(
-            os.path.join(ROOT_DIR, "raw_data", "ghcnd-stations.txt"),
-            header=None,
-            names=[     "ID", "LATITUDE", "LONGITUDE", "ELEVATION", "STATE", "NAME", "GSN FLAG", "HCN/CRN FLAG", "WMO ID"],
-            colspecs=[(0,11),    (12,20),     (21,30),     (31,37), (38,40), (41,71),   (72,75),        (76,79), (80,85)])
+        """Draw a map of stations to stations.pdf with plots.plot: shown, in
+        the background or not at all, as the plots mode says."""
+        stations = read_stations(
+            os.path.join(self.raw_data_dir, "ghcnd-stations.txt"))
         stations = stations[
             stations["ID"].isin(station_ids)]
 
-        fig=plt.figure()
-        ax=fig.add_axes([0.1,0.1,0.8,0.8])
-        m = Basemap(projection="mill",\
-                    lon_0=0)
-        m.drawcoastlines()
-        m.drawcountries()
-        lons = stations["LONGITUDE"].tolist()
-        lats = stations["LATITUDE"].tolist()
-        x, y = m(lons, lats)
-        m.scatter(x,y,marker=".", color="red")
-        ax.set_title("Weather stations")
-        plt.savefig("stations.pdf")
-        plt.show()    
+        return plot(station_map, stations)
 
                 
+    # The columns munge emits for every station and month, in order
+    monthly_statistics = STATISTICS
+
+    # Bump whenever monthly_aggregates changes, to invalidate cached ones
+    aggregates_version = 1
+    # Bump whenever munge_station or the stress features change what munge
+    # writes, to rewrite weather.features
+    features_version = 2
+
+
+    @classmethod
+    def season_schema(cls, station_id, start_month, end_month):
+        "Names of one station's columns in the wide munge output"
+        return [element + statistic + "_" + str(station_id) +
+                "_month" + str(month)
+                for month in range(start_month, end_month+1)
+                for element, statistic in cls.monthly_statistics]
+
+
+    def get_aggregates(self, station_id):
+        """monthly_aggregates of one station's .dly file. Cached under
+        cache_dir with a digest of each year's measurements, so when the
+        file changes, say with a new year's data, only the years whose
+        measurements changed are aggregated again."""
+        if self.cache_dir is None:
+            with stage("aggregate") as counts:
+                aggregates = monthly_aggregates(
+                    self.get_measurements(station_id))
+                counts["rows"] = len(aggregates)
+            return aggregates
+        cache_path = self.aggregates_path(station_id)
+        metadata = load_metadata(cache_path)
+        if self.aggregates_current(station_id, metadata):
+            return aggregates_from_columns(load_columns(cache_path))
+        columns = self.get_columns(station_id)
+        year_digests = group_digests(
+            columns["YEAR"], [columns[name] for name
+                              in ("MONTH", "DAY", "ELEMENT", "VALUE")])
+        unchanged = []
+        if metadata is not None:
+            unchanged = [int(year) for year, year_digest
+                         in year_digests.items()
+                         if metadata["year_digests"].get(year) == year_digest]
+        with stage("aggregate") as counts:
+            changed = ~np.isin(columns["YEAR"], unchanged)
+            aggregates = monthly_aggregates(columns_to_frame(
+                {name : (column if name == "ID_NAMES" else column[changed])
+                 for name, column in columns.items()}))
+            counts["rows"] = len(aggregates)
+        if unchanged:
+            previous = aggregates_from_columns(load_columns(cache_path))
+            aggregates = pd.concat(
+                [previous[previous["YEAR"].isin(unchanged)], aggregates],
+                ignore_index=True)
+            aggregates = aggregates.sort_values(
+                ["ELEMENT", "YEAR", "MONTH"]).reset_index(drop=True)
+        dly_path = os.path.join(self.raw_data_dir, station_id + ".dly")
+        metadata = file_fingerprint(dly_path)
+        metadata["sha1"] = file_digest(dly_path)
+        metadata["years"] = [START_YEAR, END_YEAR]
+        metadata["year_digests"] = year_digests
+        metadata["digest"] = digest("aggregates", self.aggregates_version,
+                                    year_digests)
+        save_columns(cache_path, aggregates_to_columns(aggregates), metadata)
+
+        return aggregates
+
+
+    def aggregates_path(self, station_id):
+        settings = digest("aggregates", self.aggregates_version,
+                          DLY_FILTER_VERSION, ELEMENTS)
+        return os.path.join(self.cache_dir, "aggregates",
+                            station_id + "-" + settings[:16])
+
+
+    def aggregates_current(self, station_id, metadata):
+        "Whether a station's cached aggregates are of its .dly file as it is"
+        dly_path = os.path.join(self.raw_data_dir, station_id + ".dly")
+        return (metadata is not None and
+                metadata.get("years") == [START_YEAR, END_YEAR] and
+                os.path.isfile(dly_path) and
+                is_fresh(dly_path, metadata, self.aggregates_path(station_id)))
+
+
+    def features_key(self, station_ids, start_month, end_month, enough_days,
+                     stress, dtype=np.float64):
+        """Digest of everything munge's output depends on, or None if some
+        station's cached aggregates are out of date (or there is no cache)"""
+        if self.cache_dir is None:
+            return None
+        aggregates = []
+        for station_id in station_ids:
+            metadata = load_metadata(self.aggregates_path(station_id))
+            if not self.aggregates_current(station_id, metadata):
+                return None
+            aggregates.append(metadata["digest"])
+
+        return digest("features", self.features_version, START_YEAR, END_YEAR,
+                      list(station_ids), aggregates, start_month, end_month,
+                      enough_days, stress, np.dtype(dtype).name)
+
+
+    def munge_station(self, station_id, start_month=2, end_month=11,
+                      enough_days=15, store=None):
+        """Monthly statistics of one station for every year, as a DataFrame
+        indexed by year with the station's season_schema columns, and the
+        number of months that fell back on the all-years climatology. The
+        measurements come from store, a MeasurementStore, if given, and from
+        the station's (cached) get_aggregates otherwise."""
+        if store is None:
+            aggregates = self.get_aggregates(station_id)
+        else:
+            with stage("aggregate") as counts:
+                aggregates = monthly_aggregates(store.to_frame(station_id))
+                counts["rows"] = len(aggregates)
+        integers = aggregates["min"].dtype.kind == "i"
+        with stage("filter") as counts:
+            aggregates = aggregates[
+                (aggregates["MONTH"] >= start_month) &
+                (aggregates["MONTH"] <= end_month)]
+            counts["rows"] = len(aggregates)
+        with stage("aggregate") as counts:
+            monthly = aggregates.set_index(["ELEMENT", "YEAR", "MONTH"])
+            # Months with too few measurements use every year's measurements
+            # from that month instead
+            climatology = aggregates.groupby(["ELEMENT", "MONTH"]).agg(
+                {"count" : "sum", "sum" : "sum", "min" : "min", "max" : "max"})
+            climatology["mean"] = climatology["sum"] / climatology["count"]
+            climatology = climatology[["mean", "min", "max"]]
+            monthly = monthly.assign(mean=monthly["sum"] / monthly["count"])
+            monthly = monthly[["count", "mean", "min", "max"]]
+            elements = sorted(set(element for element, statistic
+                                  in self.monthly_statistics))
+            monthly = monthly.reindex(pd.MultiIndex.from_product(
+                [elements, range(START_YEAR, END_YEAR+1),
+                 range(start_month, end_month+1)],
+                names=["ELEMENT", "YEAR", "MONTH"]))
+            bad = ~(monthly["count"] >= enough_days)
+            fallback = climatology.reindex(pd.MultiIndex.from_arrays(
+                [monthly.index.get_level_values("ELEMENT"),
+                 monthly.index.get_level_values("MONTH")]))
+            monthly = monthly.drop("count", axis=1)
+            monthly.loc[bad.values, :] = fallback[bad.values].values
+            monthly = monthly.rename(columns={"mean" : "avg"})
+            counts["rows"] = len(monthly)
+        with stage("reshape") as counts:
+            # One row per year, one column per (statistic, element, month)
+            monthly = monthly.unstack(["ELEMENT", "MONTH"])
+            # Minima and maxima stay integers unless a month has no data at
+            # all
+            for column in monthly.columns:
+                if (column[0] != "avg" and integers and
+                        monthly[column].notnull().all()):
+                    monthly[column] = monthly[column].astype(np.int64)
+            monthly.columns = [element + statistic + "_" + str(station_id) +
+                               "_month" + str(month)
+                               for statistic, element, month
+                               in monthly.columns]
+            monthly = monthly[self.season_schema(station_id, start_month,
+                                                 end_month)]
+            monthly.index.name = "year"
+            counts["rows"] = len(monthly)
+
+        return monthly, int(bad.sum())
+
+
     def munge(self, start_month=2, end_month=11, enough_days=15,
-              station_ids=default_station_ids):
+              station_ids=None, workers=1, store=None, stress=None,
+              dtype=np.float64, csv=False, allow_missing=False):
         """Compute monthly averages of TMIN, TMAX and PRCP and return them in a 
-        DataFrame."""
-        # pandas doesn't have wide_to_long, so generate a big wide schema.
-        # (This is naming the columns of what will be X.)
-        season_schema = ["year"]
-        for station_id in station_ids:
-            for month in range(start_month, end_month+1):
-                season_schema += [
-                "TMAXavg_" + str(station_id) + "_month" + str(month),
-                "TMAXmin_" + str(station_id) + "_month" + str(month),
-                "TMAXmax_" + str(station_id) + "_month" + str(month),
-                "TMINavg_" + str(station_id) + "_month" + str(month),
-                "TMINmin_" + str(station_id) + "_month" + str(month),
-                "TMINmax_" + str(station_id) + "_month" + str(month),
-                "PRCPavg_" + str(station_id) + "_month" + str(month),
-                "PRCPmax_" + str(station_id) + "_month" + str(month)]
-        seasons = []
-        bad_months = {station_id : 0 for station_id in station_ids}
-        for year in range(START_YEAR, END_YEAR+1):
-            print(str(year) + " ... ", end = ""); sys.stdout.flush()
-            season = [year]
-            for station_id in station_ids:
-                measurements = self.get_measurements(station_id)
-                for month in range(start_month, end_month+1):
-                    tmaxs = measurements[(measurements["MONTH"] == month) &
-                                         (measurements["YEAR"] == year) &
-                                         (measurements["ELEMENT"] == "TMAX") ]
-                    if(len(tmaxs) < enough_days):
-                        print(":( ", end="")
-                        bad_months[station_id] += 1
-                        tmaxs = measurements[(measurements["MONTH"] == month) &
-                                             (measurements["ELEMENT"] == "TMAX")]
-                    tmins = measurements[(measurements["MONTH"] == month) &
-                                         (measurements["YEAR"] == year) &
-                                         (measurements["ELEMENT"] == "TMIN") ]
-                    if(len(tmins) < enough_days):
-                        print(":( ", end="")
-                        bad_months[station_id] += 1
-                        tmins = measurements[(measurements["MONTH"] == month) &
-                                             (measurements["ELEMENT"] == "TMIN")]
-                    prcps = measurements[(measurements["MONTH"] == month) &
-                                         (measurements["YEAR"] == year) &
-                                         (measurements["ELEMENT"] == "PRCP")]
-                    if(len(prcps) < enough_days):
-                        print(":( ", end="")
-                        bad_months[station_id] += 1
-                        prcps = measurements[(measurements["MONTH"] == month) &
-                                             (measurements["ELEMENT"] == "PRCP")]
-                    season += [tmaxs["VALUE"].mean(),
-                               tmaxs["VALUE"].min(),
-                               tmaxs["VALUE"].max(),
-                               tmins["VALUE"].mean(),
-                               tmins["VALUE"].min(),
-                               tmins["VALUE"].max(),
-                               prcps["VALUE"].mean(),
-                               prcps["VALUE"].max()]
-            seasons.append(season)
-            print("")
-        print("Bad months: ")
-        pprint(bad_months)
-        seasons = pd.DataFrame(seasons, columns=season_schema)
+        DataFrame. With workers > 1 the stations are parsed and aggregated in
+        a pool of that many processes. Missing .dly files are downloaded
+        concurrently first. A station that can't be downloaded raises a
+        DownloadError, unless allow_missing, when it is reported and left
+        out, along with its columns.
+
+        Given a MeasurementStore, such as the grid cells from get_grid, its
+        series are munged instead of .dly files, all of them unless
+        station_ids says otherwise. Stores on disk are shared with the
+        workers rather than copied to them, and stores in memory are saved
+        to a temporary directory to be shared the same way.
+
+        stress adds the season's weather stress event counts from
+        stress.stress_features: True for the default thresholds, or a dict
+        overriding some of them.
+
+        The statistics are saved as a features.FeatureMatrix of dtype
+        (float64, or float32 for half the size) in weather.features, which
+        the predictors memory-map. csv also writes them to weather.csv for
+        inspection.
+
+        Munging .dly files is incremental: each station's monthly aggregates
+        are cached by year (see get_aggregates), and the outputs are keyed on
+        those and the arguments. If nothing they depend on changed, they are
+        loaded rather than rebuilt, and they are only rewritten when their
+        content would change, so make sees them as up to date."""
+        if station_ids is None:
+            station_ids = (self.default_station_ids if store is None
+                           else store.station_ids)
+        if store is None:
+            with stage("download") as counts:
+                downloads = self.download(station_ids)
+                counts["rows"] = len(downloads)
+            failures = {result["station_id"] : result["error"]
+                        for result in downloads
+                        if result["status"] == "failed"}
+            if failures:
+                missing = [column for station_id in sorted(failures)
+                           for column in self.season_schema(
+                               station_id, start_month, end_month)]
+                message = ("Couldn't download " + ", ".join(sorted(failures)) +
+                           ", so " + str(len(missing)) + " columns, such as " +
+                           missing[0] + ", would be missing")
+                if not allow_missing:
+                    raise DownloadError(message + " (allow_missing, or "
+                                        "--allow-missing, munges without "
+                                        "them)", False)
+                warn(message + "; leaving them out")
+                add_result("download_failures", failures)
+                station_ids = [station_id for station_id in station_ids
+                               if station_id not in failures]
+        dtype = np.dtype(dtype)
+        features_path = os.path.abspath("weather.features")
+        outputs = [os.path.join(features_path, name) for name
+                   in ("values.npy", "years.npy", "features.json")]
+        if csv:
+            outputs.append(os.path.abspath("weather.csv"))
+        record_path = None
+        if store is None and self.cache_dir is not None:
+            record_path = os.path.join(self.cache_dir, "features", "weather")
+            record = load_metadata(record_path)
+            if (all(os.path.isfile(output) for output in outputs) and
+                    is_current(record, self.features_key(
+                        station_ids, start_month, end_month, enough_days,
+                        stress, dtype), outputs, record_path)):
+                log("weather.features is up to date")
+                add_result("bad_months", record["bad_months"])
+                return FeatureMatrix.load(features_path).to_frame(
+                    integers=True)
+        scratch = None
+        shared_store = store
+        if workers > 1 and store is not None and store.path is None:
+            # Stores on disk travel to the workers as their path, so save an
+            # in-memory one rather than pickle the whole array into every
+            # task
+            scratch = tempfile.mkdtemp(prefix="store-")
+            store.save(scratch)
+            shared_store = MeasurementStore.load(scratch)
+        arguments = [(station_id, start_month, end_month, enough_days,
+                      shared_store) for station_id in station_ids]
+        with stage("stations") as counts:
+            if workers > 1:
+                # map hands results back in station order, so the output is
+                # the same as a serial run
+                try:
+                    with ProcessPoolExecutor(max_workers=workers) as executor:
+                        results = list(executor.map(
+                            _munge_station,
+                            [(self.cache_dir, self.raw_data_dir, station)
+                             for station in arguments]))
+                finally:
+                    if scratch is not None:
+                        shutil.rmtree(scratch)
+            else:
+                results = [self.munge_station(*station)
+                           for station in arguments]
+            counts["rows"] = len(results)
+        stations = []
+        bad_months = dict()
+        for station_id, (station, bad) in zip(station_ids, results):
+            stations.append(station)
+            bad_months[station_id] = bad
+        log("Bad months: " + (", ".join(
+            str(station_id) + " " + str(bad)
+            for station_id, bad in bad_months.items() if bad) or "none"))
+        add_result("bad_months", bad_months)
+        seasons = pd.concat(stations, axis=1)
+        if stress:
+            with stage("stress"):
+                if store is None:
+                    store = self.get_store(station_ids)
+                seasons = seasons.join(stress_features(
+                    store, start_month, end_month, station_ids,
+                    **(stress if isinstance(stress, dict) else {})))
         #seasons = seasons.fillna(0)
-        seasons = seasons.set_index("year")
-        seasons.to_csv("weather.csv")
+        with stage("write") as counts:
+            key = None
+            if record_path is not None:
+                key = self.features_key(station_ids, start_month, end_month,
+                                        enough_days, stress, dtype)
+            # The same inputs make the same files, so leave them be
+            if (key is None or
+                    not all(os.path.isfile(output) for output in outputs) or
+                    not is_current(load_metadata(record_path), key, outputs,
+                                   record_path)):
+                features = FeatureMatrix.from_frame(seasons, dtype)
+                features.save(features_path)
+                if csv:
+                    features.to_csv(outputs[-1])
+                counts["rows"] = len(seasons)
+                if key is not None:
+                    save_columns(record_path, {},
+                                 {"key" : key,
+                                  "sources" : source_metadata(outputs),
+                                  "bad_months" : bad_months})
         
         return seasons
 
 
+def monthly_aggregates(measurements):
+    """count, sum, min and max of the VALUEs of a long daily DataFrame by
+    ELEMENT, YEAR and MONTH, which is all that any season's statistics
+    need, as a DataFrame with those columns"""
+    aggregates = measurements.groupby(["ELEMENT", "YEAR", "MONTH"])[
+        "VALUE"].agg(["count", "sum", "min", "max"])
+
+    return aggregates.reset_index()
+
+
+def aggregates_to_columns(aggregates, elements=ELEMENTS):
+    "monthly_aggregates as numpy columns for the cache, elements as codes"
+    columns = {name : aggregates[name].values for name in aggregates.columns}
+    columns["ELEMENT"] = pd.Categorical(
+        aggregates["ELEMENT"], categories=elements).codes
+
+    return columns
+
+
+def aggregates_from_columns(columns, elements=ELEMENTS):
+    "Inverse of aggregates_to_columns"
+    aggregates = pd.DataFrame(
+        {name : columns[name] for name in ["ELEMENT", "YEAR", "MONTH",
+                                           "count", "sum", "min", "max"]})
+    aggregates["ELEMENT"] = np.array(elements, dtype=object)[
+        aggregates["ELEMENT"].values]
+
+    return aggregates
+
+
+def _munge_station(arguments):
+    """Process pool entry point. Each worker parses its station itself, and
+    only the small per-station frame of monthly statistics travels back."""
+    cache_dir, raw_data_dir, station = arguments
+    return GhcndMunger(cache_dir, raw_data_dir).munge_station(*station)
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Munge NOAA daily station files into weather.features")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes munging stations")
+    parser.add_argument("--float32", action="store_true",
+                        help="store the features as float32")
+    parser.add_argument("--csv", action="store_true",
+                        help="also write weather.csv for inspection")
+    parser.add_argument("--allow-missing", action="store_true",
+                        help="leave out stations that can't be downloaded "
+                             "rather than stop")
+    parser.add_argument("--plots", choices=MODES, default=PLOTS,
+                        help="show the station map, render it in the "
+                             "background, or skip it and only munge")
+    parser.add_argument("--report", default=RUN_REPORT,
+                        help="write a JSON report of the run's stages here")
+    parser.add_argument("--profile", default=PROFILE,
+                        help="profiling hooks, comma separated: cprofile, "
+                             "tracemalloc")
+    args = parser.parse_args()
+    run = start_run("weather", args.profile, args.report)
+    set_mode(args.plots)
     m = GhcndMunger()
-    m.plot_stations()
-    m.munge()
+    if args.plots != "none":
+        with stage("plot"):
+            m.plot_stations()
+    m.munge(workers=args.workers,
+            dtype=np.float32 if args.float32 else np.float64, csv=args.csv,
+            allow_missing=args.allow_missing)
+    with stage("plot"):
+        wait()
+    if args.report:
+        run.write(args.report)
@@ -0,0 +1,249 @@
+import numpy as np
+import pandas as pd
+
+
+# The statistics munge takes of every window, in column order
+STATISTICS = [("TMAX", "avg"), ("TMAX", "min"), ("TMAX", "max"),
+              ("TMIN", "avg"), ("TMIN", "min"), ("TMIN", "max"),
+              ("PRCP", "avg"), ("PRCP", "max")]
+
+
+class WindowIndex:
+    """Prefix sums, prefix counts and sparse min/max tables over the days of a
+    MeasurementStore, built once, after which the count, average, minimum and
+    maximum of any window of days costs O(1) per station and element.
+
+    Level k of a sparse table holds the minimum (maximum) of every 2^k day
+    span, so any window is covered by two overlapping spans of the largest
+    level that fits. Levels go up to max_window_days."""
+
+    def __init__(self, store, station_ids=None, max_window_days=366):
+        self.store = store
+        if station_ids is None:
+            station_ids = store.station_ids
+        self.station_ids = list(station_ids)
+        self.max_window_days = max_window_days
+        values = np.asarray(
+            store.values[[store.station_index[station_id]
+                          for station_id in self.station_ids]],
+            dtype=np.float64)
+        present = ~np.isnan(values)
+        start = np.zeros((values.shape[0], 1, values.shape[2]))
+        self.sums = np.concatenate(
+            [start, np.cumsum(np.where(present, values, 0.0), axis=1)],
+            axis=1)
+        self.counts = np.concatenate(
+            [start.astype(np.int64), np.cumsum(present, axis=1)], axis=1)
+        self.minima = [np.where(present, values, np.inf).astype(np.float32)]
+        self.maxima = [np.where(present, values, -np.inf).astype(np.float32)]
+        span = 1
+        while 2 * span <= max_window_days:
+            self.minima.append(np.minimum(self.minima[-1][:, :-span],
+                                          self.minima[-1][:, span:]))
+            self.maxima.append(np.maximum(self.maxima[-1][:, :-span],
+                                          self.maxima[-1][:, span:]))
+            span *= 2
+
+
+    def query(self, starts, stops):
+        """count, sum, min and max of the days [start, stop) of every window,
+        as arrays shaped stations x windows x elements. starts and stops are
+        day offsets into the store, one per window or one per station and
+        window. Empty windows have NaN minimum and maximum."""
+        shape = (len(self.station_ids), np.shape(starts)[-1])
+        starts = np.broadcast_to(np.asarray(starts, dtype=np.int64), shape)
+        stops = np.broadcast_to(np.asarray(stops, dtype=np.int64), shape)
+        lengths = stops - starts
+        assert lengths.min() > 0 and lengths.max() <= self.max_window_days
+        stations = np.broadcast_to(
+            np.arange(shape[0])[:, np.newaxis], shape)
+        statistics = {
+            "count" : (self.counts[stations, stops] -
+                       self.counts[stations, starts]),
+            "sum" : (self.sums[stations, stops] -
+                     self.sums[stations, starts])}
+        levels = np.floor(np.log2(lengths)).astype(np.int64)
+        for name, tables, combine, empty in [
+                ("min", self.minima, np.minimum, np.inf),
+                ("max", self.maxima, np.maximum, -np.inf)]:
+            extreme = np.empty(shape + (self.sums.shape[2],))
+            for level in np.unique(levels):
+                at = levels == level
+                table = tables[level]
+                extreme[at] = combine(
+                    table[stations[at], starts[at]],
+                    table[stations[at], stops[at] - 2**level])
+            extreme[extreme == empty] = np.nan
+            statistics[name] = extreme
+
+        return statistics
+
+
+def month_windows(store, start_month=2, end_month=11):
+    "Calendar months of every year, named like month7"
+    windows = []
+    for year in range(store.start_year, store.end_year + 1):
+        for month in range(start_month, end_month + 1):
+            days = store.day_slice(year, month)
+            windows.append([year, "month" + str(month), days.start,
+                            days.stop])
+
+    return pd.DataFrame(windows, columns=["year", "name", "start", "stop"])
+
+
+def dekad_windows(store, start_month=2, end_month=11):
+    """Days 1-10, 11-20 and 21 to the end of every month, named like
+    dekad2_month7"""
+    windows = []
+    for year in range(store.start_year, store.end_year + 1):
+        for month in range(start_month, end_month + 1):
+            days = store.day_slice(year, month)
+            bounds = [days.start, days.start + 10, days.start + 20, days.stop]
+            for dekad in range(3):
+                windows.append([year,
+                                "dekad" + str(dekad+1) + "_month" + str(month),
+                                bounds[dekad], bounds[dekad+1]])
+
+    return pd.DataFrame(windows, columns=["year", "name", "start", "stop"])
+
+
+def week_windows(store, start_month=2, end_month=11):
+    """Seven day weeks counted from the first of start_month, the last one
+    cut short at the end of end_month. Named like week05_month3 after the
+    month the week ends in (in a non-leap year), so that names agree from
+    year to year."""
+    windows = []
+    reference = pd.Timestamp("2001-%02d-01" % start_month)
+    for year in range(store.start_year, store.end_year + 1):
+        start = store.day_slice(year, start_month).start
+        stop = store.day_slice(year, end_month).stop
+        for week, week_start in enumerate(range(start, stop, 7)):
+            month = (reference + pd.Timedelta(days=7*week + 6)).month
+            windows.append([year,
+                            "week%02d_month%d" % (week + 1, month),
+                            week_start, min(week_start + 7, stop)])
+
+    return pd.DataFrame(windows, columns=["year", "name", "start", "stop"])
+
+
+def date_windows(store, spec):
+    """Custom windows. spec is either a list of (name, (month, day),
+    (month, day)) inclusive date ranges applied to every year, or a DataFrame
+    of year, name, start_date and end_date (inclusive) giving each year its
+    own ranges."""
+    first_day = store.dates[0]
+    if not isinstance(spec, pd.DataFrame):
+        spec = pd.DataFrame(
+            [[year, name,
+              pd.Timestamp(year=year, month=start[0], day=start[1]),
+              pd.Timestamp(year=year, month=end[0], day=end[1])]
+             for year in range(store.start_year, store.end_year + 1)
+             for name, start, end in spec],
+            columns=["year", "name", "start_date", "end_date"])
+    windows = pd.DataFrame({
+        "year" : spec["year"].values,
+        "name" : spec["name"].values,
+        "start" : (pd.to_datetime(spec["start_date"]) - first_day).dt.days,
+        "stop" : (pd.to_datetime(spec["end_date"]) - first_day).dt.days + 1},
+        columns=["year", "name", "start", "stop"])
+
+    return windows
+
+
+def gdd_windows(store, station_id, stages, start_month=4, base=100, cap=300):
+    """Crop development stages of one station, found from growing degree days
+    accumulated from the first of start_month each year. stages is a list of
+    (name, gdd_from, gdd_to) in degree C days; a stage runs from the day the
+    total reaches gdd_from until it reaches gdd_to (or the end of the year).
+    Concatenate the windows of several stations to aggregate them together.
+    Daily GDD is the mean of TMAX and TMIN, each clamped to [base, cap]
+    (tenths of C), less base. Missing days add nothing."""
+    tmax = np.clip(store.select(station_id, "TMAX"), base, cap)
+    tmin = np.clip(store.select(station_id, "TMIN"), base, cap)
+    daily = np.nan_to_num((tmax + tmin) / 2.0 - base) / 10.0
+    windows = []
+    for year in range(store.start_year, store.end_year + 1):
+        start = store.day_slice(year, start_month).start
+        stop = store.day_slice(year).stop
+        accumulated = np.cumsum(daily[start:stop])
+        for name, gdd_from, gdd_to in stages:
+            first, last = np.searchsorted(accumulated, [gdd_from, gdd_to])
+            # Stages never reached are squeezed onto the last day
+            first = min(first, len(accumulated) - 1)
+            windows.append([year, name, start + first,
+                            start + max(last, first + 1)])
+    windows = pd.DataFrame(windows, columns=["year", "name", "start", "stop"])
+    windows["stop"] = np.minimum(windows["stop"],
+                                 store.month_offsets[-1])
+    windows["station"] = station_id
+
+    return windows
+
+
+def aggregate(index, windows, enough_days=15, statistics=STATISTICS):
+    """munge, generalised to any windows: a DataFrame indexed by year with
+    columns like TMAXavg_USW00023271_dekad2_month7, per station, window name
+    and statistic.
+
+    As in munge, a window with fewer than enough_days measurements of an
+    element takes that element's statistics from the same window in every
+    year instead. enough_days below 1 is a fraction of the window's length.
+    windows may carry a station column, for per station windows like
+    gdd_windows, in which case every station needs the same years and
+    names; otherwise every station shares them. Also returns the number of
+    windows that fell back, per station."""
+    if "station" in windows.columns:
+        # One set of (year, name) windows per station, in the same order
+        per_station = [windows[windows["station"] == station_id].sort_values(
+            ["year", "name"]) for station_id in index.station_ids]
+        windows = per_station[0]
+        starts = np.vstack([w["start"].values for w in per_station])
+        stops = np.vstack([w["stop"].values for w in per_station])
+    else:
+        starts = windows["start"].values[np.newaxis, :]
+        stops = windows["stop"].values[np.newaxis, :]
+    names, name_codes = np.unique(windows["name"].values, return_inverse=True)
+    years = np.asarray(windows["year"].values)
+    results = index.query(starts, stops)
+    count = results["count"].astype(np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        results["avg"] = results["sum"] / count
+    # Every year's measurements, per window name
+    shape = (count.shape[0], len(names), count.shape[2])
+    climatology = {"count" : np.zeros(shape), "sum" : np.zeros(shape),
+                   "min" : np.full(shape, np.inf),
+                   "max" : np.full(shape, -np.inf)}
+    for name, reduce in [("count", np.add), ("sum", np.add),
+                         ("min", np.fmin), ("max", np.fmax)]:
+        reduce.at(climatology[name].transpose(1, 0, 2), name_codes,
+                  np.asarray(results[name], dtype=np.float64).transpose(
+                      1, 0, 2))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        climatology["avg"] = climatology["sum"] / climatology["count"]
+    climatology["min"][np.isinf(climatology["min"])] = np.nan
+    climatology["max"][np.isinf(climatology["max"])] = np.nan
+    lengths = np.broadcast_to(stops - starts, count.shape[:2])
+    needed = enough_days * lengths if enough_days < 1 else enough_days
+    bad = count < np.asarray(needed)[..., np.newaxis]
+    elements = index.store.elements
+    order = pd.unique(windows["name"].values)
+    columns = dict()
+    for i, station_id in enumerate(index.station_ids):
+        for name in order:
+            in_window = windows["name"].values == name
+            for element, statistic in statistics:
+                e = elements.index(element)
+                values = np.where(
+                    bad[i, in_window, e],
+                    climatology[statistic][i, name_codes[in_window], e],
+                    results[statistic][i, in_window, e])
+                columns[element + statistic + "_" + str(station_id) + "_" +
+                        name] = pd.Series(values, index=years[in_window])
+    aggregated = pd.DataFrame(columns)
+    aggregated.index.name = "year"
+    used = [elements.index(element) for element
+            in sorted(set(element for element, statistic in statistics))]
+    bad_windows = {station_id : int(bad[i][:, used].sum())
+                   for i, station_id in enumerate(index.station_ids)}
+
+    return aggregated, bad_windows